@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from label_store import DIRTY_BLOCK_SIZE
+
+AUTOSAVE_INTERVAL_SECONDS = 60
+AUTOSAVE_ROOT = os.path.join(os.path.expanduser("~"), ".cell_gui", "autosave")
+MANIFEST_NAME = "manifest.json"
+
+
+def autosave_path(image_filename):
+    # One autosave directory per image file
+    key = hashlib.sha1(os.path.abspath(image_filename).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(AUTOSAVE_ROOT, key)
+
+
+def replace_file(filename, write):
+    # write(file object) goes to a temporary file which then replaces filename,
+    # so a crash never leaves a half written file behind
+    partial = filename + ".part"
+    with open(partial, "wb") as fp:
+        write(fp)
+    os.replace(partial, filename)
+
+
+class AutosaveStore:
+    # Directory holding the annotations of one image, one compressed .npz per
+    # DIRTY_BLOCK_SIZE^3 block that has labels plus a manifest.json listing the
+    # blocks. A checkpoint only rewrites the blocks edited since the previous
+    # one, so its cost follows the amount of edited data.
+
+    def __init__(self, image_filename, path=None):
+        self.image_filename = image_filename
+        self.path = path or autosave_path(image_filename)
+        self.manifest = self.read_manifest()
+        self.blocks = set(self.manifest["blocks"]) if self.manifest is not None else set()
+        # (label store id, version) last saved to a file by the user
+        self.saved = None
+        # Label store the blocks on disk were taken from, linked tabs swap it
+        self.label_store_id = None
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST_NAME)) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def block_filename(self, key):
+        return os.path.join(self.path, "block_%d.npz" % key)
+
+    def can_resume(self, shape):
+        # Only autosaves with edits that were never saved to a file are offered
+        manifest = self.manifest
+        return manifest is not None and manifest.get("unsaved", False) \
+            and tuple(manifest["shape"]) == tuple(shape[:3]) and manifest["block_size"] == DIRTY_BLOCK_SIZE
+
+    def is_unsaved(self, label_store):
+        return self.saved != (id(label_store), label_store.version)
+
+    def track(self, label_store):
+        self.label_store_id = id(label_store)
+
+    def needs_checkpoint(self, label_store):
+        if len(label_store.dirty_blocks) > 0 or self.label_store_id != id(label_store):
+            return True
+        unsaved = self.is_unsaved(label_store)
+        if self.manifest is None:
+            return unsaved
+        return self.manifest.get("unsaved") != unsaved
+
+    def write(self, shape, blocks, unsaved):
+        # blocks: {block key: block array, None for blocks without labels}
+        os.makedirs(self.path, exist_ok=True)
+        for key, block in blocks.items():
+            filename = self.block_filename(key)
+            if block is None:
+                self.blocks.discard(key)
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+            replace_file(filename, lambda fp: np.savez_compressed(fp, labels=block))
+            self.blocks.add(key)
+        manifest = {
+            "image": self.image_filename,
+            "shape": list(shape[:3]),
+            "block_size": DIRTY_BLOCK_SIZE,
+            "blocks": sorted(self.blocks),
+            "unsaved": unsaved,
+            "time": time.time(),
+        }
+        replace_file(os.path.join(self.path, MANIFEST_NAME), lambda fp: fp.write(json.dumps(manifest).encode("utf-8")))
+        self.manifest = manifest
+
+    def load_into(self, label_store):
+        # Paints the autosaved blocks into an empty label store
+        for key in sorted(self.blocks):
+            try:
+                with np.load(self.block_filename(key)) as data:
+                    block = data["labels"]
+            except (OSError, KeyError, ValueError):
+                continue
+            z0, y0, x0 = label_store.block_origin(key)
+            z, y, x = np.nonzero(block)
+            label_store.add_labelled_points(np.column_stack((x + x0, y + y0, z + z0)), block[z, y, x])
+        # The blocks on disk already match the store
+        label_store.take_dirty_blocks()
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.manifest = None
+        self.blocks = set()
+
+
+def checkpoint_jobs(pairs):
+    # Copies the blocks edited since the last checkpoint on the calling (GUI)
+    # thread, the AutosaveWriter compresses and writes them. pairs holds the
+    # (autosave store, label store) of every tab. A label store shared by
+    # several pairs has its dirty blocks read once for all of them.
+    # An autosave whose tab switched to another label store rewrites the blocks
+    # it holds and those that may hold labels in the new store, nothing else.
+    jobs = []
+    dirty = {}
+    pending = [(autosave_store, label_store) for autosave_store, label_store in pairs
+               if autosave_store.needs_checkpoint(label_store)]
+    for autosave_store, label_store in pending:
+        if id(label_store) not in dirty:
+            dirty[id(label_store)] = read_blocks(label_store, label_store.take_dirty_blocks())
+        blocks = dirty[id(label_store)]
+        if autosave_store.label_store_id != id(label_store):
+            swapped = (autosave_store.blocks | label_store.label_blocks) - blocks.keys()
+            blocks = dict(blocks)
+            blocks.update(read_blocks(label_store, swapped))
+            autosave_store.track(label_store)
+        jobs.append((autosave_store, label_store, blocks, autosave_store.is_unsaved(label_store)))
+    return jobs
+
+
+def read_blocks(label_store, keys):
+    # {key: block copy, None for blocks without labels}, blocks found empty
+    # are no longer counted as possibly holding labels
+    blocks = {}
+    for key in keys:
+        blocks[key] = label_store.read_block(key)
+        if blocks[key] is None:
+            label_store.label_blocks.discard(key)
+    return blocks
+
+
+class AutosaveWriter(QThread):
+    # Writes the checkpoint jobs of all tabs off the GUI thread. The blocks of
+    # failed jobs are handed back through restore_failed once it has finished,
+    # their errors are reported through error_signal.
+    error_signal = pyqtSignal(str, str)
+
+    def __init__(self, jobs, parent=None):
+        super().__init__(parent)
+        self.jobs = jobs
+        self.failed = []
+
+    def run(self):
+        errors = []
+        for autosave_store, label_store, blocks, unsaved in self.jobs:
+            try:
+                autosave_store.write(label_store.shape, blocks, unsaved)
+            except OSError as e:
+                errors.append(f"{autosave_store.path}: {e}")
+                self.failed.append((label_store, blocks))
+        if len(errors) > 0:
+            self.error_signal.emit("Autosave Failed", "Edits could not be autosaved and will be retried:\n"
+                                   + "\n".join(errors))
+
+    def restore_failed(self):
+        # Called on the GUI thread, the blocks are written again at the next checkpoint
+        for label_store, blocks in self.failed:
+            label_store.dirty_blocks.update(blocks)
+        self.failed = []
@@ -169,4 +169,7 @@ glasbey_cmap_20 = ['#d21820',
 glasbey_cmap = glasbey_map_1000
 glasbey_cmap_rgb = [ImageColor.getcolor(col, "RGB") for col in glasbey_cmap]
 glasbey_cmap_rgb = np.array(glasbey_cmap_rgb, dtype = np.uint32)
+# opaque 0xAARRGGBB values, used as colour table for the label overlay
+glasbey_cmap_argb = (0xFF << 24) | (glasbey_cmap_rgb[:, 0] << 16) | (glasbey_cmap_rgb[:, 1] << 8) | glasbey_cmap_rgb[:, 2]
+glasbey_cmap_argb = glasbey_cmap_argb.astype(np.uint32)
 num_colors = len(glasbey_cmap)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import numpy as np
+
+# Voxels processed per chunk, bounds the temporaries of the streamed passes
+CONTRAST_CHUNK_VOXELS = 1 << 24
+# Integer volumes spanning up to this many grey values get an exact histogram
+MAX_EXACT_BINS = 1 << 24
+# Bins of the histogram used for float volumes and very wide integer ranges
+HISTOGRAM_BINS = 1 << 16
+# Z-planes the contrast of a lazily loaded volume is estimated from
+SAMPLE_PLANES = 64
+
+
+def iter_chunks(image, progress=None, chunk_voxels=CONTRAST_CHUNK_VOXELS):
+    # Yields (start, end) ranges along the first axis of roughly chunk_voxels each.
+    # progress, if given, is called with the fraction done after every chunk.
+    plane_voxels = max(1, int(np.prod(image.shape[1:], dtype=np.int64)))
+    step = max(1, chunk_voxels // plane_voxels)
+    for start in range(0, image.shape[0], step):
+        end = min(start + step, image.shape[0])
+        yield start, end
+        if progress is not None:
+            progress(end / image.shape[0])
+
+
+def progress_range(progress, start, end):
+    # Maps the 0-1 progress of one pass onto [start, end] of the overall progress
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + fraction * (end - start))
+
+
+def value_range(image, progress=None):
+    low, high = None, None
+    for start, end in iter_chunks(image, progress):
+        chunk = image[start:end]
+        chunk_low, chunk_high = chunk.min(), chunk.max()
+        low = chunk_low if low is None else min(low, chunk_low)
+        high = chunk_high if high is None else max(high, chunk_high)
+    return low, high
+
+
+def uses_exact_histogram(image, low, high):
+    return np.issubdtype(image.dtype, np.integer) and int(high) - int(low) < MAX_EXACT_BINS
+
+
+def histogram_offset(image, low):
+    # Unsigned volumes index the histogram and LUT directly, saving a shifted copy per chunk
+    return 0 if np.issubdtype(image.dtype, np.unsignedinteger) else int(low)
+
+
+def intensity_histogram(image, low, high, progress=None):
+    # Returns (counts, bin values), the histogram is accumulated chunk by chunk.
+    # Integer volumes get one bin per grey value, floats HISTOGRAM_BINS equal bins
+    # whose values are their left edges.
+    if uses_exact_histogram(image, low, high):
+        offset = histogram_offset(image, low)
+        n_bins = int(high) - offset + 1
+        counts = np.zeros(n_bins, dtype=np.int64)
+        for start, end in iter_chunks(image, progress):
+            chunk = image[start:end].ravel()
+            if offset != 0:
+                chunk = chunk.astype(np.int64) - offset
+            counts += np.bincount(chunk, minlength=n_bins)
+        return counts, np.arange(offset, int(high) + 1)
+    counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for start, end in iter_chunks(image, progress):
+        counts += np.histogram(image[start:end], bins=HISTOGRAM_BINS, range=(float(low), float(high)))[0]
+    return counts, np.linspace(float(low), float(high), HISTOGRAM_BINS, endpoint=False)
+
+
+def saturated_range(image, saturated=0.35, progress=None):
+    # Grey values below and above which saturated percent of the voxels lie in
+    # total, read off a cumulative histogram instead of a sorted copy.
+    low, high = value_range(image, progress_range(progress, 0, 0.5))
+    counts, values = intensity_histogram(image, low, high, progress_range(progress, 0.5, 1))
+    cumulative = np.cumsum(counts)
+    n_pixels = int(cumulative[-1])
+    saturated_pixel_count = int(n_pixels * saturated / 100.0)
+    saturated_pixel_count = min(saturated_pixel_count, n_pixels // 2 - 1)  # avoid index overflow
+    saturated_pixel_count = max(saturated_pixel_count, 0)
+    # The k-th smallest voxel lies in the first bin whose cumulative count exceeds k
+    min_val = values[np.searchsorted(cumulative, saturated_pixel_count, side="right")]
+    max_val = values[np.searchsorted(cumulative, n_pixels - 1 - saturated_pixel_count, side="right")]
+    return low, high, min_val, max_val
+
+
+def sampled_saturated_range(image, saturated=0.35, n_planes=SAMPLE_PLANES):
+    # Same as saturated_range, estimated from evenly spaced planes so a memory
+    # mapped volume is not read in full
+    if image.shape[0] > n_planes:
+        indices = np.unique(np.linspace(0, image.shape[0] - 1, n_planes).astype(np.intp))
+        image = np.stack([np.asarray(image[i]) for i in indices])
+    return saturated_range(image, saturated)
+
+
+def stretch_to_uint8(values, min_val, max_val):
+    # [min_val, max_val] mapped to 0-255, values outside are clipped
+    if max_val == min_val:
+        return np.zeros(np.shape(values), dtype=np.uint8)
+    span = np.float32(float(max_val) - float(min_val))
+    values = np.asarray(values, dtype=np.float32)
+    return (np.clip((values - np.float32(min_val)) / span, 0, 1) * 255.0).astype(np.uint8)
+
+
+def apply_contrast(image, low, high, min_val, max_val, progress=None):
+    # Stretches [min_val, max_val] to the full uint8 range. Integer volumes go
+    # through a lookup table, all volumes are processed chunk by chunk so only
+    # the uint8 output is allocated at full size.
+    output = np.empty(image.shape, dtype=np.uint8)
+    if uses_exact_histogram(image, low, high):
+        offset = histogram_offset(image, low)
+        lut = stretch_to_uint8(np.arange(offset, int(high) + 1), min_val, max_val)
+        for start, end in iter_chunks(image, progress):
+            chunk = image[start:end]
+            if offset != 0:
+                chunk = chunk.astype(np.int64) - offset
+            output[start:end] = lut[chunk]
+        return output
+    for start, end in iter_chunks(image, progress):
+        output[start:end] = stretch_to_uint8(image[start:end], min_val, max_val)
+    return output
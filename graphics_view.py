@@ -1,12 +1,75 @@
+from functools import lru_cache
+
 import numpy as np
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.QtGui import QTransform
+from PyQt5.QtCore import Qt, QRectF, pyqtSignal
+from PyQt5.QtGui import QTransform, QPen, QColor, QImage
 from PyQt5.QtWidgets import (QGraphicsScene,
+                             QGraphicsItem,
                              QGraphicsPixmapItem,
+                             QGraphicsLineItem,
+                             QGraphicsEllipseItem,
                              QGraphicsView,
                              QMessageBox)
 
-from cmaps import num_colors
+
+@lru_cache(maxsize=64)
+def brush_stencil(distance, fixed_dimension):
+    # (K, 3) x, y, z offsets of a disc of radius distance lying in the plane
+    # orthogonal to fixed_dimension, cached per radius and plane.
+    v1, v2 = np.mgrid[-distance:distance + 1, -distance:distance + 1]
+    inside = v1 ** 2 + v2 ** 2 <= distance ** 2
+    v1, v2 = v1[inside], v2[inside]
+    fixed = np.zeros_like(v1)
+    if fixed_dimension == 'X':
+        stencil = np.column_stack((fixed, v1, v2))
+    elif fixed_dimension == 'Y':
+        stencil = np.column_stack((v1, fixed, v2))
+    else:  # fixed_dimension == 'Z'
+        stencil = np.column_stack((v1, v2, fixed))
+    stencil.setflags(write=False)
+    return stencil
+
+
+def rasterize_line(start_point, end_point):
+    # (L, 3) integer positions along the segment from start_point to end_point,
+    # one per step along its longest axis so consecutive positions touch.
+    start_point = np.asarray(start_point[:3])
+    end_point = np.asarray(end_point[:3])
+    n_steps = int(np.abs(end_point - start_point).max())
+    if n_steps == 0:
+        return start_point[None, :]
+    t = np.arange(n_steps + 1)[:, None] / n_steps
+    return np.rint(start_point + t * (end_point - start_point)).astype(start_point.dtype)
+
+
+class LabelOverlayItem(QGraphicsItem):
+    # Label overlay kept as an ARGB32 buffer which the QImage shares, so a
+    # dirty rectangle is rewritten in place and only that region repainted.
+
+    def __init__(self):
+        super().__init__()
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.buffer = np.zeros((0, 0), dtype=np.uint32)
+        self.image = QImage()
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.buffer.shape[1], self.buffer.shape[0])
+
+    def paint(self, painter, option, widget=None):
+        if not self.image.isNull():
+            painter.drawImage(option.exposedRect, self.image, option.exposedRect)
+
+    def set_buffer(self, argb):
+        self.prepareGeometryChange()
+        self.buffer = np.ascontiguousarray(argb, dtype=np.uint32)
+        height, width = self.buffer.shape
+        self.image = QImage(self.buffer.data, width, height, self.buffer.strides[0], QImage.Format_ARGB32)
+        self.update()
+
+    def update_region(self, row, col, argb):
+        height, width = argb.shape
+        self.buffer[row:row + height, col:col + width] = argb
+        self.update(QRectF(col, row, width, height))
 
 
 class GraphicsView(QGraphicsView):
@@ -19,8 +82,35 @@ class GraphicsView(QGraphicsView):
         self.view_plane = view_plane
         self.scene = QGraphicsScene(self)
         self.setScene(self.scene)
+        # Grayscale image slice, label overlay and view finder are separate
+        # layers so each one can be updated or hidden on its own.
         self._pixmap_item = QGraphicsPixmapItem()
         self.scene.addItem(self._pixmap_item)
+        self._overlay_item = LabelOverlayItem()
+        self._overlay_item.setZValue(1)
+        self.scene.addItem(self._overlay_item)
+        selection_pen = QPen(QColor(255, 0, 0, 80))
+        selection_pen.setWidth(1)
+        self._selection_item = QGraphicsEllipseItem()
+        self._selection_item.setPen(selection_pen)
+        self._selection_item.setZValue(1)
+        self._selection_item.hide()
+        self.scene.addItem(self._selection_item)
+        view_finder_pen = QPen(QColor(255, 255, 0, 80))
+        view_finder_pen.setWidth(1)
+        self._view_finder_items = [QGraphicsLineItem(), QGraphicsLineItem(), QGraphicsEllipseItem()]
+        for item in self._view_finder_items:
+            item.setPen(view_finder_pen)
+            item.setZValue(2)
+            item.hide()
+            self.scene.addItem(item)
+        self.base_key = None
+        self.overlay_key = None
+        # Label store version the overlay reflects, plus the (row0, row1, col0, col1)
+        # rectangles edited since and still waiting to be repainted
+        self.overlay_version = None
+        self.dirty_rects = []
+        self.last_stroke_point = None
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         if self.view_plane == "XY":
             self.fixed_dim = "Z"
@@ -34,10 +124,51 @@ class GraphicsView(QGraphicsView):
         else:
             raise ValueError("Invalid viewplane.\
                              Choose among 'XY', 'XZ', 'YZ'")
+        # Index of the fixed dimension in (x, y, z) points
+        self.fixed_axis = "XYZ".index(self.fixed_dim)
 
     def setPixmap(self, pixmap):
         self._pixmap_item.setPixmap(pixmap)
 
+    def setOverlay(self, argb):
+        self._overlay_item.set_buffer(argb)
+
+    def update_overlay_region(self, row, col, argb):
+        self._overlay_item.update_region(row, col, argb)
+
+    def set_overlay_visible(self, visible):
+        self._overlay_item.setVisible(visible)
+        if not visible:
+            self._selection_item.hide()
+
+    def set_selection_box(self, min_box, max_box):
+        self._selection_item.setRect(min_box[0] - 2, min_box[1] - 2, max_box[0] - min_box[0] + 4,
+                                     max_box[1] - min_box[1] + 4)
+        self._selection_item.show()
+
+    def hide_selection_box(self):
+        self._selection_item.hide()
+
+    def base_size(self):
+        pixmap = self._pixmap_item.pixmap()
+        return pixmap.width(), pixmap.height()
+
+    def set_view_finder(self, x, y, width, height, circle_size=0):
+        vertical_line, horizontal_line, circle = self._view_finder_items
+        vertical_line.setLine(x, 0, x, height)
+        horizontal_line.setLine(0, y, width, y)
+        vertical_line.show()
+        horizontal_line.show()
+        if circle_size > 0:
+            circle.setRect(x - circle_size // 2, y - circle_size // 2, circle_size, circle_size)
+            circle.show()
+        else:
+            circle.hide()
+
+    def hide_view_finder(self):
+        for item in self._view_finder_items:
+            item.hide()
+
     def rotate_view(self, angle):
         self.rotate(angle)
 
@@ -104,9 +235,7 @@ class GraphicsView(QGraphicsView):
             self.main_window.sliderx.setValue(current_value + step_size)
         elif event.key() == Qt.Key_M:
             self.main_window.markers_enabled = not self.main_window.markers_enabled
-            self.main_window.update_xy_view()
-            self.main_window.update_xz_view()
-            self.main_window.update_yz_view()
+            self.main_window.request_render()
         elif event.key() == Qt.Key_E:
             self.main_window.toggleEraser()
         elif event.key() == Qt.Key_A:
@@ -187,151 +316,70 @@ class GraphicsView(QGraphicsView):
         self.centerOn(location)
 
     def generate_nearby_points(self, center_point, fixed_dimension, distance):
-        
-        x, y, z = center_point
-        dimension_ranges = {'X': (y, z), 'Y': (x, z), 'Z': (x, y)}
-        bounds = {
-            'X': (self.main_window.y_min, self.main_window.y_max, self.main_window.z_min, self.main_window.z_max),
-            'Y': (self.main_window.x_min, self.main_window.x_max, self.main_window.z_min, self.main_window.z_max),
-            'Z': (self.main_window.x_min, self.main_window.x_max, self.main_window.y_min, self.main_window.y_max),
-        }
-        points = []
-        main_index = self.main_window.index_control.cell_index
-        color_index = main_index % num_colors
-
-        def in_bounds(v, min_v, max_v):
-            return min_v <= v <= max_v
-
-        def add_point(i, j, k):
-            #if self.main_window.foreground_enabled:
-            points.append((i, j, k, main_index, color_index))
-
-        dim1, dim2 = dimension_ranges[fixed_dimension]
-        min1, max1, min2, max2 = bounds[fixed_dimension]
-
-        for v1 in range(dim1 - distance, dim1 + distance + 1):
-            for v2 in range(dim2 - distance, dim2 + distance + 1):
-                if (v1 - dim1) ** 2 + (v2 - dim2) ** 2 <= distance ** 2 and in_bounds(v1, min1, max1) and in_bounds(v2, min2, max2):
-                    if fixed_dimension == 'X':
-                        add_point(x, v1, v2)
-                    elif fixed_dimension == 'Y':
-                        add_point(v1, y, v2)
-                    else:  # fixed_dimension == 'Z'
-                        add_point(v1, v2, z)
-
-        return points
+        # Returns the (N, 3) x, y, z positions covered by a round brush of the
+        # given radius around center_point, clipped to the volume.
+        return self.generate_stroke_points(center_point, center_point, fixed_dimension, distance)
+
+    def generate_stroke_points(self, start_point, end_point, fixed_dimension, distance):
+        # Sweeps the brush along the segment between two mouse positions, so
+        # fast strokes leave no gaps and still cost a single commit.
+        stencil = brush_stencil(distance, fixed_dimension)
+        line = rasterize_line(start_point, end_point)
+        points = (line[:, None, :] + stencil[None, :, :]).reshape(-1, 3)
+        lower = (self.main_window.x_min, self.main_window.y_min, self.main_window.z_min)
+        upper = (self.main_window.x_max, self.main_window.y_max, self.main_window.z_max)
+        in_bounds = ((points >= lower) & (points <= upper)).all(axis=1)
+        return points[in_bounds]
+
+    def label_under_cursor(self, event):
+        # Label of the clicked voxel, 0 on background or without annotations
+        label_store = self.main_window.label_store
+        if label_store is None:
+            return 0
+        return label_store.label_at(self.obtain_current_point(self._pixmap_item, event, self.view_plane))
 
     def mousePressEvent(self, event):
 
         if event.button() == Qt.LeftButton:
 
             if self.main_window.delete_cell_enabled:
-                pixmap_item = self._pixmap_item
-                point = self.obtain_current_point(pixmap_item, event, self.view_plane)
-                image = pixmap_item.pixmap().toImage()
-                if self.view_plane == "XY":
-                    x = point[0]
-                    y = point[1]
-                elif self.view_plane == "XZ":
-                    x = point[0]
-                    y = point[2]
-                elif self.view_plane == "YZ":
-                    x = point[2]
-                    y = point[1]
-                color = image.pixelColor(x, y)
-                r, g, b, _ = color.getRgb()
-                if not (r == g == b):
+                cell_idx = self.label_under_cursor(event)
+                if cell_idx:
                     mbox = QMessageBox.question(self,  
                              "Delete Cell",  
                              "Are you sure you want to delete this cell?", 
                              QMessageBox.Yes | QMessageBox.No,  
                              QMessageBox.No)
                     if mbox == QMessageBox.Yes:
-                        cell_idx = None
-                        point = np.expand_dims(point, 0)
-                        if self.view_plane == "XY":
-                            z_index = self.main_window.slider.value()
-                            view_points = self.main_window.z_view_dict.get(z_index)
-                        elif self.view_plane == "XZ":
-                            y_index = self.main_window.slidery.value()
-                            view_points = self.main_window.y_view_dict.get(y_index)
-                            point = point[:, [0, 2, 1]]
-                        elif self.view_plane == "YZ":
-                            x_index = self.main_window.sliderx.value()
-                            view_points = self.main_window.x_view_dict.get(x_index)
-                            point = point[:, [2, 1, 0]]
-                        if view_points is not None:
-                            point = point[:, :2]
-                            matches = np.all(view_points[:, :2] == point, axis=1)
-                            match_indices = np.where(matches)[0]
-                            if match_indices.size > 0:
-                                found_point = view_points[match_indices]
-                                cell_idx = found_point[0][2]
-                        if cell_idx is not None:
-                            self.main_window.removeCell(cell_idx)
+                        self.main_window.removeCell(cell_idx)
                 event.accept()
                 return
 
             if not self.main_window.new_cell_selected \
                 and self.main_window.select_cell_enabled \
                 and self.main_window.markers_enabled:
-                pixmap_item = self._pixmap_item
-                point = self.obtain_current_point(pixmap_item, event, self.view_plane)
-                if point.size > 0:
-                    cell_idx = None
-                    point = np.expand_dims(point, 0)
-                    if self.view_plane == "XY":
-                        z_index = self.main_window.slider.value()
-                        view_points = self.main_window.z_view_dict.get(z_index)
-                    elif self.view_plane == "XZ":
-                        y_index = self.main_window.slidery.value()
-                        view_points = self.main_window.y_view_dict.get(y_index)
-                        point = point[:, [0, 2, 1]]
-                    elif self.view_plane == "YZ":
-                        x_index = self.main_window.sliderx.value()
-                        view_points = self.main_window.x_view_dict.get(x_index)
-                        point = point[:, [2, 1, 0]]
-                    if view_points is not None:
-                        point = point[:, :2]
-                        matches = np.all(view_points[:, :2] == point, axis=1)
-                        match_indices = np.where(matches)[0]
-                        if match_indices.size > 0:
-                            found_point = view_points[match_indices]
-                            cell_idx = found_point[0][2]
-                    else:
-                        return
-                    if cell_idx:
-                        self.main_window.new_cell_selected = True
-                        self.main_window.index_control.cell_index = cell_idx
-                        self.main_window.update_index_display()
-                        self.main_window.alpha_label_index = cell_idx
-                        self.main_window.index_control.update_index(cell_idx, 
-                                                                    self.main_window.current_highest_cell_index)
-                        self.main_window.update_xy_view()
-                        self.main_window.update_xz_view()
-                        self.main_window.update_yz_view()
+                cell_idx = self.label_under_cursor(event)
+                if cell_idx:
+                    self.main_window.new_cell_selected = True
+                    self.main_window.index_control.cell_index = cell_idx
+                    self.main_window.update_index_display()
+                    self.main_window.alpha_label_index = cell_idx
+                    self.main_window.index_control.update_index(cell_idx, 
+                                                                self.main_window.current_highest_cell_index)
+                    self.main_window.request_render()
             else:
                 self.main_window.dragging = True
                 if self.main_window.drawing and self.main_window.markers_enabled:
                     pixmap_item = self._pixmap_item
                     points = self.obtain_current_point(pixmap_item, event, self.view_plane)
+                    self.last_stroke_point = points
+                    cell_index = self.main_window.index_control.cell_index
                     if self.main_window.foreground_enabled:
-                        if self.main_window.brush_width == 1:
-                            points = points + (self.main_window.index_control.cell_index,) + (self.main_window.index_control.cell_index%num_colors,)
-                            self.main_window.add_points(points)
-                        elif self.main_window.brush_width > 1:
-                            ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.brush_width - 1)
-                            self.main_window.add_points(ppoints)
+                        ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.brush_width - 1)
+                        self.main_window.add_points(ppoints, cell_index)
                     elif self.main_window.eraser_enabled:
-                        if self.main_window.eraser_radius == 1:
-                            points = points + (self.main_window.index_control.cell_index,) + (self.main_window.index_control.cell_index%num_colors,)
-                            self.main_window.removePoints(points, self.view_plane)
-                        else:
-                            ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.eraser_radius - 1)
-                            self.main_window.removePoints(ppoints, self.view_plane)
-                    self.main_window.update_xy_view()
-                    self.main_window.update_xz_view()
-                    self.main_window.update_yz_view()
+                        ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.eraser_radius - 1)
+                        self.main_window.removePoints(ppoints, cell_index, self.view_plane)
                 else:
                     self.main_window.last_mouse_pos = event.pos()
 
@@ -339,8 +387,7 @@ class GraphicsView(QGraphicsView):
 
             if len(self.main_window.copied_points) > 0:
                 # now shift by whatever index you are at
-                origin_plane = self.main_window.copied_points[0][0]
-                points_to_copy = self.main_window.copied_points[0][1]
+                origin_plane, points_to_copy, cell_idx = self.main_window.copied_points[0]
                 self.main_window.copied_points = []
                 if origin_plane != self.view_plane:
                     return
@@ -354,70 +401,40 @@ class GraphicsView(QGraphicsView):
                 elif self.view_plane == "YZ":
                     x_index = self.main_window.sliderx.value()
                     points_to_copy[:, 0] = x_index
-                self.main_window.add_points(list(points_to_copy))
-                self.main_window.update_xy_view()
-                self.main_window.update_xz_view()
-                self.main_window.update_yz_view()
+                self.main_window.add_points(points_to_copy, cell_idx)
             else:
-                pixmap_item = self._pixmap_item
-                point = self.obtain_current_point(pixmap_item, event, self.view_plane)
-                if point.size > 0:
-                    cell_idx = None
-                    point = np.expand_dims(point, 0)
+                cell_idx = self.label_under_cursor(event)
+                if cell_idx:
+                    label_store = self.main_window.label_store
                     if self.view_plane == "XY":
-                        z_index = self.main_window.slider.value()
-                        view_points = self.main_window.z_view_dict.get(z_index)
+                        points_to_copy = label_store.points_in_slice("XY", self.main_window.slider.value(), cell_idx)
                     elif self.view_plane == "XZ":
-                        y_index = self.main_window.slidery.value()
-                        view_points = self.main_window.y_view_dict.get(y_index)
-                        point = point[:, [0, 2, 1]]
+                        points_to_copy = label_store.points_in_slice("XZ", self.main_window.slidery.value(), cell_idx)
                     elif self.view_plane == "YZ":
-                        x_index = self.main_window.sliderx.value()
-                        view_points = self.main_window.x_view_dict.get(x_index)
-                        point = point[:, [2, 1, 0]]
-                    if view_points is not None:
-                        point = point[:, :2]
-                        matches = np.all(view_points[:, :2] == point, axis=1)
-                        match_indices = np.where(matches)[0]
-                        if match_indices.size > 0:
-                            found_point = view_points[match_indices]
-                            cell_idx = found_point[0][2]
-                    else:
-                        return
-                    if cell_idx:
-                        relevant_points = self.main_window.points_per_cell.get(cell_idx)
-                        if self.view_plane == "XY":
-                            points_to_copy = relevant_points[relevant_points[:, 2]==z_index]
-                        elif self.view_plane == "XZ":
-                            points_to_copy = relevant_points[relevant_points[:, 1]==y_index]
-                        elif self.view_plane == "YZ":
-                            points_to_copy = relevant_points[relevant_points[:, 0]==x_index]
-                        if points_to_copy.size > 0:
-                            self.main_window.copied_points.append((self.view_plane, points_to_copy))
+                        points_to_copy = label_store.points_in_slice("YZ", self.main_window.sliderx.value(), cell_idx)
+                    if points_to_copy.size > 0:
+                        self.main_window.copied_points.append((self.view_plane, points_to_copy, cell_idx))
         event.accept()
 
     def mouseMoveEvent(self, event):
         if self.main_window.drawing and self.main_window.dragging and self.main_window.markers_enabled:
             pixmap_item = self._pixmap_item
             points = self.obtain_current_point(pixmap_item, event, self.view_plane)
+            start_point = self.last_stroke_point
+            # A stroke is only interpolated within one slice, once the slice
+            # changes mid-drag it continues from the cursor in the new slice
+            if start_point is None or start_point[self.fixed_axis] != points[self.fixed_axis]:
+                start_point = points
+            self.last_stroke_point = points
+            cell_index = self.main_window.index_control.cell_index
             if self.main_window.foreground_enabled:
-                if self.main_window.brush_width == 1:
-                    if points not in self.main_window.pure_coordinates:
-                        points = points + (self.main_window.index_control.cell_index,) + (self.main_window.index_control.cell_index%num_colors,)
-                        self.main_window.add_points(points)
-                elif self.main_window.brush_width > 1:
-                    ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.brush_width - 1)
-                    self.main_window.add_points(ppoints)
+                ppoints = self.generate_stroke_points(start_point, points, self.fixed_dim,
+                                                      self.main_window.brush_width - 1)
+                self.main_window.add_points(ppoints, cell_index)
             elif self.main_window.eraser_enabled:
-                if self.main_window.eraser_radius == 1:
-                    points = points + (self.main_window.index_control.cell_index,) + (self.main_window.index_control.cell_index%num_colors,)
-                    self.main_window.removePoints(points, self.view_plane)
-                else:
-                    ppoints = self.generate_nearby_points(points, self.fixed_dim, self.main_window.eraser_radius - 1)
-                    self.main_window.removePoints(ppoints, self.view_plane)
-            self.main_window.update_xy_view()
-            self.main_window.update_xz_view()
-            self.main_window.update_yz_view()
+                ppoints = self.generate_stroke_points(start_point, points, self.fixed_dim,
+                                                      self.main_window.eraser_radius - 1)
+                self.main_window.removePoints(ppoints, cell_index, self.view_plane)
         elif self.main_window.dragging:
             delta = event.pos() - self.main_window.last_mouse_pos
             self.verticalScrollBar().setValue(self.verticalScrollBar().value() - delta.y())
@@ -427,4 +444,5 @@ class GraphicsView(QGraphicsView):
 
     def mouseReleaseEvent(self, event):
         self.main_window.dragging = False
+        self.last_stroke_point = None
         event.accept()
\ No newline at end of file
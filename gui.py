@@ -1,9 +1,11 @@
-import imageio.v3 as iio
 import numpy as np
 import os
+import shutil
 import sys
-from PyQt5.QtCore import Qt, QSize, pyqtSlot
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QCursor
+import tempfile
+import time
+from PyQt5.QtCore import Qt, QSize, QTimer, pyqtSlot
+from PyQt5.QtGui import QImage, QPixmap, QColor, QCursor
 from PyQt5.QtWidgets import (QApplication,
                              QMainWindow,
                              QVBoxLayout,
@@ -17,20 +19,48 @@ from PyQt5.QtWidgets import (QApplication,
                              QSplitter,
                              QAction,
                              QTabWidget)
-from scipy.ndimage import label, find_objects
-from skimage.measure import find_contours
 
-from cmaps import glasbey_cmap, glasbey_cmap_rgb
+from autosave import AutosaveStore, AutosaveWriter, checkpoint_jobs, AUTOSAVE_INTERVAL_SECONDS
+from cmaps import glasbey_cmap_argb, num_colors
+from contrast import saturated_range, apply_contrast
 from graphics_view import GraphicsView
 from gui_widgets import *
+from label_store import create_label_store
+from mask_io import MASK_FILE_FILTER
+from render_scheduler import RenderScheduler
+from slice_cache import SliceCache, SlicePrefetcher, PREFETCH_RADIUS
+from tab_document import (TabDocument, document_property, link_source, link_documents, join_link,
+                          relink_documents, handover_link, unlink_documents, TAB_MEMORY_BUDGET_BYTES)
+from volume_layout import create_volume_layout, is_resident
 
 
 class MainWindow(QMainWindow):
     label_shift_answer = pyqtSignal(bool)
+    # Per tab state, lives on the current TabDocument
+    filename = document_property("filename")
+    image_data = document_property("image_data")
+    volume_layout = document_property("volume_layout")
+    image_min = document_property("image_min")
+    image_max = document_property("image_max")
+    min_pixel_intensity = document_property("min_pixel_intensity")
+    max_pixel_intensity = document_property("max_pixel_intensity")
+    z_max = document_property("z_max")
+    y_max = document_property("y_max")
+    x_max = document_property("x_max")
+    z_min = document_property("z_min")
+    y_min = document_property("y_min")
+    x_min = document_property("x_min")
+    xy_view = document_property("xy_view")
+    xz_view = document_property("xz_view")
+    yz_view = document_property("yz_view")
+    background_points = document_property("background_points")
+    label_store = document_property("label_store")
 
     def __init__(self, filename=None):
         super().__init__()
         self.setAcceptDrops(True)
+        # Document of the current tab, the empty one stands in until an image is loaded
+        self.document = TabDocument()
         self.image_min = 0
         self.image_max = 255
         self.min_pixel_intensity = 0
@@ -45,6 +75,15 @@ class MainWindow(QMainWindow):
         self.eraser_radius = 2
         self.num_channels = 0
         self.image_data = None
+        self.volume_layout = None
+        # "strided", "transposed" or "bricked", see volume_layout.py
+        self.volume_layout_mode = "transposed"
+        # Large .npy and uncompressed TIFF files are memory-mapped and decoded per slice
+        self.lazy_loading = True
+        # Large label volumes are imported by a process pool, see parallel_import.py
+        self.parallel_mask_import = True
+        self.image_loaders = []
+        self.mask_saver = None
         self.filename_list = []
         if filename is not None:
             self.load_image(filename)
@@ -66,12 +105,8 @@ class MainWindow(QMainWindow):
         self.xy_mouse_position = None
         self.xz_mouse_position = None
         self.yz_mouse_position = None
-        self.foreground_points = []
         self.background_points = []
-        self.z_view_dict = {}
-        self.y_view_dict = {}
-        self.x_view_dict = {}
-        self.points_per_cell = {}
+        self.label_store = None
         self.copied_points = []
         self.relevant_xy_points = {}
         self.relevant_xz_points = {}
@@ -88,11 +123,37 @@ class MainWindow(QMainWindow):
         self.current_zoom_location = None  # scene_pos - delta
         self.current_zoom_factor = 1
 
+        self.render_scheduler = RenderScheduler({"XY": self.update_xy_view,
+                                                 "XZ": self.update_xz_view,
+                                                 "YZ": self.update_yz_view}, self)
+        self.slice_cache = SliceCache()
+        self.slice_prefetcher = SlicePrefetcher(self.slice_cache, self)
+        QApplication.instance().aboutToQuit.connect(self.slice_prefetcher.stop)
+        QApplication.instance().aboutToQuit.connect(self.stop_image_loaders)
+        QApplication.instance().aboutToQuit.connect(self.wait_for_mask_saver)
+        # Edited blocks of every tab are checkpointed periodically, see autosave.py
+        self.autosave_writer = None
+        # Failures are shown once until an autosave succeeds again
+        self.autosave_failing = False
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start(AUTOSAVE_INTERVAL_SECONDS * 1000)
+        QApplication.instance().aboutToQuit.connect(self.final_autosave)
+        # Inactive tabs are spilled to disk least recently used first once all
+        # tabs together hold more than tab_memory_budget bytes
+        self.tab_memory_budget = TAB_MEMORY_BUDGET_BYTES
+        self.recent_documents = []
+        self.spill_dir = None
+        QApplication.instance().aboutToQuit.connect(self.remove_spill_dir)
+        # Linked tabs of the same shape share the label store of linked_source
+        self.link_annotations = False
+        self.linked_source = None
+
         self.tab_widget = QTabWidget()
         self.tab_widget.setTabsClosable(True)
         self.tab_widget.tabCloseRequested.connect(self.close_tab)
         self.initial_view = 0
-        self.data_per_tab = {}
+        self.documents = {}
         self.current_tab_index = 0
         self.tab_indices = []
         self.create_image_view_layout()
@@ -129,6 +190,12 @@ class MainWindow(QMainWindow):
         self.file_menu.addSeparator()  # Adds a separator line
         self.file_menu.addAction(exit_action)
 
+        self.tabs_menu = self.menu_bar.addMenu("Tabs")
+        self.link_tabs_action = QAction("Link Annotations Across Tabs", self)
+        self.link_tabs_action.setCheckable(True)
+        self.link_tabs_action.toggled.connect(self.set_linked_tabs)
+        self.tabs_menu.addAction(self.link_tabs_action)
+
         self.slider = QSlider(Qt.Horizontal)
 
         self.slider_label = QLabel("Z-Planes (1,2)")
@@ -249,18 +316,16 @@ class MainWindow(QMainWindow):
         self.progress_label = QLabel('Progress: 0%', self)
         self.progress_label.hide()
         layout.addWidget(self.progress_label)
+        self.cancel_loading_button = QPushButton('Cancel Loading', self)
+        self.cancel_loading_button.clicked.connect(self.cancel_image_loading)
+        self.cancel_loading_button.hide()
+        layout.addWidget(self.cancel_loading_button)
 
-        self.slider.valueChanged.connect(self.update_xy_view)
-        self.slider.valueChanged.connect(self.update_yz_view)
-        self.slider.valueChanged.connect(self.update_xz_view)
+        self.slider.valueChanged.connect(lambda: self.on_slice_changed("XY"))
         self.slider.valueChanged.connect(self.update_slider_text)
-        self.slidery.valueChanged.connect(self.update_xz_view)
+        self.slidery.valueChanged.connect(lambda: self.on_slice_changed("XZ"))
         self.slidery.valueChanged.connect(self.update_slidery_text)
-        self.sliderx.valueChanged.connect(self.update_yz_view)
-        self.slidery.valueChanged.connect(self.update_xy_view)
-        self.sliderx.valueChanged.connect(self.update_xy_view)
-        self.slidery.valueChanged.connect(self.update_yz_view)
-        self.sliderx.valueChanged.connect(self.update_xz_view)
+        self.sliderx.valueChanged.connect(lambda: self.on_slice_changed("YZ"))
         self.sliderx.valueChanged.connect(self.update_sliderx_text)
 
         self.side_widget = QWidget()
@@ -284,9 +349,7 @@ class MainWindow(QMainWindow):
         self.paint_color = QColor(Qt.red)
         self.paint_color.setAlphaF(0.3)
         self.markers_enabled = True
-        self.update_xz_view()
-        self.update_yz_view()
-        self.update_xy_view()
+        self.request_render()
         self.xy_painter = None
         self.xz_painter = None
         self.yz_painter = None
@@ -306,6 +369,17 @@ class MainWindow(QMainWindow):
         if self.index_control.cell_index > self.current_highest_cell_index:
             self.current_highest_cell_index = self.index_control.cell_index
 
+    def request_render(self, *view_planes):
+        # Views are rendered by the scheduler at most once per frame
+        self.render_scheduler.request(*view_planes)
+
+    def on_slice_changed(self, view_plane):
+        # The other views only change through the view finder lines
+        if self.view_finder:
+            self.request_render()
+        else:
+            self.request_render(view_plane)
+
     def slider_value_text(self, val):
         return f"Z-Planes (1,2): {val}/{self.slider.maximum()}"
 
@@ -340,7 +414,7 @@ class MainWindow(QMainWindow):
         num_tabs = self.tab_widget.count()
         previous_index = (current_index - 1) % num_tabs
         previous_tab_widget = self.tab_widget.widget(previous_index)
-        if self.data_per_tab.get(previous_tab_widget) is not None:
+        if previous_tab_widget in self.documents:
             self.current_tab_index = previous_index
             self.tab_widget.setCurrentIndex(previous_index)
             self.update_tab_view(previous_index)
@@ -353,7 +427,7 @@ class MainWindow(QMainWindow):
         num_tabs = self.tab_widget.count()
         next_index = (current_index + 1) % num_tabs
         next_tab_widget = self.tab_widget.widget(next_index)
-        if self.data_per_tab.get(next_tab_widget) is not None:
+        if next_tab_widget in self.documents:
             self.current_tab_index = next_index
             self.tab_widget.setCurrentIndex(next_index)
             self.update_tab_view(next_index)
@@ -361,7 +435,7 @@ class MainWindow(QMainWindow):
             # self.update_xz_view()
             # self.update_yz_view()
 
-    def create_image_view_layout(self, image_name="Image", image_data=None):
+    def create_image_view_layout(self, image_name="Image", image_data=None, final=True):
 
         if self.initial_view == 0: #TODO reduce redundancy
             # Create a new QWidget for the layout
@@ -477,6 +551,7 @@ class MainWindow(QMainWindow):
 
             self.tab_widget.addTab(image_view_widget, image_name)
 
+            self.document = TabDocument()
             self.xy_view = xy_view
             self.xz_view = xz_view
             self.yz_view = yz_view
@@ -503,11 +578,9 @@ class MainWindow(QMainWindow):
             self.eraser_radius = 3
             self.filename = image_name
             self.current_highest_cell_index = 0
-            self.foreground_points = []
             self.background_points = []
-            self.z_view_dict = {}
-            self.y_view_dict = {}
-            self.x_view_dict = {}
+            self.volume_layout = self.create_layout(image_data, final)
+            self.label_store = create_label_store(image_data.shape)
             self.copied_points = []
 
             # layout.addWidget(xy_view, stretch=1)
@@ -518,35 +591,7 @@ class MainWindow(QMainWindow):
             # self.tab_widget.insertTab(0, image_view_widget, image_name)
             self.tab_widget.setCurrentWidget(image_view_widget)
             current_tab = self.tab_widget.currentWidget()
-            if current_tab not in self.data_per_tab:
-                self.data_per_tab[current_tab] = {}
-            self.data_per_tab[current_tab] = { #TODO put into tab data class
-                "xy_view": xy_view,
-                "xz_view": xz_view,
-                "yz_view": yz_view,
-                "image_min": self.image_min,
-                "image_max": self.image_max,
-                "z_max": self.z_max,
-                "y_max": self.y_max,
-                "x_max": self.x_max,
-                "z_min": self.z_min,
-                "y_min": self.y_min,
-                "x_min": self.x_min,
-                "min_pixel_intensity": self.min_pixel_intensity,
-                "max_pixel_intensity": self.max_pixel_intensity,
-                "image_data": self.image_data,
-                "brush_width": self.brush_width,
-                "eraser_radius": self.eraser_radius,
-                "filename": self.filename,
-                "current_highest_cell_index": self.current_highest_cell_index,
-                "foreground_points": self.foreground_points.copy(),
-                "background_points": self.background_points.copy(),
-                "z_view_dict": {k: v.copy() for k, v in self.z_view_dict.items()},  # self.z_view_dict.copy(),
-                "y_view_dict": {k: v.copy() for k, v in self.y_view_dict.items()},  # self.y_view_dict.copy(),
-                "x_view_dict": {k: v.copy() for k, v in self.x_view_dict.items()},  # self.x_view_dict.copy(),
-                "copied_points": self.copied_points.copy(),
-                "points_per_cell": {k: v.copy() for k, v in self.points_per_cell.items()}
-            }
+            self.documents[current_tab] = self.document
             self.initial_view += 1
         else:
             # Create a new QWidget for the layout
@@ -599,6 +644,7 @@ class MainWindow(QMainWindow):
 
             # Add the widget to the tab widget
             # self.tab_widget.addTab(image_view_widget, image_name)
+            self.document = TabDocument()
             self.image_min = image_data.min()
             self.image_max = image_data.max()
             self.z_max = image_data.shape[0] - 1
@@ -617,11 +663,9 @@ class MainWindow(QMainWindow):
             self.yz_view = yz_view
             self.filename = image_name
             self.current_highest_cell_index = 0
-            self.foreground_points = []
             self.background_points = []
-            self.z_view_dict = {}
-            self.y_view_dict = {}
-            self.x_view_dict = {}
+            self.volume_layout = self.create_layout(image_data, final)
+            self.label_store = create_label_store(image_data.shape)
             self.copied_points = []
 
             # layout.addWidget(xy_view, stretch=1)
@@ -631,46 +675,16 @@ class MainWindow(QMainWindow):
             self.tab_widget.addTab(image_view_widget, image_name)
             self.tab_widget.setCurrentWidget(image_view_widget)
             current_tab = self.tab_widget.currentWidget()
-            if current_tab not in self.data_per_tab:
-                self.data_per_tab[current_tab] = {}
-            self.data_per_tab[current_tab] = {
-                "xy_view": xy_view,
-                "xz_view": xz_view,
-                "yz_view": yz_view,
-                "image_min": self.image_min,
-                "image_max": self.image_max,
-                "z_max": self.z_max,
-                "y_max": self.y_max,
-                "x_max": self.x_max,
-                "z_min": self.z_min,
-                "y_min": self.y_min,
-                "x_min": self.x_min,
-                "min_pixel_intensity": self.min_pixel_intensity,
-                "max_pixel_intensity": self.max_pixel_intensity,
-                "image_data": self.image_data,
-                "brush_width": self.brush_width,
-                "eraser_radius": self.eraser_radius,
-                "filename": self.filename,
-                "current_highest_cell_index": self.current_highest_cell_index,
-                "foreground_points": self.foreground_points.copy(),
-                "background_points": self.background_points.copy(),
-                "z_view_dict": {k: v.copy() for k, v in self.z_view_dict.items()},  # self.z_view_dict.copy(),
-                "y_view_dict": {k: v.copy() for k, v in self.y_view_dict.items()},  # self.y_view_dict.copy(),
-                "x_view_dict": {k: v.copy() for k, v in self.x_view_dict.items()},  # self.x_view_dict.copy(),
-                "copied_points": self.copied_points.copy(),
-                "points_per_cell": {k: v.copy() for k, v in self.points_per_cell.items()}
-            }
+            self.documents[current_tab] = self.document
             self.tab_widget.setCurrentWidget(image_view_widget)
 
     def on_tab_changed(self, index):
         self.current_tab_index = index
         current_tab = self.tab_widget.currentWidget()
         self.alpha_label_index = None
-        if self.data_per_tab.get(current_tab) is not None:
+        if current_tab in self.documents:
             self.update_tab_view(index)
-            self.update_xy_view()
-            self.update_xz_view()
-            self.update_yz_view()
+            self.request_render()
             if self.most_recent_focus == "XY":
                 self.xy_view.setFocus()
             elif self.most_recent_focus == "XZ":
@@ -683,7 +697,25 @@ class MainWindow(QMainWindow):
     def close_tab(self, index):
         num_tabs = self.tab_widget.count()
         if num_tabs > 1:
-            del self.data_per_tab[self.tab_widget.widget(index)]
+            for loader in self.image_loaders:
+                if loader.tab is self.tab_widget.widget(index):
+                    loader.cancel()
+            document = self.documents.pop(self.tab_widget.widget(index))
+            self.close_autosave(document)
+            if document in self.recent_documents:
+                self.recent_documents.remove(document)
+            if document is self.linked_source:
+                self.linked_source = handover_link(document, list(self.documents.values()))
+            labels_shared = any(other.label_store is document.label_store for other in self.documents.values())
+            document.remove_spill_files(keep_image=any(other.image_spill == document.image_spill
+                                                       for other in self.documents.values()),
+                                        keep_labels=labels_shared)
+            # Tabs of the same file share the volume and its cached slices
+            if not any(other.volume_layout is document.volume_layout for other in self.documents.values()):
+                self.slice_cache.drop_source(document.volume_layout)
+            # Linked tabs share the labels and the overlays rendered from them
+            if not labels_shared:
+                self.slice_cache.drop_source(document.label_store)
             self.tab_widget.removeTab(index)
 
     def synch_transform(self):
@@ -704,35 +736,82 @@ class MainWindow(QMainWindow):
                 self.yz_view.apply_transform(self.yz_transform, self.yz_mouse_position)
 
     def update_tab_view(self, index):
-        current_tab = self.tab_widget.currentWidget()
-        self.image_min = self.data_per_tab[current_tab].get("image_min")
-        self.image_max = self.data_per_tab[current_tab].get("image_max")
-        self.z_max = self.data_per_tab[current_tab].get("z_max")
-        self.y_max = self.data_per_tab[current_tab].get("y_max")
-        self.x_max = self.data_per_tab[current_tab].get("x_max")
-        self.z_min = self.data_per_tab[current_tab].get("z_min")
-        self.y_min = self.data_per_tab[current_tab].get("y_min")
-        self.x_min = self.data_per_tab[current_tab].get("x_min")
-        self.min_pixel_intensity = self.data_per_tab[current_tab].get("min_pixel_intensity")
-        self.max_pixel_intensity = self.data_per_tab[current_tab].get("max_pixel_intensity")
-        self.image_data = self.data_per_tab[current_tab].get("image_data")
-        self.brush_width = self.data_per_tab[current_tab].get("brush_width")
-        self.eraser_radius = self.data_per_tab[current_tab].get("eraser_radius")
-        self.num_channels = self.data_per_tab[current_tab].get("num_channels")
-        self.xy_view = self.data_per_tab[current_tab].get("xy_view")
-        self.xz_view = self.data_per_tab[current_tab].get("xz_view")
-        self.yz_view = self.data_per_tab[current_tab].get("yz_view")
-        self.filename = self.data_per_tab[current_tab].get("filename")
-        self.current_highest_cell_current_tab = self.data_per_tab[current_tab].get("current_highest_cell_current_tab")
-        self.foreground_points = self.data_per_tab[current_tab].get("foreground_points")
-        self.background_points = self.data_per_tab[current_tab].get("background_points")
-        self.z_view_dict = self.data_per_tab[current_tab].get("z_view_dict")
-        self.y_view_dict = self.data_per_tab[current_tab].get("y_view_dict")
-        self.x_view_dict = self.data_per_tab[current_tab].get("x_view_dict")
-        self.points_per_cell = self.data_per_tab[current_tab].get("points_per_cell")
+        # The per tab attributes all read from the current document
+        self.document = self.documents[self.tab_widget.currentWidget()]
+        self.restore_document(self.document)
+        if self.document in self.recent_documents:
+            self.recent_documents.remove(self.document)
+        self.recent_documents.append(self.document)
+        self.enforce_tab_memory_budget()
         self.copied_points = []
         self.synch_transform()
 
+    def enforce_tab_memory_budget(self):
+        counted = set()
+        total = sum(document.resident_bytes(counted) for document in self.documents.values())
+        loading = [loader.tab for loader in self.image_loaders]
+        never_viewed = [document for document in self.documents.values() if document not in self.recent_documents]
+        for document in never_viewed + self.recent_documents:
+            if total <= self.tab_memory_budget:
+                break
+            tab = next((tab for tab, other in self.documents.items() if other is document), None)
+            if document is self.document or tab is None or tab in loading:
+                continue
+            before = document.resident_bytes(set())
+            self.spill_document(document)
+            total -= before - document.resident_bytes(set())
+
+    def spill_document(self, document):
+        # The reordered copies of the volume layout are dropped, they are
+        # rebuilt once the tab is viewed again. Whatever the current tab
+        # shares stays in memory.
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="cell_gui_spill_")
+        image_data = document.image_data
+        spill_image = image_data is not self.image_data
+        document.spill(self.spill_dir, spill_image, spill_labels=document.label_store is not self.label_store)
+        if spill_image:
+            self.slice_cache.drop_source(document.volume_layout)
+            document.volume_layout = self.create_layout(document.image_data)
+            self.share_with_tabs(document, image_data)
+
+    def restore_document(self, document):
+        image_data = document.image_data
+        if document.restore():
+            document.volume_layout = self.create_layout(document.image_data)
+            self.share_with_tabs(document, image_data)
+
+    def set_linked_tabs(self, linked):
+        # Links the tabs shaped like the current one, see tab_document.link_documents
+        documents = list(self.documents.values())
+        if linked:
+            source = link_source(self.document, documents)
+            if source is None:
+                QMessageBox.about(self, "Link Annotations",
+                                  "More than one tab of this shape has annotations. Close all of them but one "
+                                  "or clear their annotations to link the tabs.")
+                self.link_tabs_action.blockSignals(True)
+                self.link_tabs_action.setChecked(False)
+                self.link_tabs_action.blockSignals(False)
+                return
+            link_documents(source, documents)
+            self.linked_source = source
+        elif self.linked_source is not None:
+            unlink_documents(self.linked_source, documents)
+            self.linked_source = None
+        self.link_annotations = linked
+        self.request_render()
+
+    def share_with_tabs(self, document, image_data):
+        # Tabs sharing the image the document had before follow it
+        for other in self.documents.values():
+            if other is not document and other.image_data is image_data:
+                other.share_image(document)
+
+    def remove_spill_dir(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
     # def numpyArrayToPixmap(self, img_np):
     #     img_np = np.require(img_np, np.uint8, 'C')
     #     if img_np.ndim == 3 and img_np.shape[2] == 3:
@@ -745,6 +824,10 @@ class MainWindow(QMainWindow):
     #     return pixmap
 
     def numpyArrayToPixmap(self, arr: np.ndarray) -> QPixmap:
+        return QPixmap.fromImage(self.numpyArrayToImage(arr))
+
+    def numpyArrayToImage(self, arr: np.ndarray) -> QImage:
+        # The returned image owns its pixels, in a format QPixmap takes without conversion
         arr = np.require(arr, np.uint8, 'C')
         if arr.ndim == 3:
             h, w, c = arr.shape
@@ -754,47 +837,24 @@ class MainWindow(QMainWindow):
                 fmt = QImage.Format_RGB888
             else:
                 raise ValueError("Unsupported number of channels")
-
             image = QImage(arr.data, w, h, arr.strides[0], fmt)
-            return QPixmap.fromImage(image)
         else:
-            if arr.ndim == 3 and arr.shape[2] == 3:
-                qim = QImage(arr.data, arr.shape[1], arr.shape[0], arr.strides[0], QImage.Format_RGB888)
-            else:
-                qim = QImage(arr.data, arr.shape[1],
-                             arr.shape[0], arr.strides[0],
-                             QImage.Format_Indexed8)
-            pixmap = QPixmap.fromImage(qim)
-            return pixmap
+            image = QImage(arr.data, arr.shape[1],
+                           arr.shape[0], arr.strides[0],
+                           QImage.Format_Indexed8)
+        if image.hasAlphaChannel():
+            return image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        return image.convertToFormat(QImage.Format_RGB32)
 
     def imagej_auto_contrast(self, image, saturated=0.35): #TODO make perc explicit
-        image = image.astype(np.float32)
-        flat = image.flatten()
-        n_pixels = len(flat)
-        saturated_pixel_count = int(n_pixels * saturated / 100.0)
-        saturated_pixel_count = min(saturated_pixel_count, n_pixels // 2 - 1)  # avoid index overflow
-        sorted_pixels = np.sort(flat)
-        # Handle very small saturation count
-        if saturated_pixel_count == 0:
-            min_val = sorted_pixels[0]
-            max_val = sorted_pixels[-1]
-        else:
-            min_val = sorted_pixels[saturated_pixel_count]
-            max_val = sorted_pixels[-saturated_pixel_count - 1]
-        # Prevent division by zero
-        if max_val == min_val:
-            return np.clip(image, 0, 1)
-            # Stretch contrast
-        stretched = (image - min_val) / (max_val - min_val)
-        stretched = np.clip(stretched, 0, 1)
-
-        return stretched
+        # Percentiles come from a streamed histogram and the stretch is applied
+        # chunk by chunk, so no float copy or sorted copy of the volume is made
+        low, high, min_val, max_val = saturated_range(image, saturated)
+        return apply_contrast(image, low, high, min_val, max_val)
 
     def load_image(self, filename):
         # Load image data
-        self.filename = filename
         try:
-            ext = os.path.splitext(filename)[1].lower()
             mbox = QMessageBox(self)
             mbox.setWindowTitle('Mask Or Image?')
             mbox.setText("Do you want to load a mask or an image?")
@@ -809,43 +869,71 @@ class MainWindow(QMainWindow):
                     QMessageBox.critical(self, "Error", "Failed to load mask as no image present:")
                     return None
             elif mbox.clickedButton() == load_image_btn:
-                if ext == '.npy':
-                    image_data = np.load(filename)
-                else:
-                    image_data = iio.imread(filename)
+                self.start_image_loader(filename)
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to load file:\n{e}")
             return None
 
+    def start_image_loader(self, filename):
+        # A file that is already open is not decoded again, the new tab shares its image
+        source = self.loaded_document(filename)
+        if source is not None:
+            self.open_image_tab(filename, source.image_data, source)
+            return
+        # Decoding and contrast run in an ImageLoader thread, the open tabs stay usable meanwhile
+        loader = ImageLoader(filename, self.lazy_loading, self)
+        loader.progress.connect(self.handle_progress)
+        loader.error_signal.connect(self.show_load_error)
+        loader.volume_ready.connect(lambda volume, final: self.on_image_volume_ready(loader, volume, final))
+        loader.finished.connect(lambda: self.on_image_loader_finished(loader))
+        self.image_loaders.append(loader)
+        self.cancel_loading_button.show()
+        loader.start()
+
+    def cancel_image_loading(self):
+        for loader in self.image_loaders:
+            loader.cancel()
+
+    def stop_image_loaders(self):
+        self.cancel_image_loading()
+        for loader in self.image_loaders:
+            loader.wait()
+
+    @pyqtSlot(str, str)
+    def show_load_error(self, title, message):
+        QMessageBox.warning(self, title, message)
+
+    def on_image_loader_finished(self, loader):
+        if loader in self.image_loaders:
+            self.image_loaders.remove(loader)
+        if len(self.image_loaders) == 0:
+            self.cancel_loading_button.hide()
+            self.handle_finished()
+
+    def on_image_volume_ready(self, loader, image_data, final):
+        if loader.cancelled:
+            return
+        if loader.tab is not None:
+            # The finished uint8 volume replaces the one stretched per slice
+            self.replace_tab_volume(loader.tab, image_data)
+            return
         shape = image_data.shape
         if self.initial_view > 1:
             previous_tab = self.tab_widget.widget(0)
-            current_shape = self.data_per_tab[previous_tab]["image_data"].shape
+            current_shape = self.documents[previous_tab].image_data.shape
             if shape != current_shape:
+                loader.cancel()
                 QMessageBox.warning(self, "Invalid Image",
                                     "Image dimensions do not match the current image." \
                                     "This GUI is made to load images of the same shape" \
                                     " concurrently")
                 return None
+        loader.tab = self.open_image_tab(loader.filename, image_data, final=final)
 
-        if len(shape) == 3:
-            if shape[-1] in [3, 4] and np.issubdtype(image_data.dtype, np.integer):
-                QMessageBox.warning(self, "Invalid Image",
-                                    "The image appears to be a 2D color image, but a greyscale 3D volume is required.")
-                return None
-        elif len(shape) == 4:
-            # Shape might be (T, Z, Y, X) or (Z, Y, X, C)
-            if shape[-1] in [3, 4] and np.issubdtype(image_data.dtype, np.integer):
-                QMessageBox.warning(self, "Invalid Image",
-                                    "The image appears to be a 3D color stack, but a single-channel 3D volume is required.")
-                return None
-        elif len(shape) < 3:
-            QMessageBox.warning(self, "Invalid Image",
-                                "Image must be at least 3D.")
-            return None
-        image_data = self.imagej_auto_contrast(image_data)
-        image_data = (image_data - image_data.min()) / (image_data.max() - image_data.min())
-        image_data = (image_data * 255.0).astype(np.uint8)
+    def open_image_tab(self, filename, image_data, source=None, final=True):
+        # Adds a tab showing image_data and returns it. With source, an open
+        # document of the same file, the new tab shares its image. final is
+        # False for a volume the image loader replaces once it is done.
         self.filename_list.append(filename)
 
         # Update sliders with new image dimensions
@@ -862,16 +950,29 @@ class MainWindow(QMainWindow):
 
         # Create a new tab with the image layout
         image_name = filename.split('/')[-1]  # Use the filename as the tab name
-        self.create_image_view_layout(image_name, image_data)
+        self.create_image_view_layout(image_name, image_data, final)
+        tab = self.tab_widget.currentWidget()
+        self.document.path = filename
 
         # Update image parameters and views
         self.image_min = 0
         self.image_max = 255
-        self.min_pixel_intensity = np.min(self.image_data)
-        self.max_pixel_intensity = np.max(self.image_data)
-        self.update_xy_view()
-        self.update_yz_view()
-        self.update_xz_view()
+        self.min_pixel_intensity = self.image_data.min()
+        self.max_pixel_intensity = self.image_data.max()
+        if source is not None:
+            self.document.share_image(source)
+            self.restore_document(self.document)
+        self.attach_autosave(tab, filename)
+        if self.link_annotations:
+            # A new tab joins the linked tabs unless it resumed annotations of its own
+            if self.linked_source is None:
+                self.linked_source = self.document
+                link_documents(self.document, [self.document])
+            elif len(self.label_store.label_counts) == 0 \
+                    and self.linked_source.label_store.shape == self.label_store.shape:
+                join_link(self.linked_source, self.document)
+        self.enforce_tab_memory_budget()
+        self.request_render()
 
         self.tab_widget.setCurrentIndex(self.tab_widget.count() - 1)
         self.synch_transform()
@@ -883,6 +984,112 @@ class MainWindow(QMainWindow):
             self.yz_view.setFocus()
         else:
             self.xy_view.setFocus()
+        return tab
+
+    def loaded_document(self, filename):
+        # Open document of filename whose image is fully loaded, None if there is none
+        loading = [loader.tab for loader in self.image_loaders]
+        for tab, document in self.documents.items():
+            if document.path is not None and os.path.abspath(document.path) == os.path.abspath(filename) \
+                    and tab not in loading:
+                return document
+        return None
+
+    def attach_autosave(self, tab, filename):
+        # Offers to resume from an autosave of the image left by a crash or an
+        # unsaved session, otherwise starts a fresh one
+        document = self.documents[tab]
+        # Further tabs of the same file keep separate autosaves
+        copies = sum(other.path == document.path for other in self.documents.values() if other is not document)
+        autosave = AutosaveStore(filename if copies == 0 else "%s#%d" % (filename, copies + 1))
+        label_store = document.label_store
+        if autosave.can_resume(label_store.shape):
+            saved_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(autosave.manifest["time"]))
+            answer = QMessageBox.question(self, "Resume Annotations",
+                                          f"Unsaved annotations of {os.path.basename(filename)} were autosaved "
+                                          f"at {saved_at}. Do you want to resume from them?",
+                                          QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if answer == QMessageBox.Yes:
+                autosave.load_into(label_store)
+                autosave.track(label_store)
+                if label_store.max_label() > self.index_control.cell_index:
+                    self.index_control.cell_index = label_store.max_label()
+                self.update_index_display()
+                self.request_render()
+                document.autosave = autosave
+                return
+        autosave.clear()
+        autosave.track(label_store)
+        autosave.saved = (id(label_store), label_store.version)
+        document.autosave = autosave
+
+    def autosave(self, wait=False):
+        # Blocks are copied here on the GUI thread, compressing and writing
+        # them happens in an AutosaveWriter
+        if self.autosave_writer is not None and self.autosave_writer.isRunning():
+            return
+        # Linked tabs checkpoint their own annotations, the shared ones are the source's own
+        jobs = checkpoint_jobs([(document.autosave, document.own_store()) for document in self.documents.values()
+                                if document.autosave is not None and document.own_store() is not None])
+        if len(jobs) == 0:
+            return
+        writer = AutosaveWriter(jobs, self)
+        writer.error_signal.connect(self.show_autosave_error)
+        writer.finished.connect(lambda: self.on_autosave_finished(writer))
+        self.autosave_writer = writer
+        writer.start()
+        if wait:
+            writer.wait()
+
+    @pyqtSlot(str, str)
+    def show_autosave_error(self, title, message):
+        if not self.autosave_failing:
+            self.show_load_error(title, message)
+
+    def on_autosave_finished(self, writer):
+        self.autosave_failing = len(writer.failed) > 0
+        writer.restore_failed()
+
+    def final_autosave(self):
+        for document in self.documents.values():
+            self.close_autosave(document)
+
+    def close_autosave(self, document):
+        # The autosave of annotations saved to a file is removed, unsaved ones
+        # get a last checkpoint so they can be resumed next time
+        autosave, label_store = document.autosave, document.own_store()
+        if autosave is None or label_store is None:
+            return
+        if self.autosave_writer is not None:
+            self.autosave_writer.wait()
+        if autosave.is_unsaved(label_store):
+            writer = AutosaveWriter(checkpoint_jobs([(autosave, label_store)]))
+            writer.error_signal.connect(self.show_load_error)
+            writer.run()
+            writer.restore_failed()
+        else:
+            autosave.clear()
+        document.autosave = None
+
+    def create_layout(self, image_data, final=True):
+        # A volume that is replaced once loading finishes is sliced strided,
+        # reordered copies are only built for the final volume. So is one that
+        # is not held in memory, a lazily loaded or spilled volume only ever
+        # reads the planes that are shown.
+        final = final and is_resident(image_data)
+        return create_volume_layout(image_data, self.volume_layout_mode if final else "strided")
+
+    def replace_tab_volume(self, tab, image_data):
+        if tab not in self.documents:
+            return
+        document = self.documents[tab]
+        self.slice_cache.drop_source(document.volume_layout)
+        document.image_data = image_data
+        document.image_spill = None
+        document.volume_layout = self.create_layout(image_data)
+        if tab is self.tab_widget.currentWidget():
+            self.request_render()
+        self.enforce_tab_memory_budget()
 
     def open_file(self):
         options = QFileDialog.Options()
@@ -900,7 +1107,7 @@ class MainWindow(QMainWindow):
     def open_mask(self):
         if self.image_data is not None:
             options = QFileDialog.Options()
-            file_name, _ = QFileDialog.getOpenFileName(self, "Load Mask", "", "Numpy Files (*.npy)", options=options)
+            file_name, _ = QFileDialog.getOpenFileName(self, "Load Mask", "", MASK_FILE_FILTER, options=options)
             if not file_name:
                 return
             self.load_masks(file_name)
@@ -908,27 +1115,44 @@ class MainWindow(QMainWindow):
             QMessageBox.information(self, "No Image Found", "Please load an image first!")
 
     def save_file(self):
-        mask = np.zeros_like(self.image_data, dtype=np.int32)
+        if self.label_store is None:
+            return
         filename, _ = QFileDialog.getSaveFileName(self, 'Save File')
         if not filename:
             return
-        while not (filename.endswith(".npy") or filename.endswith(".tif") or filename.endswith(".tiff")):
-            QMessageBox.warning(self, "Invalid File Name", "File name should end with .npy, .tif, or .tiff.")
+        while not filename.endswith((".npz", ".npy", ".tif", ".tiff")):
+            QMessageBox.warning(self, "Invalid File Name",
+                                "File name should end with .npz (compact), .npy, .tif, or .tiff.")
             filename, _ = QFileDialog.getSaveFileName(self, 'Save File')
             if not filename:
                 return
-        z_dimension = mask.shape[0]
-        for i in range(z_dimension):
-            xy_points = self.z_view_dict.get(i)
-            if xy_points is None:
-                continue
-            xy_coors = xy_points[:, :2]
-            mask[i, xy_coors[:, 1], xy_coors[:, 0]] = xy_points[:, 2]
+        self.start_mask_saver(filename)
 
-        if filename.endswith(".npy"):
-            np.save(filename, mask)
-        elif filename.endswith(".tif") or filename.endswith(".tiff"):
-            iio.imwrite(filename, mask)
+    def start_mask_saver(self, filename):
+        # Saving runs in a MaskSaver thread, so Ctrl+S never blocks the GUI
+        if self.mask_saver is not None and self.mask_saver.isRunning():
+            QMessageBox.information(self, "Saving", "The previous save is still running.")
+            return
+        saver = MaskSaver(self.label_store, filename, self)
+        saver.progress.connect(self.handle_progress)
+        saver.error_signal.connect(self.show_load_error)
+        saver.finished.connect(lambda: self.on_mask_saver_finished(saver))
+        self.mask_saver = saver
+        saver.start()
+
+    def on_mask_saver_finished(self, saver):
+        self.handle_finished()
+        if saver.edited and not saver.failed:
+            QMessageBox.information(self, "Saved",
+                                    "The annotations were edited while saving, save again to include every edit.")
+        elif not saver.failed:
+            for document in self.documents.values():
+                if document.own_store() is saver.label_store and document.autosave is not None:
+                    document.autosave.saved = (id(saver.label_store), saver.version)
+
+    def wait_for_mask_saver(self):
+        if self.mask_saver is not None:
+            self.mask_saver.wait()
 
     def on_selection_change(self, index):
         print(f"Active Index: {index}, Item: {self.combo_box.currentText()}")
@@ -945,9 +1169,7 @@ class MainWindow(QMainWindow):
         else:
             self.view_finder_button.setText("View Finder On (V)")
         self.view_finder = not self.view_finder
-        self.update_xy_view()
-        self.update_xz_view()
-        self.update_yz_view()
+        self.request_render()
 
     def select_cell(self):
         self.select_cell_enabled = not self.select_cell_enabled
@@ -960,9 +1182,7 @@ class MainWindow(QMainWindow):
             self.new_cell_selected = False
             # self.index_control.cell_index = self.current_highest_cell_index
             self.update_index_display()
-            self.update_xy_view()
-            self.update_xz_view()
-            self.update_yz_view()
+            self.request_render()
             self.index_control.update_index(self.index_control.cell_index, self.current_highest_cell_index)
         self.repaint()
 
@@ -984,8 +1204,8 @@ class MainWindow(QMainWindow):
         self.progress_label.setVisible(False)
 
     def update_index_display(self):
-        if len(self.points_per_cell) > 0:
-            self.current_highest_cell_index = max(self.points_per_cell.keys())
+        if self.label_store is not None and len(self.label_store.label_counts) > 0:
+            self.current_highest_cell_index = self.label_store.max_label()
         self.cell_idx_display.update_text(self.index_control.cell_index, self.current_highest_cell_index)
 
     def toggleForeground(self):
@@ -1073,246 +1293,24 @@ class MainWindow(QMainWindow):
         finally:
             self.eraser_radius_text.clearFocus()
 
-    def remove_indices(self, indices):
-        self.foreground_points = [p for i, p in enumerate(self.foreground_points) if i not in indices]
-        self.update_xy_view()
-        self.update_xz_view()
-        self.update_yz_view()
-
-    def remove_pts_slice_view_dicts(self,
-                                    temp_z_view_removal_dict,
-                                    temp_y_view_removal_dict,
-                                    temp_x_view_removal_dict):
-
-        for k, v in temp_z_view_removal_dict.items(): #TODO consolidate
-            np_z_pts = self.z_view_dict.get(k)
-            if np_z_pts is not None:
-                coors_present = np_z_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = np.isin(coors_rows, v_rows)
-                indices_to_remove = np.argwhere(occupied_mask).flatten()
-                if indices_to_remove.size == 0:
-                    continue
-                self.z_view_dict[k] = np.delete(np_z_pts, indices_to_remove, axis=0)
-        for k, v in temp_y_view_removal_dict.items():
-            np_y_pts = self.y_view_dict.get(k)
-            if np_y_pts is not None:
-                coors_present = np_y_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = np.isin(coors_rows, v_rows)
-                indices_to_remove = np.argwhere(occupied_mask).flatten()
-                if indices_to_remove.size == 0:
-                    continue
-                self.y_view_dict[k] = np.delete(np_y_pts, indices_to_remove, axis=0)
-        for k, v in temp_x_view_removal_dict.items():
-            np_x_pts = self.x_view_dict.get(k)
-            if np_x_pts is not None:
-                coors_present = np_x_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = np.isin(coors_rows, v_rows)
-                indices_to_remove = np.argwhere(occupied_mask).flatten()
-                if indices_to_remove.size == 0:
-                    continue
-                self.x_view_dict[k] = np.delete(np_x_pts, indices_to_remove, axis=0)
-
     def removeCell(self, cell_idx):
-        # cell_points structure:
-        # x, y, z, target_label, cell_id
-        cell_points = self.points_per_cell.get(cell_idx)
-        if cell_points is None:
+        # The corners of its bounding box cover everything the removal changes
+        bounding_box = self.label_store.stats.bounding_box(cell_idx)
+        if bounding_box is None:
             return
-        temp_z_view_removal_dict = {}
-        temp_y_view_removal_dict = {}
-        temp_x_view_removal_dict = {}
-        for p in cell_points:
-            if p[2] not in temp_z_view_removal_dict:
-                temp_z_view_removal_dict[p[2]] = []
-            if p[1] not in temp_y_view_removal_dict:
-                temp_y_view_removal_dict[p[1]] = []
-            if p[0] not in temp_x_view_removal_dict:
-                temp_x_view_removal_dict[p[0]] = []
-            temp_z_view_removal_dict[p[2]].append((p[0], p[1], p[3], p[4]))
-            temp_y_view_removal_dict[p[1]].append((p[2], p[0], p[3], p[4]))
-            temp_x_view_removal_dict[p[0]].append((p[2], p[1], p[3], p[4]))
-        temp_z_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_z_view_removal_dict.items()}
-        temp_y_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_y_view_removal_dict.items()}
-        temp_x_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_x_view_removal_dict.items()}
-        self.remove_pts_slice_view_dicts(temp_z_view_removal_dict, temp_y_view_removal_dict, temp_x_view_removal_dict)
-        self.points_per_cell.pop(cell_idx)
-        self.update_xy_view()
-        self.update_xz_view()
-        self.update_yz_view()
-
-    def removePoints(self, point, view_plane): #TODO points, have single points get passed in as [point]
-        if self.eraser_enabled and self.markers_enabled:
-            # Determine the coordinate indices based on the view plane
-            if view_plane == "XY": #TODO roll xy, yx, zy into one?
-                # Handle both single point and list of points
-                if not isinstance(point, list) or len(point) == 5:
-                    # Single point case
-                    points_array = np.array([point])
-                    z_plane_array = self.z_view_dict.get(point[2])
-                else:
-                    # Multiple points case
-                    points_array = np.array(point)
-                    z_plane_array = self.z_view_dict.get(points_array[0, 2])
-
-                if z_plane_array is None:
-                    return
-
-                # Extract coordinates and target label (assuming all points have same target_label)
-                eraser_x = points_array[:, 0]
-                eraser_y = points_array[:, 1]
-                target_label = points_array[0, 3]  # All points should have same target_label
-
-                # Extract coordinates and labels from z_plane_array
-                points_x = z_plane_array[:, 0]
-                points_y = z_plane_array[:, 1]
-                points_labels = z_plane_array[:, 3]
-
-                # Vectorized conditions - check if any eraser point is within radius
-                label_match = points_labels == target_label
-
-                points_x_match = np.isin(points_x, eraser_x)
-                points_y_match = np.isin(points_y, eraser_y)
-                mask = label_match & points_x_match & points_y_match
-
-                # Build points_to_remove as numpy array using vectorized indexing
-                if np.any(mask):
-                    selected_points = z_plane_array[mask]
-                    # For multiple eraser points, we use the first point's index (point[2]) 
-                    # as they should all have the same z-coordinate/index
-                    point_z_index = points_array[0, 2]
-                    points_to_remove = np.column_stack([
-                        selected_points[:, 0],  # p[0] - x coordinate
-                        selected_points[:, 1],  # p[1] - y coordinate
-                        np.full(len(selected_points), point_z_index),  # point[2] - z index
-                        selected_points[:, 2],  # p[2] - label
-                        selected_points[:, 3]  # p[3] - color index
-                    ])
-                else:
-                    points_to_remove = []
-            elif view_plane == "XZ":
-                # Handle both single point and list of points
-                if not isinstance(point, list) or len(point) == 5:
-                    # Single point case
-                    points_array = np.array([point])
-                    y_plane_array = self.y_view_dict.get(point[1])
-                else:
-                    # Multiple points case
-                    points_array = np.array(point)
-                    y_plane_array = self.y_view_dict.get(points_array[0, 1])
-                if y_plane_array is None:
-                    return
-
-                # Extract coordinates and target label (assuming all points have same target_label)
-                eraser_x = points_array[:, 0]
-                eraser_y = points_array[:, 2]
-                target_label = points_array[0, 3]  # All points should have same target_label
-
-                # Extract coordinates and labels from z_plane_array
-                points_x = y_plane_array[:, 1]
-                points_y = y_plane_array[:, 0]
-                points_labels = y_plane_array[:, 3]
-
-                # Vectorized conditions - check if any eraser point is within radius
-                label_match = points_labels == target_label
-                points_x_match = np.isin(points_x, eraser_x)
-                points_y_match = np.isin(points_y, eraser_y)
-
-                # Combine all conditions
-                mask = label_match & points_x_match & points_y_match
-
-                # Build points_to_remove as numpy array using vectorized indexing
-                if np.any(mask):
-                    selected_points = y_plane_array[mask]
-                    # For multiple eraser points, we use the first point's index (point[2]) 
-                    # as they should all have the same z-coordinate/index
-                    point_y_index = points_array[0, 1]
-                    points_to_remove = np.column_stack([
-                        selected_points[:, 1],  # p[0] - x coordinate
-                        np.full(len(selected_points), point_y_index),
-                        selected_points[:, 0],  # p[1] - z coordinate
-                        selected_points[:, 2],  # p[2] - label
-                        selected_points[:, 3]  # p[3] - color index
-                    ])
-                else:
-                    points_to_remove = []
-            elif view_plane == "YZ":
-                # Handle both single point and list of points
-                if not isinstance(point, list) or len(point) == 5:
-                    # Single point case
-                    points_array = np.array([point])
-                    x_plane_array = self.x_view_dict.get(point[0])
-                else:
-                    # Multiple points case
-                    points_array = np.array(point)
-                    x_plane_array = self.x_view_dict.get(points_array[0, 0])
-                if x_plane_array is None:
-                    return
-                # Extract coordinates and target label (assuming all points have same target_label)
-                eraser_x = points_array[:, 2]
-                eraser_y = points_array[:, 1]
-                target_label = points_array[0, 3]  # All points should have same target_label
-
-                # Extract coordinates and labels from x_plane_array
-                points_x = x_plane_array[:, 0]
-                points_y = x_plane_array[:, 1]
-                points_labels = x_plane_array[:, 3]
-
-                # Vectorized conditions - check if any eraser point is within radius
-                label_match = points_labels == target_label
-
-                points_x_match = np.isin(points_x, eraser_x)
-                points_y_match = np.isin(points_y, eraser_y)
-                mask = label_match & points_x_match & points_y_match
-
-                # Build points_to_remove as numpy array using vectorized indexing
-                if np.any(mask):
-                    selected_points = x_plane_array[mask]
-                    # For multiple eraser points, we use the first point's index (point[2]) 
-                    # as they should all have the same z-coordinate/index
-                    point_x_index = points_array[0, 0]
-                    points_to_remove = np.column_stack([
-                        np.full(len(selected_points), point_x_index),
-                        selected_points[:, 1],  # p[0] - y coordinate
-                        selected_points[:, 0],  # p[1] - z coordinate
-                        selected_points[:, 2],  # p[2] - label
-                        selected_points[:, 3]  # p[3] - color index
-                    ])
-                else:
-                    points_to_remove = []
-            else:
-                return
+        version = self.label_store.version
+        self.label_store.remove_label(cell_idx)
+        self.mark_labels_dirty(np.array(bounding_box), version)
 
-            if len(points_to_remove) == 0:
+    def removePoints(self, coords, target_label, view_plane):
+        # coords: (N, 3) array of x, y, z eraser positions, a single point may be passed as (3,)
+        # Only voxels of target_label are erased, all view planes share this path.
+        if self.eraser_enabled and self.markers_enabled:
+            if view_plane not in ("XY", "XZ", "YZ"):
                 return
-
-            temp_z_view_removal_dict = {}
-            temp_y_view_removal_dict = {}
-            temp_x_view_removal_dict = {}
-            for p in points_to_remove:
-                if p[2] not in temp_z_view_removal_dict:
-                    temp_z_view_removal_dict[p[2]] = []
-                if p[1] not in temp_y_view_removal_dict:
-                    temp_y_view_removal_dict[p[1]] = []
-                if p[0] not in temp_x_view_removal_dict:
-                    temp_x_view_removal_dict[p[0]] = []
-                temp_z_view_removal_dict[p[2]].append((p[0], p[1], p[3], p[4]))
-                temp_y_view_removal_dict[p[1]].append((p[2], p[0], p[3], p[4]))
-                temp_x_view_removal_dict[p[0]].append((p[2], p[1], p[3], p[4]))
-            temp_z_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_z_view_removal_dict.items()}
-            temp_y_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_y_view_removal_dict.items()}
-            temp_x_view_removal_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_x_view_removal_dict.items()}
-            self.remove_pts_slice_view_dicts(temp_z_view_removal_dict, temp_y_view_removal_dict,
-                                             temp_x_view_removal_dict) #TODO direct array interaction?
-            points_of_target_label = self.points_per_cell.get(target_label)
-            mask_to_remove = (points_to_remove[None, :, :] == points_of_target_label[:, None, :]).all(-1).any(1)
-            new_points_of_target_label = points_of_target_label[~mask_to_remove]
-            self.points_per_cell[target_label] = new_points_of_target_label
+            version = self.label_store.version
+            removed = self.label_store.remove_points(coords, target_label)
+            self.mark_labels_dirty(removed, version)
 
     def load_masks(self, filename):
         # Show the loading screen
@@ -1338,114 +1336,65 @@ class MainWindow(QMainWindow):
         answer_bool = (answer == QMessageBox.Yes)
         self.label_shift_answer.emit(answer_bool)
 
-    def add_pts_slice_view_dicts(self,
-                                 temp_z_view_dict,
-                                 temp_y_view_dict,
-                                 temp_x_view_dict,
-                                 temp_points_per_cell_dict):
-        for k, v in temp_z_view_dict.items(): #TODO roll xyz into one
-            np_z_pts = self.z_view_dict.get(k)
-            if np_z_pts is not None:
-                coors_present = np_z_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = ~np.isin(v_rows, coors_rows)
-                v = v[occupied_mask]
-                if v.size == 0:
-                    continue
-                self.z_view_dict[k] = np.append(np_z_pts, v, axis=0)
-            else:
-                self.z_view_dict[k] = v
-        for k, v in temp_y_view_dict.items():
-            np_y_pts = self.y_view_dict.get(k)
-            if np_y_pts is not None:
-                coors_present = np_y_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = ~np.isin(v_rows, coors_rows)
-                v = v[occupied_mask]
-                if v.size == 0:
-                    continue
-                self.y_view_dict[k] = np.append(np_y_pts, v, axis=0)
-            else:
-                self.y_view_dict[k] = v
-        for k, v in temp_x_view_dict.items():
-            np_x_pts = self.x_view_dict.get(k)
-            if np_x_pts is not None:
-                coors_present = np_x_pts[:, :2]
-                v_rows = v[:, :2].view([('', v.dtype)] * 2).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 2).reshape(-1)
-                occupied_mask = ~np.isin(v_rows, coors_rows)
-                v = v[occupied_mask]
-                if v.size == 0:
-                    continue
-                self.x_view_dict[k] = np.append(np_x_pts, v, axis=0)
-            else:
-                self.x_view_dict[k] = v
-        for k, v in temp_points_per_cell_dict.items():
-            np_pts = self.points_per_cell.get(k)
-            if np_pts is not None:
-                coors_present = np_pts[:, :3]
-                v_rows = v[:, :3].view([('', v.dtype)] * 3).reshape(-1)
-                coors_rows = coors_present.view([('', coors_present.dtype)] * 3).reshape(-1)
-                occupied_mask = ~np.isin(v_rows, coors_rows)
-                v = v[occupied_mask]
-                if v.size == 0:
-                    continue
-                self.points_per_cell[k] = np.append(np_pts, v, axis=0)
-            else:
-                self.points_per_cell[k] = v
-
-    def add_points(self, point):
-        if not isinstance(point, list):
-            point = [point]
-        temp_z_view_dict = {}
-        temp_y_view_dict = {}
-        temp_x_view_dict = {}
-        temp_points_per_cell_dict = {}
-        for p in point:
-            # self.foreground_points.append(p)
-            if p[3] not in temp_points_per_cell_dict:
-                temp_points_per_cell_dict[p[3]] = []
-            if p[2] not in temp_z_view_dict:
-                temp_z_view_dict[p[2]] = []
-            if p[1] not in temp_y_view_dict:
-                temp_y_view_dict[p[1]] = []
-            if p[0] not in temp_x_view_dict:
-                temp_x_view_dict[p[0]] = []
-            temp_points_per_cell_dict[p[3]].append(p)
-            temp_z_view_dict[p[2]].append((p[0], p[1], p[3], p[4]))
-            temp_y_view_dict[p[1]].append((p[2], p[0], p[3], p[4]))
-            temp_x_view_dict[p[0]].append((p[2], p[1], p[3], p[4]))
-        temp_z_view_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_z_view_dict.items()}
-        temp_y_view_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_y_view_dict.items()}
-        temp_x_view_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_x_view_dict.items()}
-        temp_points_per_cell_dict = {k: np.array(v, dtype=np.int32) for k, v in temp_points_per_cell_dict.items()}
-        self.add_pts_slice_view_dicts(temp_z_view_dict, temp_y_view_dict, temp_x_view_dict, temp_points_per_cell_dict)
+    def add_points(self, coords, target_label):
+        # coords: (N, 3) array of x, y, z positions, a single point may be passed as (3,)
+        # Brush stamps, pasted slices and imported segmentations all end up
+        # here and are committed to the label store in one vectorized write.
+        version = self.label_store.version
+        written = self.label_store.add_points(coords, target_label)
+        self.mark_labels_dirty(written, version)
+
+    def mark_labels_dirty(self, coords, version):
+        # coords: (N, 3) voxels an edit actually changed, version: store version before the edit.
+        # Each view gets the bounding box of the edit within its slice as a dirty
+        # rectangle, views whose slice the edit does not cross are not re-rendered.
+        if len(coords) == 0:
+            return
+        x_min, y_min, z_min = coords.min(axis=0)
+        x_max, y_max, z_max = coords.max(axis=0) + 1
+        edited_views = (
+            (self.xy_view, "XY", self.slider.value(), (z_min, z_max), (y_min, y_max, x_min, x_max)),
+            (self.xz_view, "XZ", self.slidery.value(), (y_min, y_max), (x_min, x_max, z_min, z_max)),
+            (self.yz_view, "YZ", self.sliderx.value(), (x_min, x_max), (y_min, y_max, z_min, z_max)),
+        )
+        for view, view_plane, flat_index, (low, high), dirty_rect in edited_views:
+            self.slice_cache.invalidate("overlay", self.label_store, view_plane, range(low, high))
+            intersects = low <= flat_index < high
+            if view.overlay_version == version:
+                # Overlay was current, so this edit is all it is missing
+                view.overlay_version = self.label_store.version
+                if intersects:
+                    view.dirty_rects.append(tuple(int(v) for v in dirty_rect))
+            if intersects:
+                self.request_render(view_plane)
 
     def on_masks_loaded(self):
         self.loading_screen.hide()
+        if self.document.unlinked_store is not None:
+            old_store = self.linked_source.unlinked_store
+            relink_documents(self.linked_source, list(self.documents.values()), self.label_store)
+            self.slice_cache.drop_source(old_store)
+        # Annotations loaded from a file need no resuming, until they are edited
+        for document in self.documents.values():
+            if document.own_store() is self.label_store and document.autosave is not None:
+                document.autosave.saved = (id(self.label_store), self.label_store.version)
         self.cell_idx_display.update_text(self.index_control.cell_index, self.current_highest_cell_index)
         self.index_control.update_index(self.index_control.cell_index, self.current_highest_cell_index)
         self.update_index_display()
-        self.update_xy_view()
-        self.update_xz_view()
-        self.update_yz_view()
+        self.request_render()
 
     def open_file_dialog(self):
         options = QFileDialog.Options()
-        file_name, _ = QFileDialog.getOpenFileName(self, "Load Mask", "", "Numpy Files (*.npy)", options=options)
+        file_name, _ = QFileDialog.getOpenFileName(self, "Load Mask", "", MASK_FILE_FILTER, options=options)
         if file_name:
             self.load_masks(file_name)
 
     def findCell(self):
-        cell_points = self.points_per_cell.get(self.current_highest_cell_index)
-        if cell_points is not None:
-            xyz_points = cell_points[:, :3]
-            average_point = np.median(xyz_points, axis=0)
-            self.slidery.setValue(round(average_point[1]))
-            self.sliderx.setValue(round(average_point[0]))
-            self.slider.setValue(round(average_point[2]))
+        if self.label_store is not None and self.label_store.has_label(self.current_highest_cell_index):
+            x, y, z = self.label_store.stats.nearest_point(self.current_highest_cell_index)
+            self.slidery.setValue(y)
+            self.sliderx.setValue(x)
+            self.slider.setValue(z)
         else:
             QMessageBox.about(self, "Foreground empty", "%s" % ("Please draw cells using the foreground button"))
 
@@ -1457,181 +1406,135 @@ class MainWindow(QMainWindow):
             self.foreground_enabled = False
             self.background_enabled = False
             self.eraser_enabled = False
-            self.update_xy_view()
-            self.update_xz_view()
-            self.update_yz_view()
+            self.request_render()
         else:
             self.markers_enabled = True
             self.markers_off_on_button.setText("Markers On (M)")
-            self.update_xy_view()
-            self.update_xz_view()
-            self.update_yz_view()
+            self.request_render()
         self.repaint()
 
     def update_xy_view(self): #TODO consolidate views
         if self.image_data is not None:
             z_index = self.slider.value()
-            image = self.get_flat_image_view("XY", z_index)
-            if self.markers_enabled:
-                relevant_points = self.z_view_dict.get(z_index)
-                if relevant_points is not None:
-                    points_to_paint = []
-                    xy = relevant_points[:, :2]
-                    label_indices = relevant_points[:, -1]
-                    if self.alpha_label_index is not None:
-                        mask_for_contour_finding = np.where(label_indices == self.alpha_label_index)[0]
-                        pts_relevant = xy[mask_for_contour_finding]
-                        if pts_relevant.shape[0] > 0:
-                            max_box = np.max(pts_relevant, axis=0)
-                            min_box = np.min(pts_relevant, axis=0)
-                    colors = glasbey_cmap_rgb[label_indices]
-                    points_to_paint = np.hstack((xy, colors))
-                    gray_rgb = np.stack([image] * 3, axis=-1)
-                    gray_rgb[points_to_paint[:, 1], points_to_paint[:, 0]] = points_to_paint[:, 2:]
-                    pixmap = self.numpyArrayToPixmap(gray_rgb)
-                    if self.alpha_label_index is not None and pts_relevant.shape[0] > 0:
-                        circle_painter = QPainter(pixmap)
-                        pen = QPen(QColor(255, 0, 0, 80))
-                        pen.setWidth(1)
-                        circle_painter.setPen(pen)
-                        circle_painter.drawEllipse(min_box[0] - 2, min_box[1] - 2, max_box[0] - min_box[0] + 4,
-                                                   max_box[1] - min_box[1] + 4)
-                        circle_painter.end()
-                else:
-                    pixmap = self.numpyArrayToPixmap(image)
-
-                if self.view_finder:
-                    self.xy_painter = QPainter(pixmap)
-                    pen = QPen(QColor(255, 255, 0, 80))
-                    pen.setWidth(1)
-                    self.xy_painter.setPen(pen)
-                    y_val = self.slider_to_pixmap(self.slidery.value(), 0, self.y_max, 0, pixmap.height())
-                    x_val = self.slider_to_pixmap(self.sliderx.value(), 0, self.x_max, 0, pixmap.width())
-                    square_size = 30
-                    top_left_x = x_val - square_size // 2
-                    top_left_y = y_val - square_size // 2
-                    self.xy_painter.drawEllipse(top_left_x, top_left_y, square_size, square_size)
-                    self.xy_painter.drawLine(x_val, 0, x_val, pixmap.height())
-                    self.xy_painter.drawLine(0, y_val, pixmap.width(), y_val)
-                    self.xy_painter.end()
+            self.update_base_layer(self.xy_view, "XY", z_index)
+            self.update_overlay_layer(self.xy_view, "XY", z_index)
+            if self.markers_enabled and self.view_finder:
+                width, height = self.xy_view.base_size()
+                y_val = self.slider_to_pixmap(self.slidery.value(), 0, self.y_max, 0, height)
+                x_val = self.slider_to_pixmap(self.sliderx.value(), 0, self.x_max, 0, width)
+                self.xy_view.set_view_finder(x_val, y_val, width, height, circle_size=30)
             else:
-                pixmap = self.numpyArrayToPixmap(image)
-            self.xy_view.setPixmap(pixmap)
+                self.xy_view.hide_view_finder()
+
+    def update_base_layer(self, view, view_plane, flat_index):
+        # The grayscale slice only changes with the slice index or the image
+        key = (id(self.image_data), flat_index)
+        if view.base_key != key:
+            image = self.slice_cache.get("base", self.volume_layout, view_plane, flat_index)
+            if image is None:
+                image, n_bytes = self.render_base_slice(self.volume_layout, view_plane, flat_index)
+                self.slice_cache.put("base", self.volume_layout, view_plane, flat_index, image, n_bytes)
+            view.setPixmap(QPixmap.fromImage(image))
+            view.base_key = key
+            self.prefetch_slices(view_plane, flat_index)
+
+    def render_base_slice(self, volume_layout, view_plane, flat_index):
+        image = self.numpyArrayToImage(self.get_flat_image_view(view_plane, flat_index, volume_layout))
+        return image, image.bytesPerLine() * image.height()
+
+    def render_overlay_slice(self, label_store, view_plane, flat_index):
+        argb = self.labels_to_argb(label_store.get_slice(view_plane, flat_index))
+        return argb, argb.nbytes
+
+    def prefetch_slices(self, view_plane, flat_index):
+        # Neighbouring slices are rendered in the background, nearest first
+        n_slices = {"XY": self.z_max, "XZ": self.y_max, "YZ": self.x_max}[view_plane] + 1
+        indices = []
+        for offset in range(1, PREFETCH_RADIUS + 1):
+            indices += [i for i in (flat_index + offset, flat_index - offset) if 0 <= i < n_slices]
+        jobs = [("base", self.volume_layout, view_plane, i, self.render_base_slice) for i in indices]
+        if self.markers_enabled and self.label_store.label_counts:
+            jobs += [("overlay", self.label_store, view_plane, i, self.render_overlay_slice) for i in indices]
+        self.slice_prefetcher.request(view_plane, jobs)
+
+    def update_overlay_layer(self, view, view_plane, flat_index):
+        # Hiding the masks only hides the overlay, the slice is not re-rendered
+        view.set_overlay_visible(self.markers_enabled)
+        if not self.markers_enabled:
+            return
+        label_store = self.label_store
+        key = (id(label_store), flat_index)
+        # The label slice is only fetched when something has to be rendered from
+        # it, a chunked store assembles it from its chunks
+        if view.overlay_key != key or view.overlay_version != label_store.version:
+            argb = self.slice_cache.get("overlay", label_store, view_plane, flat_index)
+            if argb is None:
+                argb = self.labels_to_argb(label_store.get_slice(view_plane, flat_index))
+                self.slice_cache.put("overlay", label_store, view_plane, flat_index, argb, argb.nbytes)
+            view.setOverlay(argb)
+            view.overlay_key = key
+            view.overlay_version = label_store.version
+        elif len(view.dirty_rects) > 0:
+            # Brush strokes only repaint the rectangles they touched
+            label_slice = label_store.get_slice(view_plane, flat_index)
+            for row_min, row_max, col_min, col_max in view.dirty_rects:
+                view.update_overlay_region(row_min, col_min,
+                                           self.labels_to_argb(label_slice[row_min:row_max, col_min:col_max]))
+        view.dirty_rects = []
+        self.update_selection_box(view, view_plane, flat_index)
+
+    def labels_to_argb(self, label_slice):
+        # Colours come from a lookup table, background stays transparent
+        argb = glasbey_cmap_argb[label_slice % num_colors]
+        argb[label_slice == 0] = 0
+        return argb
+
+    def update_selection_box(self, view, view_plane, flat_index):
+        if self.alpha_label_index is not None:
+            extent = self.label_store.stats.slice_extent(view_plane, flat_index, self.alpha_label_index)
+            if extent is not None:
+                row_min, row_max, col_min, col_max = extent
+                view.set_selection_box((col_min, row_min), (col_max, row_max))
+                return
+        view.hide_selection_box()
 
     def slider_to_pixmap(self, slider_value, slider_min, slider_max, pixmap_min, pixmap_max):
         return int((slider_value - slider_min) / (slider_max - slider_min) * (pixmap_max - pixmap_min) + pixmap_min)
 
-    def get_flat_image_view(self, view_plane, flat_index):
-        if view_plane == "XY":
-            image = self.image_data[flat_index]
-        elif view_plane == "XZ":
-            if self.image_data.ndim == 4:
-                image = self.image_data[:, flat_index, :, :]
-                image = np.transpose(image, (1, 0, 2))
-            else:
-                image = self.image_data[:, flat_index, :].T
-        elif view_plane == "YZ":
-            if self.image_data.ndim == 4:
-                image = self.image_data[:, :, flat_index, :]
-                image = np.transpose(image, (1, 0, 2))
-            else:
-                image = self.image_data[:, :, flat_index].T
-        else:
+    def get_flat_image_view(self, view_plane, flat_index, volume_layout=None):
+        # The volume layout decides where each plane is sliced from, so XZ and YZ
+        # can come from memory in which they are contiguous
+        if volume_layout is None:
+            volume_layout = self.volume_layout
+        if view_plane not in ("XY", "XZ", "YZ"):
             return
-        return image
+        return volume_layout.get_slice(view_plane, flat_index)
 
     def update_xz_view(self):
         if self.image_data is not None:
             y_index = self.slidery.value()
-            image = self.get_flat_image_view("XZ", y_index)
-            if self.markers_enabled:
-                relevant_points = self.y_view_dict.get(y_index)
-                if relevant_points is not None:
-                    points_to_paint = []
-                    xz = relevant_points[:, :2]
-                    label_indices = relevant_points[:, -1]
-                    colors = glasbey_cmap_rgb[label_indices]
-                    points_to_paint = np.hstack((xz, colors))
-                    gray_rgb = np.stack([image] * 3, axis=-1)  # shape (H, W, 3)
-                    gray_rgb[points_to_paint[:, 1], points_to_paint[:, 0]] = points_to_paint[:, 2:]
-                    pixmap = self.numpyArrayToPixmap(gray_rgb)
-                    if self.alpha_label_index is not None:
-                        mask_for_contour_finding = np.where(label_indices == self.alpha_label_index)[0]
-                        pts_relevant = xz[mask_for_contour_finding]
-                        if pts_relevant.shape[0] > 0:
-                            max_box = np.max(pts_relevant, axis=0)
-                            min_box = np.min(pts_relevant, axis=0)
-                    if self.alpha_label_index is not None and pts_relevant.shape[0] > 0:
-                        circle_painter = QPainter(pixmap)
-                        pen = QPen(QColor(255, 0, 0, 80))
-                        pen.setWidth(1)
-                        circle_painter.setPen(pen)
-                        circle_painter.drawEllipse(min_box[0] - 2, min_box[1] - 2, max_box[0] - min_box[0] + 4,
-                                                   max_box[1] - min_box[1] + 4)
-                        circle_painter.end()
-                else:
-                    pixmap = self.numpyArrayToPixmap(image)
-
-                if self.view_finder:
-                    painter = QPainter(pixmap)
-                    pixmapx = self.slider_to_pixmap(self.slider.value(), 0, self.z_max, 0, pixmap.width())
-                    pixmapy = self.slider_to_pixmap(self.sliderx.value(), 0, self.x_max, 0, pixmap.height())
-                    pen = QPen(QColor(255, 255, 0, 80)) #TODO could define color/constants towards top of file for easy future edits
-                    pen.setWidth(1)
-                    painter.setPen(pen)
-                    painter.drawLine(pixmapx, 0, pixmapx, pixmap.height())
-                    painter.drawLine(0, pixmapy, pixmap.width(), pixmapy)
-                    painter.end()
+            self.update_base_layer(self.xz_view, "XZ", y_index)
+            self.update_overlay_layer(self.xz_view, "XZ", y_index)
+            if self.markers_enabled and self.view_finder:
+                width, height = self.xz_view.base_size()
+                pixmapx = self.slider_to_pixmap(self.slider.value(), 0, self.z_max, 0, width)
+                pixmapy = self.slider_to_pixmap(self.sliderx.value(), 0, self.x_max, 0, height)
+                self.xz_view.set_view_finder(pixmapx, pixmapy, width, height)
             else:
-                pixmap = self.numpyArrayToPixmap(image)
-            self.xz_view.setPixmap(pixmap)
+                self.xz_view.hide_view_finder()
 
     def update_yz_view(self):
         if self.image_data is not None:
             x_index = self.sliderx.value()
-            image = self.get_flat_image_view("YZ", x_index)
-            pixmap = self.numpyArrayToPixmap(image)
-            if self.markers_enabled:
-                relevant_points = self.x_view_dict.get(x_index)
-                if relevant_points is not None:
-                    points_to_paint = []
-                    yz = relevant_points[:, :2]
-                    label_indices = relevant_points[:, -1]
-                    colors = glasbey_cmap_rgb[label_indices]
-                    points_to_paint = np.hstack((yz, colors))
-                    gray_rgb = np.stack([image] * 3, axis=-1)
-                    gray_rgb[points_to_paint[:, 1], points_to_paint[:, 0]] = points_to_paint[:, 2:]
-                    pixmap = self.numpyArrayToPixmap(gray_rgb)
-                    if self.alpha_label_index is not None:
-                        mask_for_contour_finding = np.where(label_indices == self.alpha_label_index)[0]
-                        pts_relevant = yz[mask_for_contour_finding]
-                        if pts_relevant.shape[0] > 0:
-                            max_box = np.max(pts_relevant, axis=0)
-                            min_box = np.min(pts_relevant, axis=0)
-                    if self.alpha_label_index is not None and pts_relevant.shape[0] > 0:
-                        circle_painter = QPainter(pixmap)
-                        pen = QPen(QColor(255, 0, 0, 80))
-                        pen.setWidth(1)
-                        circle_painter.setPen(pen)
-                        circle_painter.drawEllipse(min_box[0] - 2, min_box[1] - 2, max_box[0] - min_box[0] + 4,
-                                                   max_box[1] - min_box[1] + 4)
-                        circle_painter.end()
-                else:
-                    pixmap = self.numpyArrayToPixmap(image)
-
-                if self.view_finder:
-                    painter = QPainter(pixmap)
-                    pixmapy = self.slider_to_pixmap(self.slidery.value(), 0, self.y_max, 0, pixmap.height())
-                    pixmapx = self.slider_to_pixmap(self.slider.value(), 0, self.z_max, 0, pixmap.width())
-                    pen = QPen(QColor(255, 255, 0, 80))
-                    pen.setWidth(1)
-                    painter.setPen(pen)
-                    painter.drawLine(pixmapx, 0, pixmapx, pixmap.height())
-                    painter.drawLine(0, pixmapy, pixmap.width(), pixmapy)
-                    painter.end()
+            self.update_base_layer(self.yz_view, "YZ", x_index)
+            self.update_overlay_layer(self.yz_view, "YZ", x_index)
+            if self.markers_enabled and self.view_finder:
+                width, height = self.yz_view.base_size()
+                pixmapy = self.slider_to_pixmap(self.slidery.value(), 0, self.y_max, 0, height)
+                pixmapx = self.slider_to_pixmap(self.slider.value(), 0, self.z_max, 0, width)
+                self.yz_view.set_view_finder(pixmapx, pixmapy, width, height)
             else:
-                pixmap = self.numpyArrayToPixmap(image)
-            self.yz_view.setPixmap(pixmap)
+                self.yz_view.hide_view_finder()
 
 
 def main():
@@ -11,11 +11,14 @@ from PyQt5.QtCore import Qt, QThread, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QMovie
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QFormLayout, QSpinBox, QSlider, QDialog, QMessageBox
 import numpy as np
-from tqdm import tqdm
 from cmaps import  num_colors
-from scipy.ndimage import find_objects
 import os
 import imageio.v3 as iio
+from contrast import saturated_range, apply_contrast, progress_range
+from label_store import create_label_store
+from parallel_import import parallel_load_array, PARALLEL_IMPORT_MIN_BYTES
+from mask_io import save_label_store, load_mask_file
+from lazy_volume import LazyVolume, open_memmap, LAZY_LOAD_MIN_BYTES
 
 class LoadingScreen(QWidget):
     def __init__(self, parent=None):
@@ -103,9 +106,7 @@ class WatershedDialog(QDialog):
             keep_points += self.min_shift
             keep_points = keep_points[:, [2, 1, 0]]
             self.parent().watershed_foreground_points = keep_points
-            self.parent().update_xy_view()
-            self.parent().update_xz_view()
-            self.parent().update_yz_view()
+            self.parent().request_render()
 
 
 class ThresholdDialog(QDialog):
@@ -169,41 +170,6 @@ class ThresholdDialog(QDialog):
         # Return the adjusted values
         return (self.background_slider.value(), self.cell_centre_slider.value())
 
-# Step 2: pure Python function to build the dictionary
-def group_points_sparse(points):
-    # points shape: (N, 3) where last column is index
-    index_values = points[:, -1].astype(int)
-    unique_indices = np.unique(index_values)
-
-    groups = {}
-    for idx in unique_indices:
-        mask = (index_values == idx)
-        group_points = points[mask][:, :2]  # only x, y columns
-        groups[idx] = group_points
-
-    return groups
-    
-class SliceLoader(QThread):
-        finished = pyqtSignal(dict, str)
-        def __init__(self, parent, view_plane, slice_index, *args, **kwargs):
-            super().__init__(*args, **kwargs)
-            self.parent = parent
-            self._view_plane = view_plane
-            self._slice_index = slice_index
-
-        def run(self):
-            if self._view_plane == "XY":
-                relevant_points = self.parent.z_view_dict.get(self._slice_index)
-            elif self._view_plane == "XZ":
-                relevant_points = self.parent.y_view_dict.get(self._slice_index)
-            elif self._view_plane == "YZ":
-                relevant_points = self.parent.x_view_dict.get(self._slice_index)
-            if relevant_points:
-                grouped_points = group_points_sparse(np.array(relevant_points))
-                self.finished.emit(grouped_points, self._view_plane)
-            else:
-                self.finished.emit({}, self._view_plane)
-
 class MaskLoader(QThread):
     finished = pyqtSignal()
     progress = pyqtSignal(int)
@@ -220,57 +186,30 @@ class MaskLoader(QThread):
 
     def run(self):
         #assert self.filename.endswith(".npy"), "Mask file must end with .npy"
-        ext = os.path.splitext(self.filename)[1].lower()
-        if ext == '.npy':
-            mask = np.load(self.filename, allow_pickle='TRUE')#.item()
-        else:
-            mask = iio.imread(self.filename)
+        mask = load_mask_file(self.filename)
+        if self.parent.image_data is None:
+            return
         if isinstance(mask, np.ndarray) and mask.dtype == object and mask.ndim == 0:
             # mask saved as dict
             mask = mask.item()
-            if np.issubdtype(mask.dtype, np.floating):
-                mask = mask.astype(int)
-            if mask.shape != self.parent.image_data.shape:
-                self.error_signal.emit("Mask shape does not match image shape")
-                self.finished.emit()
-                return None
-            self.mask = mask
-            #assert mask.shape == self.parent.image_data.shape, f"Mask shape does not match image shape {mask.shape} != {self.parent.image_data.shape}"
-            self.parent.background_points = []
-            self.parent.foreground_points = []
-            self.parent.z_view_dict = {}
-            self.parent.y_view_dict = {}
-            self.parent.x_view_dict = {}
+            label_store = create_label_store(self.parent.image_data.shape)
             print("loading masks...")
-            for i in tqdm(range(1, len(mask)+1)):
-                global_locs = mask.get(i)
-                if global_locs is not None:
-                    color_idx = i % num_colors
-                    for loc in global_locs:
-                        z, y, x = loc
-                        self.parent.foreground_points.append((x, y, z, i, color_idx))
-                        if z not in self.parent.z_view_dict:
-                            self.parent.z_view_dict[z] = []
-                        self.parent.z_view_dict[z].append((x, y, i, color_idx))
-                        if y not in self.parent.y_view_dict:
-                            self.parent.y_view_dict[y] = []
-                        self.parent.y_view_dict[y].append((z, x, i, color_idx))
-                        if x not in self.parent.x_view_dict:
-                            self.parent.x_view_dict[x] = []
-                        self.parent.x_view_dict[x].append((z, y, i, color_idx))
-                        if i not in self.parent.points_per_cell:
-                            self.parent.points_per_cell[i] = []
-                        self.parent.points_per_cell[i].append((x, y, z, i, color_idx))
-                    if i > self.parent.index_control.cell_index:
-                        self.parent.index_control.cell_index = i
-                self.progress.emit(i)
+            coords, labels = [], []
+            for i, global_locs in mask.items():
+                if global_locs is not None and len(global_locs) > 0:
+                    global_locs = np.asarray(global_locs, dtype=np.intp).reshape(-1, 3)
+                    # z, y, x -> x, y, z
+                    coords.append(global_locs[:, ::-1])
+                    labels.append(np.full(len(global_locs), int(i), dtype=np.int64))
+            if len(coords) > 0:
+                label_store.add_labelled_points(np.concatenate(coords), np.concatenate(labels))
+            self.update_cell_index(label_store)
+            self.progress.emit(len(mask))
         else:
             # mask saved as npy array
             # mask = np.load(self.filename)
             if np.issubdtype(mask.dtype, np.floating):
                 mask = mask.astype(int)
-            if self.parent.image_data is None:
-                return
             if mask.shape != self.parent.image_data.shape:
                 self.error_signal.emit("Mask shape does not match image shape")
                 self.finished.emit()
@@ -281,104 +220,40 @@ class MaskLoader(QThread):
                 return
                 #if self.minimum_index is not None:
             #assert mask.shape == self.parent.image_data.shape, f"Mask shape does not match image shape {mask.shape} != {self.parent.image_data.shape}"
-            self.parent.background_points = []
-            self.parent.foreground_points = []
-            self.parent.z_view_dict = {}
-            self.parent.y_view_dict = {}
-            self.parent.x_view_dict = {}
-            print("loading masks...")
-            slices = find_objects(mask)
-            for i, slice_tuple in enumerate(tqdm(slices), start=1):
-                if slice_tuple is not None:
-                    local_locs = np.array(np.where(mask[slice_tuple] == i))
-                    global_locs = np.stack(local_locs).T + np.array([s.start for s in slice_tuple])
-                    color_idx = i % num_colors
-                    for loc in global_locs:
-                        z, y, x = loc
-                        self.parent.foreground_points.append((x, y, z, i, color_idx))
-                        if z not in self.parent.z_view_dict:
-                            self.parent.z_view_dict[z] = []
-                        self.parent.z_view_dict[z].append((x, y, i, color_idx))
-                        if y not in self.parent.y_view_dict:
-                            self.parent.y_view_dict[y] = []
-                        self.parent.y_view_dict[y].append((z, x, i, color_idx))
-                        if x not in self.parent.x_view_dict:
-                            self.parent.x_view_dict[x] = []
-                        self.parent.x_view_dict[x].append((z, y, i, color_idx))
-                        if i not in self.parent.points_per_cell:
-                            self.parent.points_per_cell[i] = []
-                        self.parent.points_per_cell[i].append((x, y, z, i, color_idx))
-                    if i > self.parent.index_control.cell_index:
-                        self.parent.index_control.cell_index = i
-                self.progress.emit(i)
-
-        #self.finish_work()
-        self.parent.z_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.z_view_dict.items()}
-        self.parent.y_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.y_view_dict.items()}
-        self.parent.x_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.x_view_dict.items()}
-        self.parent.points_per_cell = {k: np.array(v, dtype=np.int32) for k, v in self.parent.points_per_cell.items()}
-
-        self.parent.foreground_points = sorted(self.parent.foreground_points, key=lambda x: x[-1])
-        current_tab = self.parent.tab_widget.currentWidget()
-        self.parent.data_per_tab[current_tab]["points_per_cell"] = self.parent.points_per_cell
-        self.parent.data_per_tab[current_tab]["foreground_points"] = self.parent.foreground_points
-        self.parent.data_per_tab[current_tab]["z_view_dict"] = self.parent.z_view_dict
-        self.parent.data_per_tab[current_tab]["y_view_dict"] = self.parent.y_view_dict
-        self.parent.data_per_tab[current_tab]["x_view_dict"] = self.parent.x_view_dict
-        self.parent.current_highest_cell_index = self.parent.index_control.cell_index
-        self.finished.emit()
+            label_store = self.build_label_store(mask)
 
-    def continue_work(self, answer):
-        self.parent.background_points = []
-        self.parent.foreground_points = []
-        self.parent.z_view_dict = {}
-        self.parent.y_view_dict = {}
-        self.parent.x_view_dict = {}
+        self.finish_work(label_store)
+
+    def build_label_store(self, mask):
+        # The whole label volume is copied into the store in bulk and counted
+        # with bincount, no per-label or per-voxel work in Python. Large volumes
+        # are split over a process pool.
         print("loading masks...")
+        label_store = create_label_store(mask.shape)
+        if self.parent.parallel_mask_import and isinstance(mask, np.ndarray) \
+                and mask.nbytes >= PARALLEL_IMPORT_MIN_BYTES:
+            parallel_load_array(label_store, mask)
+        else:
+            label_store.load_array(mask)
+        self.update_cell_index(label_store)
+        self.progress.emit(label_store.max_label())
+        return label_store
+
+    def update_cell_index(self, label_store):
+        if label_store.max_label() > self.parent.index_control.cell_index:
+            self.parent.index_control.cell_index = label_store.max_label()
+
+    def continue_work(self, answer):
         mask = self.mask
         if answer:
-            mask = mask - mask.min()
-        slices = find_objects(mask)
-        for i, slice_tuple in enumerate(tqdm(slices), start=1):
-            if slice_tuple is not None:
-                local_locs = np.array(np.where(mask[slice_tuple] == i))
-                global_locs = np.stack(local_locs).T + np.array([s.start for s in slice_tuple])
-                color_idx = i % num_colors
-                for loc in global_locs:
-                    z, y, x = loc
-                    self.parent.foreground_points.append((x, y, z, i, color_idx))
-                    if z not in self.parent.z_view_dict:
-                        self.parent.z_view_dict[z] = []
-                    self.parent.z_view_dict[z].append((x, y, i, color_idx))
-                    if y not in self.parent.y_view_dict:
-                        self.parent.y_view_dict[y] = []
-                    self.parent.y_view_dict[y].append((z, x, i, color_idx))
-                    if x not in self.parent.x_view_dict:
-                        self.parent.x_view_dict[x] = []
-                    self.parent.x_view_dict[x].append((z, y, i, color_idx))
-                    if i not in self.parent.points_per_cell:
-                        self.parent.points_per_cell[i] = []
-                    self.parent.points_per_cell[i].append((x, y, z, i, color_idx))
-                if i > self.parent.index_control.cell_index:
-                    self.parent.index_control.cell_index = i
-            self.progress.emit(i)
-
-        self.parent.z_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.z_view_dict.items()}
-        self.parent.y_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.y_view_dict.items()}
-        self.parent.x_view_dict = {k: np.array(v, dtype=np.int32) for k, v in self.parent.x_view_dict.items()}
-        self.parent.points_per_cell = {k: np.array(v, dtype=np.int32) for k, v in self.parent.points_per_cell.items()}
-
-        self.finish_work()
-
-    def finish_work(self):
-        self.parent.foreground_points = sorted(self.parent.foreground_points, key=lambda x: x[-1])
-        current_tab = self.parent.tab_widget.currentWidget()
-        #if self.parent.data_per_tab[current_tab].get("foreground_points") is not None:
-        self.parent.data_per_tab[current_tab]["points_per_cell"] = self.parent.points_per_cell
-        self.parent.data_per_tab[current_tab]["foreground_points"] = self.parent.foreground_points
-        self.parent.data_per_tab[current_tab]["z_view_dict"] = self.parent.z_view_dict
-        self.parent.data_per_tab[current_tab]["y_view_dict"] = self.parent.y_view_dict
-        self.parent.data_per_tab[current_tab]["x_view_dict"] = self.parent.x_view_dict
+            mask = np.asarray(mask[:]) - mask.min()
+        label_store = self.build_label_store(mask)
+        self.finish_work(label_store)
+
+    def finish_work(self, label_store):
+        self.parent.background_points = []
+        # Goes to the document of the current tab
+        self.parent.label_store = label_store
         self.parent.current_highest_cell_index = self.parent.index_control.cell_index
         self.finished.emit()
 
@@ -386,6 +261,130 @@ class MaskLoader(QThread):
     def on_user_answer(self, answer):
         self.continue_work(answer)
 
+class LoadCancelled(Exception):
+    pass
+
+
+class MaskSaver(QThread):
+    # Writes the label store to disk off the GUI thread, plane by plane.
+    # Edits made while saving may be only partly included, edited tells
+    # whether there were any.
+    progress = pyqtSignal(int)
+    error_signal = pyqtSignal(str, str)
+
+    def __init__(self, label_store, filename, parent=None):
+        super().__init__(parent)
+        self.label_store = label_store
+        self.filename = filename
+        self.edited = False
+        self.failed = False
+        self.percent = -1
+        # Label store version the file was written from
+        self.version = label_store.version
+
+    def report(self, fraction):
+        percent = int(100 * fraction)
+        if percent != self.percent:
+            self.percent = percent
+            self.progress.emit(percent)
+
+    def run(self):
+        self.version = self.label_store.version
+        try:
+            save_label_store(self.label_store, self.filename, self.report)
+        except Exception as e:
+            self.failed = True
+            self.error_signal.emit("Error", f"Failed to save file:\n{e}")
+        self.edited = self.label_store.version != self.version
+
+
+class ImageLoader(QThread):
+    # Decodes an image and applies the auto-contrast off the GUI thread.
+    # volume_ready is emitted as soon as the contrast is known, with a volume
+    # that stretches each slice when it is viewed, and once more with the
+    # finished uint8 volume. Memory-mapped files only get the first. The flag
+    # tells whether the volume is the final one.
+    progress = pyqtSignal(int)
+    volume_ready = pyqtSignal(object, bool)
+    error_signal = pyqtSignal(str, str)
+
+    def __init__(self, filename, lazy_loading=True, parent=None):
+        super().__init__(parent)
+        self.filename = filename
+        self.lazy_loading = lazy_loading
+        # Tab showing the volume, set by the main window on the first volume_ready
+        self.tab = None
+        self.cancelled = False
+
+    def cancel(self):
+        # Unlike isInterruptionRequested, the flag still reads True once the thread has finished
+        self.cancelled = True
+
+    def report(self, fraction):
+        # Also the point where a cancelled load stops
+        if self.cancelled:
+            raise LoadCancelled()
+        self.progress.emit(int(100 * fraction))
+
+    def run(self):
+        try:
+            raw, lazy = self.decode(progress_range(self.report, 0, 0.4))
+            message = self.validate(raw)
+            if message is not None:
+                self.error_signal.emit("Invalid Image", message)
+                return
+            if lazy:
+                self.volume_ready.emit(LazyVolume(raw), True)
+                return
+            contrast = saturated_range(raw, progress=progress_range(self.report, 0.4, 0.6))
+            self.volume_ready.emit(LazyVolume(raw, contrast=contrast), False)
+            self.volume_ready.emit(apply_contrast(raw, *contrast, progress=progress_range(self.report, 0.6, 1)), True)
+        except LoadCancelled:
+            return
+        except Exception as e:
+            self.error_signal.emit("Error", f"Failed to load file:\n{e}")
+
+    def decode(self, progress):
+        # Returns (raw volume, memory-mapped). Files that can be mapped but are
+        # too small for lazy loading are copied out of the map chunk by chunk.
+        ext = os.path.splitext(self.filename)[1].lower()
+        raw = None
+        if ext in ('.npy', '.tif', '.tiff'):
+            try:
+                raw = open_memmap(self.filename)
+            except Exception:
+                # Pickled or malformed files are left to the regular readers below
+                raw = None
+        if raw is not None and self.lazy_loading and os.path.getsize(self.filename) >= LAZY_LOAD_MIN_BYTES:
+            return raw, True
+        if raw is not None:
+            image_data = np.empty(raw.shape, dtype=raw.dtype.newbyteorder('='))
+            step = max(1, len(image_data) // 100)
+            for start in range(0, len(image_data), step):
+                image_data[start:start + step] = raw[start:start + step]
+                progress(min(start + step, len(image_data)) / len(image_data))
+            return image_data, False
+        if ext == '.npy':
+            image_data = np.load(self.filename)
+        else:
+            image_data = iio.imread(self.filename)
+        progress(1.0)
+        return image_data, False
+
+    def validate(self, image_data):
+        shape = image_data.shape
+        if len(shape) == 3:
+            if shape[-1] in [3, 4] and np.issubdtype(image_data.dtype, np.integer):
+                return "The image appears to be a 2D color image, but a greyscale 3D volume is required."
+        elif len(shape) == 4:
+            # Shape might be (T, Z, Y, X) or (Z, Y, X, C)
+            if shape[-1] in [3, 4] and np.issubdtype(image_data.dtype, np.integer):
+                return "The image appears to be a 3D color stack, but a single-channel 3D volume is required."
+        elif len(shape) < 3:
+            return "Image must be at least 3D."
+        return None
+
+
 class Estimating_Cell_Thresholds(QThread):
     finished = pyqtSignal()  # Signal to indicate the task is finished
     progress = pyqtSignal(int)  # Signal to indicate progress (optional)
@@ -452,10 +451,10 @@ class IndexControlWidget(QWidget):
         self.repaint()
 
     def increase_index(self):
-        if len(self.main_window.points_per_cell) == 0:
+        label_store = self.main_window.label_store
+        if label_store is None or len(label_store.label_counts) == 0:
             return
-        pts_now = self.main_window.points_per_cell.get(self.cell_index)
-        if pts_now is not None:
+        if label_store.has_label(self.cell_index):
             self.cell_index += 1
             self.index_label.setText(str(self.cell_index))
             self.repaint()
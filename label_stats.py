@@ -0,0 +1,280 @@
+import numpy as np
+from scipy.ndimage import find_objects
+
+# Blocks with larger labels are renumbered before find_objects, whose
+# result has one entry per label value
+MAX_FIND_OBJECTS_LABEL = 1 << 24
+# Point coordinates (x=0, y=1, z=2) of the fixed index, the rows and the
+# columns of a slice of each view plane, see LabelStore.get_slice
+SLICE_AXES = {"XY": (2, 1, 0), "XZ": (1, 0, 2), "YZ": (0, 1, 2)}
+
+
+def label_bounds(block, z0, y0, x0):
+    # (labels, lows, highs) of the labels in a (Z, Y, X) box of labels at
+    # (z0, y0, x0), lows and highs being (N, 3) inclusive (x, y, z) bounds.
+    # One find_objects pass, cheap enough to run on every loaded block.
+    max_label = int(block.max()) if block.size > 0 else 0
+    if max_label == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+    if max_label < MAX_FIND_OBJECTS_LABEL:
+        values = None
+        objects = find_objects(block, max_label)
+    else:
+        values, inverse = np.unique(block, return_inverse=True)
+        if values[0] != 0:
+            values = np.concatenate(([0], values))
+            inverse += 1
+        objects = find_objects(inverse.reshape(block.shape))
+    present = [i for i, box in enumerate(objects) if box is not None]
+    bounds = np.array([[box[2].start, box[1].start, box[0].start, box[2].stop, box[1].stop, box[0].stop]
+                       for box in (objects[i] for i in present)], dtype=np.int64).reshape(-1, 6)
+    origin = np.array([x0, y0, z0], dtype=np.int64)
+    labels = np.array(present, dtype=np.int64) + 1
+    if values is not None:
+        labels = values[labels].astype(np.int64)
+    return labels, bounds[:, :3] + origin, bounds[:, 3:] - 1 + origin
+
+
+class LabelStats:
+    # Per label statistics of a LabelStore: coordinate sums for the centroid,
+    # voxel counts per x, y and z coordinate with the running lowest and
+    # highest coordinate for the bounding box, and the row and column extents
+    # of the label within single slices. Every edit and load of the store
+    # updates the entries of the labels it touches, so queries never scan the
+    # volume. A bound only moves when the count of its coordinate drops to
+    # zero. Slice extents are only kept for slices that were asked about,
+    # erasing in a slice drops its extents until they are asked for again.
+    # Bulk loads only record the bounds of the labels of every loaded block,
+    # see added_bounds. Sums and coordinate counts of a loaded label are
+    # counted within its bounding box the first time they are needed.
+
+    def __init__(self, label_store):
+        self.label_store = label_store
+        self.entries = {}
+        # (labels, lows, highs) of loaded blocks not merged into entries yet
+        self.pending = []
+
+    def clear(self):
+        self.entries = {}
+        self.pending = []
+
+    def discard(self, label):
+        self.flush()
+        self.entries.pop(int(label), None)
+
+    def copy(self, label_store):
+        self.flush()
+        other = LabelStats(label_store)
+        for label, entry in self.entries.items():
+            complete = entry["sums"] is not None
+            other.entries[label] = {"sums": entry["sums"].copy() if complete else None,
+                                    "axis_counts": tuple(dict(counts) for counts in entry["axis_counts"])
+                                    if complete else None,
+                                    "low": list(entry["low"]), "high": list(entry["high"]),
+                                    "slices": dict(entry["slices"])}
+        return other
+
+    def added_bounds(self, labels, lows, highs):
+        # Bounds of the labels of a freshly loaded block, see label_bounds
+        if len(labels) > 0:
+            self.pending.append((labels, lows, highs))
+
+    def flush(self):
+        # Merges the bounds recorded by added_bounds, all blocks at once
+        if not self.pending:
+            return
+        labels = np.concatenate([pending[0] for pending in self.pending])
+        lows = np.concatenate([pending[1] for pending in self.pending])
+        highs = np.concatenate([pending[2] for pending in self.pending])
+        self.pending = []
+        order = np.argsort(labels, kind="stable")
+        labels, lows, highs = labels[order], lows[order], highs[order]
+        starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+        lows = np.minimum.reduceat(lows, starts, axis=0).tolist()
+        highs = np.maximum.reduceat(highs, starts, axis=0).tolist()
+        for label, low, high in zip(labels[starts].tolist(), lows, highs):
+            entry = self.entries.get(label)
+            if entry is None:
+                self.entries[label] = {"sums": None, "axis_counts": None, "low": low, "high": high, "slices": {}}
+                continue
+            entry["low"] = [min(a, b) for a, b in zip(entry["low"], low)]
+            entry["high"] = [max(a, b) for a, b in zip(entry["high"], high)]
+            entry["sums"] = entry["axis_counts"] = None
+            entry["slices"] = {}
+
+    def entry(self, label, complete=True):
+        # Entry of label, None if it has no voxels. complete counts the voxels
+        # of a loaded label within its bounding box if that was not done yet.
+        self.flush()
+        label = int(label)
+        entry = self.entries.get(label)
+        if entry is not None and complete and entry["sums"] is None:
+            low, high = entry["low"], entry["high"]
+            box = self.label_store._read_box(low[2], low[1], low[0],
+                                             tuple(h - l + 1 for l, h in zip(low[::-1], high[::-1])))
+            z, y, x = np.nonzero(box == label)
+            points = np.column_stack((x, y, z)) + low
+            entry["sums"] = points.sum(axis=0).astype(float)
+            entry["axis_counts"] = tuple(dict(zip(*(a.tolist() for a in np.unique(points[:, axis], return_counts=True))))
+                                         for axis in range(3))
+        return entry
+
+    def added(self, label, points):
+        # points: (N, 3) voxels newly painted with label
+        self.added_labelled(points, np.full(len(points), int(label)))
+
+    def added_labelled(self, points, labels):
+        # points: (N, 3) voxels newly painted, labels: (N,) their labels
+        if len(labels) == 0:
+            return
+        self.flush()
+        order = np.argsort(labels, kind="stable")
+        points, labels = points[order], labels[order]
+        starts = np.flatnonzero(np.concatenate(([True], labels[1:] != labels[:-1])))
+        group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(labels))))
+        tables = []
+        for axis in range(3):
+            span = int(points[:, axis].max()) + 1
+            keys, counts = np.unique(group * span + points[:, axis], return_counts=True)
+            tables.append((keys // span, keys % span, counts))
+        self.merge(labels[starts], tables, points, starts)
+
+    def merge(self, labels, tables, points, starts):
+        # Adds voxels to the entries of labels. tables holds for the x, y and z
+        # axis the (group, coordinate, count) of the voxels per label and
+        # coordinate, sorted by group, the index into labels, and coordinate.
+        # points and starts are the voxels grouped by label, to extend the
+        # slice extents.
+        sums, lows, highs, axis_counts = [], [], [], []
+        for group, coords, counts in tables:
+            bounds = np.searchsorted(group, np.arange(len(labels) + 1))
+            sums.append(np.bincount(group, weights=coords * counts, minlength=len(labels)))
+            lows.append(coords[bounds[:-1]])
+            highs.append(coords[bounds[1:] - 1])
+            axis_counts.append((coords.tolist(), counts.tolist(), bounds.tolist()))
+        sums = np.column_stack(sums)
+        lows, highs = np.column_stack(lows).tolist(), np.column_stack(highs).tolist()
+        for i, label in enumerate(labels.tolist()):
+            entry = self.entries.get(label)
+            if entry is None:
+                self.entries[label] = {"sums": sums[i], "low": lows[i], "high": highs[i], "slices": {},
+                                       "axis_counts": tuple(dict(zip(coords[bounds[i]:bounds[i + 1]],
+                                                                     counts[bounds[i]:bounds[i + 1]]))
+                                                            for coords, counts, bounds in axis_counts)}
+                continue
+            entry["low"] = [min(a, b) for a, b in zip(entry["low"], lows[i])]
+            entry["high"] = [max(a, b) for a, b in zip(entry["high"], highs[i])]
+            if entry["sums"] is None:
+                # Counted from the store once needed, the new voxels included
+                continue
+            entry["sums"] += sums[i]
+            for counts_of_axis, (coords, counts, bounds) in zip(entry["axis_counts"], axis_counts):
+                for coord, count in zip(coords[bounds[i]:bounds[i + 1]], counts[bounds[i]:bounds[i + 1]]):
+                    counts_of_axis[coord] = counts_of_axis.get(coord, 0) + count
+            if not entry["slices"]:
+                continue
+            end = starts[i + 1] if i + 1 < len(starts) else len(points)
+            slices = entry["slices"]
+            label_points = points[starts[i]:end]
+            for (view_plane, index), extent in list(slices.items()):
+                fixed, row, col = SLICE_AXES[view_plane]
+                in_slice = label_points[label_points[:, fixed] == index]
+                if len(in_slice) > 0:
+                    rows, cols = in_slice[:, row], in_slice[:, col]
+                    slices[view_plane, index] = (min(extent[0], int(rows.min())), max(extent[1], int(rows.max())),
+                                                 min(extent[2], int(cols.min())), max(extent[3], int(cols.max())))
+
+    def removed(self, label, points):
+        # points: (N, 3) voxels of label that were erased
+        entry = self.entry(label, complete=False)
+        if entry is None or len(points) == 0:
+            return
+        if entry["sums"] is None:
+            # Counted from the store, which no longer has the erased voxels
+            entry = self.entry(label)
+            for axis, axis_counts in enumerate(entry["axis_counts"]):
+                entry["low"][axis], entry["high"][axis] = min(axis_counts), max(axis_counts)
+            return
+        entry["sums"] -= points.sum(axis=0)
+        for axis, axis_counts in enumerate(entry["axis_counts"]):
+            values, counts = np.unique(points[:, axis], return_counts=True)
+            for value, count in zip(values.tolist(), counts.tolist()):
+                remaining = axis_counts[value] - count
+                if remaining > 0:
+                    axis_counts[value] = remaining
+                else:
+                    axis_counts.pop(value)
+            if len(axis_counts) == 0:
+                continue
+            # Bounds walk inwards to the next coordinate the label still has
+            low, high = entry["low"][axis], entry["high"][axis]
+            while low not in axis_counts:
+                low += 1
+            while high not in axis_counts:
+                high -= 1
+            entry["low"][axis], entry["high"][axis] = low, high
+        slices = entry["slices"]
+        for view_plane, (fixed, _, _) in SLICE_AXES.items():
+            for index in np.unique(points[:, fixed]).tolist():
+                slices.pop((view_plane, index), None)
+
+    def count(self, label):
+        return self.label_store.label_counts.get(int(label), 0)
+
+    def centroid(self, label):
+        # Mean (x, y, z) of the voxels of label, None if it has none
+        entry = self.entry(label)
+        if entry is None:
+            return None
+        return entry["sums"] / self.count(label)
+
+    def bounding_box(self, label):
+        # ((x_min, y_min, z_min), (x_max, y_max, z_max)) inclusive, None if label has no voxels
+        entry = self.entry(label, complete=False)
+        if entry is None:
+            return None
+        return tuple(entry["low"]), tuple(entry["high"])
+
+    def nearest_point(self, label):
+        # Voxel (x, y, z) of label nearest its centroid, which for concave or
+        # ring shaped cells lies outside the cell. Searched in a cube around
+        # the centroid that doubles until it holds a voxel that no voxel outside
+        # of it can be nearer than, or covers the bounding box.
+        entry = self.entry(label)
+        if entry is None:
+            return None
+        centroid = self.centroid(label)
+        low, high = np.array(entry["low"]), np.array(entry["high"])
+        center = np.clip(np.round(centroid).astype(int), low, high)
+        radius = 1
+        while True:
+            start = np.maximum(center - radius, low)
+            stop = np.minimum(center + radius, high) + 1
+            box = self.label_store._read_box(start[2], start[1], start[0], tuple((stop - start)[::-1].tolist()))
+            z, y, x = np.nonzero(box == int(label))
+            if len(z) > 0:
+                points = np.column_stack((x, y, z)) + start
+                distances = np.linalg.norm(points - centroid, axis=1)
+                nearest = int(np.argmin(distances))
+                covers = (start == low).all() and (stop == high + 1).all()
+                # The cube is centred on the rounded centroid, half a voxel off at most
+                if distances[nearest] <= radius - 1 or covers:
+                    return tuple(points[nearest].tolist())
+            radius *= 2
+
+    def slice_extent(self, view_plane, index, label):
+        # (row_min, row_max, col_min, col_max) of label within one slice, None
+        # if the slice does not cross it
+        entry = self.entry(label)
+        if entry is None:
+            return None
+        fixed = SLICE_AXES[view_plane][0]
+        index = int(index)
+        if index not in entry["axis_counts"][fixed]:
+            return None
+        extent = entry["slices"].get((view_plane, index))
+        if extent is None:
+            rows, cols = np.nonzero(self.label_store.get_slice(view_plane, index) == int(label))
+            extent = (int(rows.min()), int(rows.max()), int(cols.min()), int(cols.max()))
+            entry["slices"][view_plane, index] = extent
+        return extent
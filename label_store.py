@@ -0,0 +1,608 @@
+import itertools
+
+import numpy as np
+
+from label_stats import LabelStats, label_bounds
+
+VIEW_PLANES = ("XY", "XZ", "YZ")
+CHUNK_SIZE = 64
+# Label volumes larger than this are kept in a ChunkedLabelStore
+DENSE_STORE_LIMIT_BYTES = 1 << 30
+# Labels are counted with np.bincount below this value, np.unique above
+MAX_BINCOUNT_LABEL = 1 << 24
+# Edge length of the blocks edits are tracked in for autosave.py
+DIRTY_BLOCK_SIZE = CHUNK_SIZE
+
+
+def count_labels(labels):
+    # Returns (values, counts) of the positive labels in labels
+    labels = labels[labels > 0]
+    if labels.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if labels.max() < MAX_BINCOUNT_LABEL:
+        counts = np.bincount(labels.ravel())
+        values = np.flatnonzero(counts)
+        return values, counts[values]
+    return np.unique(labels, return_counts=True)
+
+
+def clip_labels(block, dtype):
+    # Everything at or below zero is background
+    if np.issubdtype(block.dtype, np.signedinteger) or np.issubdtype(block.dtype, np.floating):
+        block = np.where(block > 0, block, 0)
+    return block.astype(dtype, copy=False)
+
+
+class LabelStore:
+    # Holds all annotations of one image volume, 0 being background.
+    # Coordinates going in and out are (N, 3) arrays in (x, y, z) order, like
+    # the point tuples used by the views. Slices are returned in the same
+    # orientation as get_flat_image_view.
+    # Subclasses provide the storage through _get_values/_set_values,
+    # which take flattened (z, y, x) voxel indices, and _get_value for a
+    # single voxel.
+
+    def __init__(self, shape, dtype=np.uint16):
+        self.shape = tuple(shape[:3])
+        self.dtype = np.dtype(dtype)
+        self.label_counts = {}
+        # Largest label in label_counts, 0 without labels
+        self.highest_label = 0
+        # Centroids, bounding boxes and slice extents of the labels
+        self.stats = LabelStats(self)
+        # Bumped on every edit, lets views tell whether their overlay is stale
+        self.version = 0
+        # Linear indices of the DIRTY_BLOCK_SIZE^3 blocks edited since the last take_dirty_blocks
+        self.block_grid_shape = tuple(-(-dim // DIRTY_BLOCK_SIZE) for dim in self.shape)
+        self.dirty_blocks = set()
+        # Blocks that may hold labels. Painting adds to it, a checkpoint that
+        # finds a block empty takes it out again, so it can be a superset.
+        self.label_blocks = set()
+
+    def _ensure_dtype(self, label):
+        if label > np.iinfo(self.dtype).max:
+            self.dtype = np.dtype(np.uint32)
+            self._upgrade_dtype()
+
+    def _in_bounds(self, coords):
+        z_dim, y_dim, x_dim = self.shape
+        if coords.size == 0 or (coords.min() >= 0 and (coords.max(axis=0) < (x_dim, y_dim, z_dim)).all()):
+            return coords
+        keep = (coords >= 0).all(axis=1) \
+            & (coords[:, 0] < x_dim) \
+            & (coords[:, 1] < y_dim) \
+            & (coords[:, 2] < z_dim)
+        return coords[keep]
+
+    def _as_coords(self, coords):
+        coords = np.asarray(coords, dtype=np.intp).reshape(-1, 3)
+        return self._in_bounds(coords)
+
+    def _bounds_mask(self, coords):
+        z_dim, y_dim, x_dim = self.shape
+        return (coords >= 0).all(axis=1) \
+            & (coords[:, 0] < x_dim) \
+            & (coords[:, 1] < y_dim) \
+            & (coords[:, 2] < z_dim)
+
+    def slice_to_coords(self, view_plane, index, rows, cols):
+        # Maps (row, col) positions of a slice back to (x, y, z) coordinates
+        fixed = np.full(len(rows), index, dtype=np.intp)
+        if view_plane == "XY":
+            return np.column_stack((cols, rows, fixed))
+        elif view_plane == "XZ":
+            return np.column_stack((rows, fixed, cols))
+        elif view_plane == "YZ":
+            return np.column_stack((fixed, rows, cols))
+        raise ValueError("Invalid viewplane. Choose among 'XY', 'XZ', 'YZ'")
+
+    def label_at(self, point):
+        # Label of one (x, y, z) voxel, 0 for background and points outside the volume
+        x, y, z = (int(v) for v in point)
+        if not (0 <= z < self.shape[0] and 0 <= y < self.shape[1] and 0 <= x < self.shape[2]):
+            return 0
+        return int(self._get_value(z, y, x))
+
+    def points_in_slice(self, view_plane, index, label):
+        rows, cols = np.nonzero(self.get_slice(view_plane, index) == label)
+        return self.slice_to_coords(view_plane, index, rows, cols)
+
+    def linear_indices(self, coords):
+        # Flattened (z, y, x) voxel index, used as the membership key
+        return np.ravel_multi_index((coords[:, 2], coords[:, 1], coords[:, 0]), self.shape)
+
+    def unique_linear_indices(self, coords):
+        # Sort based dedup, np.unique is considerably slower on large strokes
+        lin = np.sort(self.linear_indices(coords))
+        keep = np.ones(len(lin), dtype=bool)
+        keep[1:] = lin[1:] != lin[:-1]
+        return lin[keep]
+
+    def coords_from_linear(self, lin):
+        z, y, x = np.unravel_index(lin, self.shape)
+        return np.column_stack((x, y, z))
+
+    def add_points(self, coords, label):
+        # Only unoccupied voxels are painted, which keeps annotations dense
+        # without one cell overwriting another. Occupancy is looked up per
+        # stroke voxel, so the cost does not grow with the painted slice.
+        label = int(label)
+        coords = self._as_coords(coords)
+        if coords.size == 0 or label <= 0:
+            return coords[:0]
+        self._ensure_dtype(label)
+        lin = self.unique_linear_indices(coords)
+        lin = lin[self._get_values(lin) == 0]
+        if lin.size == 0:
+            return coords[:0]
+        self._set_values(lin, label)
+        self._mark_dirty(lin, labelled=True)
+        self.label_counts[label] = self.label_counts.get(label, 0) + len(lin)
+        self.highest_label = max(self.highest_label, label)
+        self.version += 1
+        coords = self.coords_from_linear(lin)
+        self.stats.added(label, coords)
+        return coords
+
+    def remove_points(self, coords, label):
+        # Only voxels carrying the given label are erased.
+        label = int(label)
+        coords = self._as_coords(coords)
+        if coords.size == 0 or label not in self.label_counts:
+            return coords[:0]
+        lin = self.unique_linear_indices(coords)
+        lin = lin[self._get_values(lin) == label]
+        if lin.size == 0:
+            return coords[:0]
+        self._set_values(lin, 0)
+        self._mark_dirty(lin)
+        self._decrease_count(label, len(lin))
+        self.version += 1
+        coords = self.coords_from_linear(lin)
+        self.stats.removed(label, coords)
+        return coords
+
+    def add_labelled_points(self, coords, labels):
+        # Like add_points with one label per coordinate, for importing whole
+        # segmentations in a single write. Where coordinates repeat the first
+        # one wins, voxels that are already painted are kept.
+        coords = np.asarray(coords, dtype=np.intp).reshape(-1, 3)
+        labels = np.asarray(labels).reshape(-1)
+        keep = (labels > 0) & self._bounds_mask(coords)
+        coords, labels = coords[keep], labels[keep]
+        if len(labels) == 0:
+            return
+        self._ensure_dtype(int(labels.max()))
+        lin = self.linear_indices(coords)
+        order = np.argsort(lin, kind="stable")
+        lin, labels = lin[order], labels[order]
+        first = np.ones(len(lin), dtype=bool)
+        first[1:] = lin[1:] != lin[:-1]
+        lin, labels = lin[first], labels[first]
+        free = self._get_values(lin) == 0
+        lin, labels = lin[free], labels[free].astype(self.dtype)
+        if lin.size == 0:
+            return
+        self._set_values(lin, labels)
+        self._mark_dirty(lin, labelled=True)
+        self._count_labels(labels)
+        self.version += 1
+        self.stats.added_labelled(self.coords_from_linear(lin), labels)
+
+    def _count_labels(self, labels):
+        # Adds the occurrences of every positive label in labels to label_counts
+        self._add_counts(*count_labels(labels))
+
+    def _add_counts(self, values, counts):
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.label_counts[value] = self.label_counts.get(value, 0) + count
+        if len(values) > 0:
+            self.highest_label = max(self.highest_label, int(np.max(values)))
+
+    def _mark_dirty(self, lin, labelled=False):
+        # labelled when lin were painted rather than erased
+        z, y, x = np.unravel_index(lin, self.shape)
+        b = DIRTY_BLOCK_SIZE
+        keys = np.unique(np.ravel_multi_index((z // b, y // b, x // b), self.block_grid_shape)).tolist()
+        self.dirty_blocks.update(keys)
+        if labelled:
+            self.label_blocks.update(keys)
+
+    def _mark_loaded(self, block, z0, y0, x0):
+        # Adds the labels of a box of freshly loaded labels at (z0, y0, x0) to
+        # the statistics and marks the blocks their bounding boxes overlap,
+        # which takes no second pass over the labels. For compact cells these
+        # are the blocks holding labels, otherwise a superset, see label_blocks.
+        labels, lows, highs = label_bounds(block, z0, y0, x0)
+        self.stats.added_bounds(labels, lows, highs)
+        self._mark_boxes(lows, highs)
+
+    def _mark_chunks(self, chunk_keys, chunk_size):
+        # Marks the blocks overlapped by the chunk_size^3 chunks chunk_keys of
+        # freshly loaded labels, chunks known to hold labels
+        grid_shape = tuple(-(-dim // chunk_size) for dim in self.shape)
+        origins = np.column_stack(np.unravel_index(np.asarray(chunk_keys, dtype=np.intp), grid_shape)) * chunk_size
+        ends = np.minimum(origins + chunk_size, self.shape) - 1
+        self._mark_boxes(origins[:, ::-1], ends[:, ::-1])
+
+    def _mark_boxes(self, lows, highs):
+        # Marks the blocks overlapped by the inclusive (x, y, z) boxes lows to
+        # highs as dirty and holding labels
+        b = DIRTY_BLOCK_SIZE
+        keys = set()
+        for x0, y0, z0, x1, y1, z1 in np.unique(np.column_stack((lows // b, highs // b)), axis=0).tolist():
+            for grid_pos in itertools.product(range(z0, z1 + 1), range(y0, y1 + 1), range(x0, x1 + 1)):
+                keys.add(int(np.ravel_multi_index(grid_pos, self.block_grid_shape)))
+        self.dirty_blocks |= keys
+        self.label_blocks |= keys
+
+    def take_dirty_blocks(self):
+        dirty_blocks, self.dirty_blocks = self.dirty_blocks, set()
+        return dirty_blocks
+
+    def block_origin(self, key):
+        grid_pos = np.unravel_index(key, self.block_grid_shape)
+        return tuple(int(p) * DIRTY_BLOCK_SIZE for p in grid_pos)
+
+    def read_block(self, key):
+        # Copy of one dirty tracking block, None if it holds no labels
+        z0, y0, x0 = self.block_origin(key)
+        block = self._read_box(z0, y0, x0, (DIRTY_BLOCK_SIZE,) * 3)
+        if not block.any():
+            return None
+        return block
+
+    def _prepare_array(self, labels, max_label=None):
+        # Checks the shape, clears the counts and picks the dtype for load_array
+        if tuple(labels.shape) != self.shape:
+            raise ValueError("Label volume shape %s does not match %s" % (labels.shape, self.shape))
+        self.label_counts = {}
+        self.highest_label = 0
+        self.stats.clear()
+        self.version += 1
+        # Blocks that held labels are cleared, the load marks the blocks it fills
+        self.dirty_blocks |= self.label_blocks
+        self.label_blocks = set()
+        if max_label is None and labels.size > 0:
+            max_label = int(labels.max())
+        if max_label is not None:
+            self._ensure_dtype(max_label)
+
+    def _clip_block(self, block):
+        return clip_labels(block, self.dtype)
+
+    def _decrease_count(self, label, amount):
+        remaining = self.label_counts[label] - amount
+        if remaining > 0:
+            self.label_counts[label] = remaining
+        else:
+            self._drop_label(label)
+
+    def _drop_label(self, label):
+        self.label_counts.pop(label)
+        self.stats.discard(label)
+        if label == self.highest_label:
+            self.highest_label = max(self.label_counts.keys(), default=0)
+
+    def has_label(self, label):
+        return int(label) in self.label_counts
+
+    def resident_bytes(self):
+        # Memory held by the labels, counted against the tab memory budget
+        return 0
+
+    def copy(self):
+        # Independent store with the same labels, all blocks holding labels dirty
+        other = type(self).__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.label_counts = dict(self.label_counts)
+        other.stats = self.stats.copy(other)
+        other.label_blocks = set(self.label_blocks)
+        other.dirty_blocks = set(self.label_blocks)
+        return other
+
+    def spill(self, filename):
+        # Moves the labels to a memory-mapped file, see TabDocument.spill
+        pass
+
+    def unspill(self):
+        pass
+
+    def max_label(self):
+        return self.highest_label
+
+
+class DenseLabelStore(LabelStore):
+    # One (Z, Y, X) label volume, slices are plain array views.
+
+    def __init__(self, shape, dtype=np.uint16):
+        super().__init__(shape, dtype)
+        self.labels = np.zeros(self.shape, dtype=self.dtype)
+        # Version the spill file was last in sync with, None before the first spill
+        self.spill_version = None
+        self.spill_file = None
+
+    def _upgrade_dtype(self):
+        self.labels = self.labels.astype(self.dtype)
+
+    def _get_values(self, lin):
+        return self.labels.reshape(-1)[lin]
+
+    def _set_values(self, lin, value):
+        self.labels.reshape(-1)[lin] = value
+
+    def _get_value(self, z, y, x):
+        return self.labels[z, y, x]
+
+    def get_slice(self, view_plane, index):
+        if view_plane == "XY":
+            return self.labels[index]
+        elif view_plane == "XZ":
+            return self.labels[:, index, :].T
+        elif view_plane == "YZ":
+            return self.labels[:, :, index].T
+        raise ValueError("Invalid viewplane. Choose among 'XY', 'XZ', 'YZ'")
+
+    def points_of_label(self, label):
+        z, y, x = np.nonzero(self.labels == label)
+        return np.column_stack((x, y, z))
+
+    def remove_label(self, label):
+        label = int(label)
+        if label not in self.label_counts:
+            return
+        lin = np.flatnonzero(self.labels == label)
+        self.labels.reshape(-1)[lin] = 0
+        self._mark_dirty(lin)
+        self._drop_label(label)
+        self.version += 1
+
+    def to_array(self):
+        return self.labels
+
+    def _read_box(self, z0, y0, x0, size):
+        # size: (Z, Y, X) of the box, clipped at the volume border
+        return self.labels[z0:z0 + size[0], y0:y0 + size[1], x0:x0 + size[2]].copy()
+
+    def resident_bytes(self):
+        return 0 if isinstance(self.labels, np.memmap) else self.labels.nbytes
+
+    def copy(self):
+        other = super().copy()
+        other.labels = np.array(self.labels)
+        other.spill_version = None
+        other.spill_file = None
+        return other
+
+    def spill(self, filename):
+        # The file is only rewritten when the labels changed since it was last
+        # in sync. Edits made while spilled go straight to the file.
+        if isinstance(self.labels, np.memmap):
+            return
+        if self.spill_file != filename or self.spill_version != self.version:
+            np.save(filename, self.labels)
+        self.spill_file = filename
+        self.labels = np.load(filename, mmap_mode="r+")
+
+    def unspill(self):
+        if isinstance(self.labels, np.memmap):
+            self.labels = np.array(self.labels)
+            self.spill_version = self.version
+
+    def load_array(self, labels):
+        # Replaces all annotations by a (Z, Y, X) label volume, copied in Z-slabs
+        self._prepare_array(labels)
+        self.labels = np.zeros(self.shape, dtype=self.dtype)
+        step = max(1, CHUNK_SIZE ** 3 // max(1, self.shape[1] * self.shape[2]))
+        for z_start in range(0, self.shape[0], step):
+            block = self._clip_block(np.asarray(labels[z_start:z_start + step]))
+            self.labels[z_start:z_start + step] = block
+            self._count_labels(block)
+            self._mark_loaded(block, z_start, 0, 0)
+
+    def load_clipped(self, labels, chunk_keys, bounds):
+        # Takes over a label volume already clipped to the store dtype without
+        # copying it, see parallel_import. chunk_keys are the CHUNK_SIZE^3
+        # chunks holding labels, bounds the label_bounds of the volume.
+        self.labels = labels.view(np.ndarray)
+        self.stats.added_bounds(*bounds)
+        self._mark_chunks(chunk_keys, CHUNK_SIZE)
+
+
+class ChunkedLabelStore(LabelStore):
+    # Block-sparse label volume made of CHUNK_SIZE^3 blocks which are only
+    # allocated on first write and dropped again once erased, so empty
+    # regions cost nothing. Blocks are keyed by their linear grid index.
+
+    def __init__(self, shape, dtype=np.uint16, chunk_size=CHUNK_SIZE):
+        super().__init__(shape, dtype)
+        self.chunk_size = chunk_size
+        self.grid_shape = tuple(-(-dim // chunk_size) for dim in self.shape)
+        self.chunks = {}
+
+    def _upgrade_dtype(self):
+        self.chunks = {k: v.astype(self.dtype) for k, v in self.chunks.items()}
+
+    def _chunk_origin(self, key):
+        grid_pos = np.unravel_index(key, self.grid_shape)
+        return tuple(int(p) * self.chunk_size for p in grid_pos)
+
+    def _new_chunk(self, key):
+        origin = self._chunk_origin(key)
+        chunk_shape = tuple(min(self.chunk_size, dim - o) for dim, o in zip(self.shape, origin))
+        chunk = np.zeros(chunk_shape, dtype=self.dtype)
+        self.chunks[key] = chunk
+        return chunk
+
+    def _group_by_chunk(self, lin):
+        # Yields (chunk key, local z, y, x indices, positions in lin)
+        if len(lin) == 0:
+            return
+        zyx = np.column_stack(np.unravel_index(lin, self.shape))
+        keys = np.ravel_multi_index(tuple((zyx // self.chunk_size).T), self.grid_shape)
+        local = zyx % self.chunk_size
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.diff(sorted_keys)) + 1
+        starts = np.concatenate(([0], starts))
+        ends = np.append(starts[1:], len(order))
+        for key, start, end in zip(sorted_keys[starts], starts, ends):
+            positions = order[start:end]
+            local_idx = local[positions]
+            yield int(key), (local_idx[:, 0], local_idx[:, 1], local_idx[:, 2]), positions
+
+    def _get_values(self, lin):
+        values = np.zeros(len(lin), dtype=self.dtype)
+        for key, local_idx, positions in self._group_by_chunk(lin):
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                values[positions] = chunk[local_idx]
+        return values
+
+    def _get_value(self, z, y, x):
+        size = self.chunk_size
+        key = ((z // size) * self.grid_shape[1] + y // size) * self.grid_shape[2] + x // size
+        chunk = self.chunks.get(key)
+        return 0 if chunk is None else chunk[z % size, y % size, x % size]
+
+    def _set_values(self, lin, value):
+        # value is one label for all voxels or an array with one label per voxel
+        per_voxel = np.ndim(value) > 0
+        for key, local_idx, positions in self._group_by_chunk(lin):
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                if not per_voxel and value == 0:
+                    continue
+                chunk = self._new_chunk(key)
+            chunk[local_idx] = value[positions] if per_voxel else value
+            if (per_voxel or value == 0) and not chunk.any():
+                del self.chunks[key]
+
+    def _chunks_in_plane(self, axis, index):
+        # Only the chunks intersecting the requested slice are visited
+        grid_ranges = [range(n) for n in self.grid_shape]
+        grid_ranges[axis] = [index // self.chunk_size]
+        _, grid_y, grid_x = self.grid_shape
+        for gz, gy, gx in itertools.product(*grid_ranges):
+            key = (gz * grid_y + gy) * grid_x + gx
+            chunk = self.chunks.get(key)
+            if chunk is not None:
+                yield self._chunk_origin(key), chunk
+
+    def get_slice(self, view_plane, index):
+        z_dim, y_dim, x_dim = self.shape
+        local = index % self.chunk_size
+        if view_plane == "XY":
+            out = np.zeros((y_dim, x_dim), dtype=self.dtype)
+            for (z0, y0, x0), chunk in self._chunks_in_plane(0, index):
+                out[y0:y0 + chunk.shape[1], x0:x0 + chunk.shape[2]] = chunk[local]
+            return out
+        elif view_plane == "XZ":
+            out = np.zeros((z_dim, x_dim), dtype=self.dtype)
+            for (z0, y0, x0), chunk in self._chunks_in_plane(1, index):
+                out[z0:z0 + chunk.shape[0], x0:x0 + chunk.shape[2]] = chunk[:, local, :]
+            return out.T
+        elif view_plane == "YZ":
+            out = np.zeros((z_dim, y_dim), dtype=self.dtype)
+            for (z0, y0, x0), chunk in self._chunks_in_plane(2, index):
+                out[z0:z0 + chunk.shape[0], y0:y0 + chunk.shape[1]] = chunk[:, :, local]
+            return out.T
+        raise ValueError("Invalid viewplane. Choose among 'XY', 'XZ', 'YZ'")
+
+    def points_of_label(self, label):
+        points = []
+        for key, chunk in self.chunks.items():
+            z, y, x = np.nonzero(chunk == label)
+            if z.size > 0:
+                z0, y0, x0 = self._chunk_origin(key)
+                points.append(np.column_stack((x + x0, y + y0, z + z0)))
+        if len(points) == 0:
+            return np.zeros((0, 3), dtype=np.intp)
+        return np.concatenate(points)
+
+    def remove_label(self, label):
+        label = int(label)
+        if label not in self.label_counts:
+            return
+        for key in list(self.chunks.keys()):
+            chunk = self.chunks[key]
+            hit = chunk == label
+            if not hit.any():
+                continue
+            chunk[hit] = 0
+            z, y, x = np.nonzero(hit)
+            z0, y0, x0 = self._chunk_origin(key)
+            self._mark_dirty(np.ravel_multi_index((z + z0, y + y0, x + x0), self.shape))
+            if not chunk.any():
+                del self.chunks[key]
+        self._drop_label(label)
+        self.version += 1
+
+    def load_array(self, labels):
+        # Replaces all annotations by a (Z, Y, X) label volume, only chunks holding labels are kept
+        self._prepare_array(labels)
+        self.chunks = {}
+        for key in range(int(np.prod(self.grid_shape))):
+            z0, y0, x0 = self._chunk_origin(key)
+            c = self.chunk_size
+            block = np.asarray(labels[z0:z0 + c, y0:y0 + c, x0:x0 + c])
+            if not (block > 0).any():
+                continue
+            block = self._clip_block(block)
+            self.chunks[key] = np.array(block, dtype=self.dtype)
+            self._count_labels(block)
+            self._mark_loaded(block, z0, y0, x0)
+
+    def load_clipped(self, labels, chunk_keys, bounds):
+        # Copies the chunks chunk_keys of a label volume already clipped to the
+        # store dtype, see parallel_import. bounds are the label_bounds of the volume.
+        self.chunks = {}
+        c = self.chunk_size
+        for key in chunk_keys:
+            z0, y0, x0 = self._chunk_origin(key)
+            self.chunks[key] = np.array(labels[z0:z0 + c, y0:y0 + c, x0:x0 + c], dtype=self.dtype)
+        self.stats.added_bounds(*bounds)
+        self._mark_chunks(chunk_keys, c)
+
+    def _read_box(self, z0, y0, x0, size):
+        # Assembled from the chunks overlapping the box
+        box_shape = tuple(min(n, dim - o) for n, dim, o in zip(size, self.shape, (z0, y0, x0)))
+        box = np.zeros(box_shape, dtype=self.dtype)
+        c = self.chunk_size
+        grid_ranges = [range(o // c, -(-(o + n) // c)) for o, n in zip((z0, y0, x0), box_shape)]
+        for grid_pos in itertools.product(*grid_ranges):
+            chunk = self.chunks.get(int(np.ravel_multi_index(grid_pos, self.grid_shape)))
+            if chunk is None:
+                continue
+            origin = [p * c for p in grid_pos]
+            src = tuple(slice(max(o, b) - o, min(o + n, b + m) - o)
+                        for o, n, b, m in zip(origin, chunk.shape, (z0, y0, x0), box_shape))
+            dst = tuple(slice(max(o, b) - b, min(o + n, b + m) - b)
+                        for o, n, b, m in zip(origin, chunk.shape, (z0, y0, x0), box_shape))
+            box[dst] = chunk[src]
+        return box
+
+    def resident_bytes(self):
+        # Chunks are small and only exist where there are labels, they are not spilled
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def copy(self):
+        other = super().copy()
+        other.chunks = {key: chunk.copy() for key, chunk in self.chunks.items()}
+        return other
+
+    def to_array(self):
+        labels = np.zeros(self.shape, dtype=self.dtype)
+        for key, chunk in self.chunks.items():
+            z0, y0, x0 = self._chunk_origin(key)
+            labels[z0:z0 + chunk.shape[0], y0:y0 + chunk.shape[1], x0:x0 + chunk.shape[2]] = chunk
+        return labels
+
+
+def create_label_store(shape, dtype=np.uint16):
+    # Dense storage is fastest, the chunked store keeps very large volumes
+    # from allocating a label array the size of the image up front.
+    n_bytes = int(np.prod(shape[:3], dtype=np.int64)) * np.dtype(dtype).itemsize
+    if n_bytes > DENSE_STORE_LIMIT_BYTES:
+        return ChunkedLabelStore(shape, dtype)
+    return DenseLabelStore(shape, dtype)
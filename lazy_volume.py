@@ -0,0 +1,193 @@
+import os
+import re
+import struct
+
+import numpy as np
+
+from contrast import sampled_saturated_range, stretch_to_uint8
+
+# Files at least this large are memory-mapped instead of read into memory
+LAZY_LOAD_MIN_BYTES = 256 << 20
+
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_TYPE_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 16: "Q", 17: "q", 18: "Q"}
+TIFF_SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+
+class LazyVolume:
+    # Read-only stand-in for the uint8 display volume of a memory-mapped file.
+    # Indexing decodes only the requested voxels from the raw volume and maps
+    # them to uint8 with the auto-contrast, through a LUT for 8 and 16 bit data.
+
+    def __init__(self, raw, saturated=0.35, contrast=None):
+        # contrast: (low, high, min_val, max_val) as returned by saturated_range,
+        # estimated from a sample of planes when not given
+        self.raw = raw
+        self.shape = tuple(raw.shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.uint8)
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        self.nbytes = self.size
+        if contrast is None:
+            contrast = sampled_saturated_range(raw, saturated)
+        low, high, self.min_val, self.max_val = contrast
+        self.lut = None
+        if np.dtype(raw.dtype).kind == "u" and np.dtype(raw.dtype).itemsize <= 2:
+            self.lut = stretch_to_uint8(np.arange(np.iinfo(raw.dtype).max + 1), self.min_val, self.max_val)
+        self.display_min = int(self.to_display(low))
+        self.display_max = int(self.to_display(high))
+
+    def to_display(self, values):
+        if self.lut is not None:
+            return self.lut[values]
+        return stretch_to_uint8(values, self.min_val, self.max_val)
+
+    def __getitem__(self, key):
+        return self.to_display(np.asarray(self.raw[key]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def min(self):
+        return self.display_min
+
+    def max(self):
+        return self.display_max
+
+
+class TiffPageStack:
+    # (Z, Y, X[, C]) array-like over the pages of a TIFF whose pages are not
+    # evenly spaced in the file. Every page is its own view of the file map and
+    # only the pages an index touches are read.
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.shape = (len(pages),) + pages[0].shape
+        self.dtype = pages[0].dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        page_key, rest = key[0], key[1:]
+        if isinstance(page_key, (int, np.integer)):
+            return self.pages[page_key][rest]
+        if isinstance(page_key, slice):
+            indices = range(self.shape[0])[page_key]
+        else:
+            indices = np.arange(self.shape[0])[page_key]
+        return np.stack([self.pages[i][rest] for i in indices])
+
+
+def read_tiff_pages(data):
+    # Yields the tags of every IFD as {tag: tuple of values}, ASCII tags as str
+    if bytes(data[:2]) == b"II":
+        order = "<"
+    elif bytes(data[:2]) == b"MM":
+        order = ">"
+    else:
+        raise ValueError("Not a TIFF file")
+    magic = struct.unpack(order + "H", data[2:4])[0]
+    if magic == 42:
+        count_format, entry_size, offset_format = "H", 12, "I"
+        ifd_offset = struct.unpack(order + "I", data[4:8])[0]
+    elif magic == 43:
+        count_format, entry_size, offset_format = "Q", 20, "Q"
+        ifd_offset = struct.unpack(order + "Q", data[8:16])[0]
+    else:
+        raise ValueError("Not a TIFF file")
+    count_size = struct.calcsize(count_format)
+    offset_size = struct.calcsize(offset_format)
+    seen = set()
+    while ifd_offset and ifd_offset not in seen:
+        seen.add(ifd_offset)
+        n_entries = struct.unpack(order + count_format, data[ifd_offset:ifd_offset + count_size])[0]
+        tags = {}
+        for i in range(n_entries):
+            entry = ifd_offset + count_size + i * entry_size
+            tag, value_type = struct.unpack(order + "HH", data[entry:entry + 4])
+            count = struct.unpack(order + offset_format, data[entry + 4:entry + 4 + offset_size])[0]
+            value_start = entry + 4 + offset_size
+            n_bytes = count * TIFF_TYPE_SIZES.get(value_type, 1)
+            if n_bytes > offset_size:
+                value_start = struct.unpack(order + offset_format, data[value_start:value_start + offset_size])[0]
+            raw_value = bytes(data[value_start:value_start + n_bytes])
+            if value_type == 2:
+                tags[tag] = raw_value.rstrip(b"\0").decode("latin-1")
+            elif value_type in TIFF_TYPE_FORMATS:
+                tags[tag] = struct.unpack(order + TIFF_TYPE_FORMATS[value_type] * count, raw_value)
+        next_offset = ifd_offset + count_size + n_entries * entry_size
+        ifd_offset = struct.unpack(order + offset_format, data[next_offset:next_offset + offset_size])[0]
+        yield order, tags
+
+
+def tiff_page_layout(order, tags):
+    # Returns (data offset, dtype, page shape) for an uncompressed, stripped page
+    # whose strips are stored back to back, None if it cannot be mapped.
+    if tags.get(259, (1,))[0] != 1 or 322 in tags or 273 not in tags:
+        return None
+    samples = tags.get(277, (1,))[0]
+    if samples > 1 and tags.get(284, (1,))[0] != 1:
+        return None
+    bits = tags.get(258, (8,))
+    if len(set(bits)) != 1 or bits[0] % 8 != 0:
+        return None
+    kind = TIFF_SAMPLE_KINDS.get(tags.get(339, (1,))[0])
+    if kind is None:
+        return None
+    dtype = np.dtype("%s%s%d" % (order, kind, bits[0] // 8))
+    shape = (tags[257][0], tags[256][0]) + ((samples,) if samples > 1 else ())
+    offsets, byte_counts = tags[273], tags.get(279)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    if byte_counts is None or sum(byte_counts) < n_bytes:
+        return None
+    if any(offsets[i] + byte_counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None
+    return offsets[0], dtype, shape
+
+
+def memmap_tiff(filename):
+    # Memory maps an uncompressed multi-page TIFF, None if it is compressed, tiled or
+    # its pages differ. Evenly spaced pages become one strided array, other files a
+    # TiffPageStack indexed by the page offsets.
+    file_map = np.memmap(filename, dtype=np.uint8, mode="r")
+    layouts = []
+    description = ""
+    for order, tags in read_tiff_pages(file_map):
+        layout = tiff_page_layout(order, tags)
+        if layout is None:
+            return None
+        if len(layouts) == 0:
+            description = tags.get(270, "")
+        elif layout[1:] != layouts[0][1:]:
+            return None
+        layouts.append(layout)
+    if len(layouts) == 0:
+        return None
+    offsets = [layout[0] for layout in layouts]
+    _, dtype, shape = layouts[0]
+    page_bytes = int(np.prod(shape)) * dtype.itemsize
+    # ImageJ stacks over 4 GB only index their first page, the others follow it
+    images = re.search(r"images=(\d+)", description) if "ImageJ" in description else None
+    if images is not None and int(images.group(1)) > len(offsets) and len(offsets) == 1:
+        offsets = [offsets[0] + i * page_bytes for i in range(int(images.group(1)))]
+    if offsets[-1] + page_bytes > len(file_map):
+        return None
+    steps = np.diff(offsets)
+    strides = tuple(int(s) for s in np.cumprod((dtype.itemsize,) + shape[::-1])[:-1][::-1])
+    if len(offsets) == 1 or ((steps == steps[0]).all() and steps[0] >= page_bytes):
+        step = int(steps[0]) if len(offsets) > 1 else page_bytes
+        return np.ndarray((len(offsets),) + shape, dtype=dtype, buffer=file_map,
+                          offset=offsets[0], strides=(step,) + strides)
+    return TiffPageStack([np.ndarray(shape, dtype=dtype, buffer=file_map, offset=offset, strides=strides)
+                          for offset in offsets])
+
+
+def open_memmap(filename):
+    # Raw volume of filename mapped from disk, None if the format cannot be mapped
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".npy":
+        return np.load(filename, mmap_mode="r")
+    elif ext in (".tif", ".tiff"):
+        return memmap_tiff(filename)
+    return None
@@ -0,0 +1,227 @@
+import os
+import struct
+
+import imageio.v3 as iio
+import numpy as np
+
+# Classic TIFF offsets are 32 bit, larger files are written as BigTIFF
+MAX_CLASSIC_TIFF_BYTES = (1 << 32) - (1 << 20)
+# Version of the run-length encoded .npz annotation format
+RLE_FORMAT_VERSION = 1
+MASK_FILE_FILTER = "Annotation Files (*.npz *.npy *.tif *.tiff);;All Files (*)"
+
+
+def save_dtype(max_label):
+    # Smallest unsigned dtype holding every label
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def store_planes(label_store, dtype):
+    # Yields the XY planes of a label store in Z order, cast to dtype
+    for z in range(label_store.shape[0]):
+        yield np.ascontiguousarray(label_store.get_slice("XY", z), dtype=dtype)
+
+
+def write_npy_planes(fp, shape, dtype, planes):
+    # Streams the (Y, X) planes of a (Z, Y, X) volume into an .npy file
+    header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(shape)}
+    np.lib.format.write_array_header_1_0(fp, header)
+    for z, plane in enumerate(planes):
+        fp.write(plane.data)
+        yield z
+
+
+def tiff_ifd(order, big, page_shape, dtype, data_offset, next_offset):
+    # IFD of one uncompressed single-strip greyscale page, all values stored inline
+    height, width = page_shape
+    n_bytes = height * width * dtype.itemsize
+    offset_type = 16 if big else 4
+    entries = [(256, 4, width), (257, 4, height), (258, 3, dtype.itemsize * 8), (259, 3, 1), (262, 3, 1),
+               (273, offset_type, data_offset), (277, 3, 1), (278, 4, height), (279, offset_type, n_bytes),
+               (339, 3, 1)]
+    formats = {3: "H", 4: "I", 16: "Q"}
+    if big:
+        ifd = struct.pack(order + "Q", len(entries))
+        for tag, value_type, value in entries:
+            ifd += struct.pack(order + "HHQ", tag, value_type, 1) + struct.pack(order + formats[value_type], value).ljust(8, b"\0")
+        return ifd + struct.pack(order + "Q", next_offset)
+    ifd = struct.pack(order + "H", len(entries))
+    for tag, value_type, value in entries:
+        ifd += struct.pack(order + "HHI", tag, value_type, 1) + struct.pack(order + formats[value_type], value).ljust(4, b"\0")
+    return ifd + struct.pack(order + "I", next_offset)
+
+
+def write_tiff_planes(fp, shape, dtype, planes):
+    # Streams the (Y, X) planes of a (Z, Y, X) volume into a multi-page TIFF.
+    # Every page is its pixel data followed by its IFD, so the pages are evenly
+    # spaced and the file can be memory-mapped again by lazy_volume.memmap_tiff.
+    order = "<"
+    n_pages, height, width = shape
+    page_bytes = height * width * dtype.itemsize
+    padded_bytes = page_bytes + page_bytes % 2
+    ifd_size = len(tiff_ifd(order, False, (height, width), dtype, 0, 0))
+    big = n_pages * (padded_bytes + ifd_size) + 8 > MAX_CLASSIC_TIFF_BYTES
+    if big:
+        ifd_size = len(tiff_ifd(order, True, (height, width), dtype, 0, 0))
+        header_size = 16
+    else:
+        header_size = 8
+    page_step = padded_bytes + ifd_size
+    first_ifd = header_size + padded_bytes if n_pages > 0 else 0
+    if big:
+        fp.write(b"II" + struct.pack(order + "HHHQ", 43, 8, 0, first_ifd))
+    else:
+        fp.write(b"II" + struct.pack(order + "HI", 42, first_ifd))
+    for z, plane in enumerate(planes):
+        data_offset = header_size + z * page_step
+        next_offset = data_offset + page_step + padded_bytes if z + 1 < n_pages else 0
+        fp.write(plane.data)
+        fp.write(b"\0" * (padded_bytes - page_bytes))
+        fp.write(tiff_ifd(order, big, (height, width), dtype, data_offset, next_offset))
+        yield z
+
+
+def encode_plane_runs(plane):
+    # Returns (starts, lengths, values) of the runs of equal labels along the
+    # flattened plane, background runs left out
+    flat = plane.reshape(-1)
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), flat[:0]
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    lengths = np.diff(np.append(starts, flat.size))
+    values = flat[starts]
+    keep = values != 0
+    return starts[keep], lengths[keep], values[keep]
+
+
+def write_rle_planes(fp, shape, dtype, planes):
+    # Run-length encodes the (Y, X) planes of a (Z, Y, X) volume into a
+    # compressed .npz of plain arrays, see RleVolume. Only the runs are kept
+    # in memory until the file is written at the end.
+    starts, lengths, values = [], [], []
+    plane_runs = np.zeros(shape[0] + 1, dtype=np.int64)
+    for z, plane in enumerate(planes):
+        plane_starts, plane_lengths, plane_values = encode_plane_runs(plane)
+        starts.append(plane_starts.astype(np.uint32))
+        lengths.append(plane_lengths.astype(np.uint32))
+        values.append(plane_values)
+        plane_runs[z + 1] = plane_runs[z] + len(plane_values)
+        yield z
+    np.savez_compressed(fp,
+                        rle_version=np.array(RLE_FORMAT_VERSION),
+                        shape=np.array(shape, dtype=np.int64),
+                        plane_runs=plane_runs,
+                        starts=np.concatenate(starts) if starts else np.zeros(0, dtype=np.uint32),
+                        lengths=np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint32),
+                        values=np.concatenate(values) if values else np.zeros(0, dtype=dtype))
+
+
+class RleVolume:
+    # Read-only (Z, Y, X) label volume backed by the runs of a .npz written by
+    # write_rle_planes. Indexing decodes only the Z-planes asked for, the last
+    # range of planes is kept so the chunk by chunk reads of a label store stay cheap.
+
+    def __init__(self, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            if "rle_version" not in data or int(data["rle_version"]) > RLE_FORMAT_VERSION:
+                raise ValueError("%s is not a supported annotation file" % filename)
+            self.shape = tuple(int(n) for n in data["shape"])
+            self.plane_runs = data["plane_runs"]
+            self.starts = data["starts"]
+            self.lengths = data["lengths"]
+            self.values = data["values"]
+        self.dtype = self.values.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        self.plane_size = int(np.prod(self.shape[1:], dtype=np.int64))
+        self.cached = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def max(self):
+        return self.values.max() if self.values.size > 0 else self.dtype.type(0)
+
+    def min(self):
+        if self.values.size == 0 or int(self.lengths.sum(dtype=np.int64)) < self.size:
+            return self.dtype.type(0)
+        return self.values.min()
+
+    def decode_planes(self, z_start, z_end):
+        if self.cached is not None and self.cached[0] == (z_start, z_end):
+            return self.cached[1]
+        out = np.zeros((z_end - z_start) * self.plane_size, dtype=self.dtype)
+        first, last = self.plane_runs[z_start], self.plane_runs[z_end]
+        lengths = self.lengths[first:last].astype(np.int64)
+        if lengths.size > 0:
+            planes = np.repeat(np.arange(z_end - z_start, dtype=np.int64), np.diff(self.plane_runs[z_start:z_end + 1]))
+            run_starts = planes * self.plane_size + self.starts[first:last]
+            # Voxel k of run i lies at run_starts[i] + k
+            run_offsets = np.cumsum(lengths) - lengths
+            positions = np.repeat(run_starts - run_offsets, lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+            out[positions] = np.repeat(self.values[first:last], lengths)
+        out = out.reshape((z_end - z_start,) + self.shape[1:])
+        out.flags.writeable = False
+        self.cached = ((z_start, z_end), out)
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        z_key, rest = key[0], key[1:]
+        if isinstance(z_key, (int, np.integer)):
+            z = range(self.shape[0])[z_key]
+            return self.decode_planes(z, z + 1)[(0,) + rest]
+        if isinstance(z_key, slice) and z_key.step in (None, 1):
+            z_start, z_end, _ = z_key.indices(self.shape[0])
+            return self.decode_planes(z_start, max(z_start, z_end))[(slice(None),) + rest]
+        return self.decode_planes(0, self.shape[0])[key]
+
+
+def load_mask_file(filename):
+    # Label volume of a mask file, the .npz annotation format is decoded lazily
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".npz":
+        return RleVolume(filename)
+    elif ext == ".npy":
+        # Label volumes are memory-mapped, so an import reads them once and a
+        # parallel one shares the mapping. Older dict masks are pickled object
+        # arrays, which cannot be mapped.
+        try:
+            return np.load(filename, mmap_mode="r")
+        except ValueError:
+            return np.load(filename, allow_pickle=True)
+    return iio.imread(filename)
+
+
+def save_label_store(label_store, filename, progress=None):
+    # Writes the annotations as a (Z, Y, X) .npy or .tif in the smallest
+    # sufficient dtype, or run-length encoded as .npz, one plane at a time
+    # without a full-volume temporary.
+    # The file is written under a temporary name and only replaces filename
+    # once complete. progress, if given, is called with the fraction done.
+    dtype = save_dtype(label_store.max_label())
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".npy":
+        writer = write_npy_planes
+    elif ext in (".tif", ".tiff"):
+        writer = write_tiff_planes
+    elif ext == ".npz":
+        writer = write_rle_planes
+    else:
+        raise ValueError("File name should end with .npz, .npy, .tif, or .tiff.")
+    n_planes = label_store.shape[0]
+    partial = filename + ".part"
+    try:
+        with open(partial, "wb") as fp:
+            for z in writer(fp, label_store.shape, dtype, store_planes(label_store, dtype)):
+                if progress is not None:
+                    progress((z + 1) / n_planes)
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
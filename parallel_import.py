@@ -0,0 +1,148 @@
+import mmap
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+from label_stats import label_bounds
+from label_store import CHUNK_SIZE, count_labels, clip_labels
+
+# Label volumes at least this large are imported by a process pool
+PARALLEL_IMPORT_MIN_BYTES = 256 << 20
+
+
+def import_tiles(shape, chunk_size):
+    # Splits a (Z, Y, X) volume into chunk aligned Z-slabs, each cut into rows
+    # of chunks along Y so there are enough tasks for many cores
+    z_dim, y_dim, _ = shape
+    return [(z0, min(z0 + chunk_size, z_dim), y0, min(y0 + chunk_size, y_dim))
+            for z0 in range(0, z_dim, chunk_size)
+            for y0 in range(0, y_dim, chunk_size)]
+
+
+def create_shared(shape, dtype):
+    # Returns (shared memory, spec) of a zeroed array workers attach to by spec
+    n_bytes = max(1, int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+    return shm, ("shm", shm.name, tuple(shape), np.dtype(dtype).str, 0)
+
+
+def create_mapped(shape, dtype):
+    # Returns (file name, array, spec) of a zeroed array in a temporary file
+    # workers map by spec. Unlike shared memory the parent can keep using the
+    # array once the file is removed, so a store can take it over uncopied.
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, filename = tempfile.mkstemp(prefix="cell_gui_import_", dir=directory)
+    os.close(fd)
+    array = np.memmap(filename, dtype=dtype, mode="w+", shape=tuple(shape))
+    return filename, array, ("file", filename, tuple(shape), np.dtype(dtype).str, 0)
+
+
+def mapped_spec(labels):
+    # Spec workers map labels by without a copy, None unless labels is a C
+    # ordered array memory-mapped from a file, like an .npy opened with mmap_mode
+    if isinstance(labels, np.memmap) and isinstance(labels.base, mmap.mmap) \
+            and labels.filename is not None and labels.flags.c_contiguous:
+        return "file", labels.filename, tuple(labels.shape), labels.dtype.str, labels.offset
+    return None
+
+
+def _attach(spec, mode="r"):
+    kind, name, shape, dtype, offset = spec
+    if kind == "file":
+        return None, np.memmap(name, dtype=dtype, mode=mode, offset=offset, shape=shape)
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _detach(shm):
+    if shm is not None:
+        shm.close()
+
+
+def _tile_max(input_spec, tile):
+    shm, labels = _attach(input_spec)
+    try:
+        z0, z1, y0, y1 = tile
+        block = labels[z0:z1, y0:y1]
+        return int(block.max()) if block.size > 0 else 0
+    finally:
+        labels = block = None
+        _detach(shm)
+
+
+def _import_tile(input_spec, output_spec, tile, chunk_size, grid_shape):
+    # Clips one tile of the shared input into the shared output, writing only the
+    # chunks holding labels. Returns (label values, counts, occupied chunk keys,
+    # label_bounds of the tile), all the parent needs to set up the store.
+    in_shm, labels = _attach(input_spec)
+    out_shm, output = _attach(output_spec, "r+")
+    try:
+        z0, z1, y0, y1 = tile
+        _, grid_y, grid_x = grid_shape
+        gz, gy = z0 // chunk_size, y0 // chunk_size
+        chunk_keys, bounds = [], []
+        for gx in range(grid_x):
+            x0 = gx * chunk_size
+            block = labels[z0:z1, y0:y1, x0:x0 + chunk_size]
+            if not (block > 0).any():
+                continue
+            block = output[z0:z1, y0:y1, x0:x0 + chunk_size] = clip_labels(block, output.dtype)
+            chunk_keys.append((gz * grid_y + gy) * grid_x + gx)
+            bounds.append(label_bounds(block, z0, y0, x0))
+        block = output[z0:z1, y0:y1]
+        values, counts = count_labels(block) if chunk_keys else (np.zeros(0, dtype=np.int64),) * 2
+        bounds = [np.concatenate(parts) for parts in zip(*bounds)] if bounds else list(label_bounds(block[:0], 0, 0, 0))
+        return values, counts, chunk_keys, bounds
+    finally:
+        labels = output = block = None
+        _detach(in_shm)
+        _detach(out_shm)
+
+
+def parallel_load_array(store, labels, max_workers=None):
+    # Same result as store.load_array(labels). Workers clip, count and bound
+    # the labels of their tiles into a shared output of the store dtype, the
+    # parent only merges their small tables and takes over the chunks that
+    # hold labels, a dense store the whole output without copying it. A
+    # memory-mapped input is mapped by the workers, anything else is copied
+    # into shared memory once. Chunks without labels are never written, so
+    # their pages of the output are never allocated.
+    chunk_size = getattr(store, "chunk_size", CHUNK_SIZE)
+    grid_shape = tuple(-(-dim // chunk_size) for dim in store.shape)
+    tiles = import_tiles(store.shape, chunk_size)
+    max_workers = max_workers or os.cpu_count() or 1
+    in_shm = out_file = None
+    try:
+        input_spec = mapped_spec(labels)
+        if input_spec is None:
+            in_shm, input_spec = create_shared(labels.shape, labels.dtype)
+            shared = np.ndarray(labels.shape, dtype=labels.dtype, buffer=in_shm.buf)
+            for z_start in range(0, labels.shape[0], chunk_size):
+                shared[z_start:z_start + chunk_size] = labels[z_start:z_start + chunk_size]
+            del shared
+        # Workers are spawned, forking a process that runs Qt threads is not safe
+        with ProcessPoolExecutor(max_workers, mp_context=get_context("spawn")) as pool:
+            max_label = max(pool.map(_tile_max, [input_spec] * len(tiles), tiles), default=0)
+            store._prepare_array(labels, max_label)
+            out_file, output, output_spec = create_mapped(store.shape, store.dtype)
+            results = pool.map(_import_tile, [input_spec] * len(tiles), [output_spec] * len(tiles), tiles,
+                               [chunk_size] * len(tiles), [grid_shape] * len(tiles))
+            chunk_keys, bounds = [], []
+            for values, counts, tile_keys, tile_bounds in results:
+                store._add_counts(values, counts)
+                chunk_keys.extend(tile_keys)
+                bounds.append(tile_bounds)
+        # The output stays mapped, its memory is freed with the last mapping
+        os.remove(out_file)
+        out_file = None
+        store.load_clipped(output, chunk_keys, [np.concatenate(parts) for parts in zip(*bounds)])
+        del output
+    finally:
+        if in_shm is not None:
+            in_shm.close()
+            in_shm.unlink()
+        if out_file is not None:
+            os.remove(out_file)
@@ -0,0 +1,43 @@
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+from PyQt5.QtWidgets import QApplication
+
+VIEW_PLANES = ("XY", "XZ", "YZ")
+
+
+class RenderScheduler(QObject):
+    # Collects render requests per view plane and flushes them at most once
+    # per frame, so a burst of slider/brush events renders each view once.
+
+    def __init__(self, renderers, parent=None):
+        super().__init__(parent)
+        self.renderers = renderers
+        self.dirty_planes = set()
+        self.last_flush = 0.0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+        refresh_rate = 60.0
+        screen = QApplication.primaryScreen()
+        if screen is not None and screen.refreshRate() > 0:
+            refresh_rate = screen.refreshRate()
+        self.frame_interval = 1.0 / refresh_rate
+
+    def request(self, *view_planes):
+        if len(view_planes) == 0:
+            view_planes = VIEW_PLANES
+        self.dirty_planes.update(view_planes)
+        if not self.timer.isActive():
+            # Flush on the next event-loop tick, but not faster than the display refreshes
+            wait = self.frame_interval - (time.monotonic() - self.last_flush)
+            self.timer.start(max(0, int(wait * 1000)))
+
+    def flush(self):
+        self.timer.stop()
+        dirty_planes = self.dirty_planes
+        self.dirty_planes = set()
+        self.last_flush = time.monotonic()
+        for view_plane in VIEW_PLANES:
+            if view_plane in dirty_planes:
+                self.renderers[view_plane]()
@@ -0,0 +1,132 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+from PyQt5.QtCore import QThread
+
+VIEW_PLANES = ("XY", "XZ", "YZ")
+SLICE_CACHE_BUDGET_BYTES = 512 << 20
+# Number of slices prefetched on either side of the current one
+PREFETCH_RADIUS = 3
+
+
+class SliceCache:
+    # LRU cache of rendered slices kept under a memory budget. Entries are keyed
+    # by (layer, source, view plane, index), where the source is the image volume
+    # or label store the slice was rendered from. Sources are only referenced
+    # weakly and compared by identity on lookup, so a closed tab is not kept
+    # alive and a recycled id() never returns a stale slice.
+    # Shared between the GUI thread and the SlicePrefetcher.
+
+    def __init__(self, budget_bytes=SLICE_CACHE_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        # Bumped by invalidate, so a slice rendered before an edit is not stored after it
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def _key(self, layer, source, view_plane, index):
+        return (layer, id(source), view_plane, int(index))
+
+    def _pop(self, key):
+        _, _, n_bytes = self.entries.pop(key)
+        self.n_bytes -= n_bytes
+
+    def get(self, layer, source, view_plane, index):
+        key = self._key(layer, source, view_plane, index)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            source_ref, value, _ = entry
+            if source_ref() is not source:
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def generation(self, layer, source, view_plane, index):
+        with self.lock:
+            return self.generations.get(self._key(layer, source, view_plane, index), 0)
+
+    def put(self, layer, source, view_plane, index, value, n_bytes, generation=None):
+        key = self._key(layer, source, view_plane, index)
+        with self.lock:
+            if generation is not None and self.generations.get(key, 0) != generation:
+                return
+            if key in self.entries:
+                self._pop(key)
+            if n_bytes > self.budget_bytes:
+                return
+            self.entries[key] = (weakref.ref(source), value, n_bytes)
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.budget_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def invalidate(self, layer, source, view_plane, indices):
+        with self.lock:
+            for index in indices:
+                key = self._key(layer, source, view_plane, index)
+                self.generations[key] = self.generations.get(key, 0) + 1
+                if key in self.entries:
+                    self._pop(key)
+
+    def drop_source(self, source):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == id(source)]:
+                self._pop(key)
+
+
+class SlicePrefetcher(QThread):
+    # Renders the slices around the current position of each view plane in the
+    # background, so scrolling finds them in the SliceCache. Jobs are
+    # (layer, source, view plane, index, render) tuples, where render(source,
+    # view_plane, index) returns (value, n_bytes). A new request for a plane
+    # replaces whatever was still pending for it.
+
+    def __init__(self, cache, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.jobs = {view_plane: [] for view_plane in VIEW_PLANES}
+        self.condition = threading.Condition()
+        self.stopped = False
+
+    def request(self, view_plane, jobs):
+        with self.condition:
+            self.jobs[view_plane] = list(jobs)
+            self.condition.notify()
+        if not self.isRunning() and not self.stopped:
+            self.start(QThread.LowPriority)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.wait()
+
+    def next_job(self):
+        # The plane with the most pending slices goes first, so the planes take turns
+        with self.condition:
+            while not self.stopped and not any(self.jobs.values()):
+                self.condition.wait()
+            if self.stopped:
+                return None
+            view_plane = max(VIEW_PLANES, key=lambda plane: len(self.jobs[plane]))
+            return self.jobs[view_plane].pop(0)
+
+    def run(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            layer, source, view_plane, index, render = job
+            if self.cache.get(layer, source, view_plane, index) is not None:
+                continue
+            generation = self.cache.generation(layer, source, view_plane, index)
+            try:
+                value, n_bytes = render(source, view_plane, index)
+            except Exception:
+                # Prefetching is best effort, the GUI thread renders the slice itself on a miss
+                continue
+            self.cache.put(layer, source, view_plane, index, value, n_bytes, generation)
@@ -0,0 +1,176 @@
+import os
+import uuid
+
+import numpy as np
+
+from volume_layout import is_resident
+
+# Memory the images and annotations of all tabs may hold before the least
+# recently used inactive tabs are spilled to disk
+TAB_MEMORY_BUDGET_BYTES = 4 << 30
+
+
+class TabDocument:
+    # Everything that belongs to one image tab: the image and the data derived
+    # from it, the annotations and the three views. MainWindow reads and writes
+    # these through document_property attributes of the same name, so switching
+    # tabs only swaps MainWindow.document.
+
+    def __init__(self, path=None):
+        # Full path of the image file, the tab shows only its name
+        self.path = path
+        self.filename = None
+        self.image_data = None
+        self.volume_layout = None
+        self.image_min = 0
+        self.image_max = 255
+        self.min_pixel_intensity = 0
+        self.max_pixel_intensity = 255
+        self.z_max = 10
+        self.y_max = 10
+        self.x_max = 10
+        self.z_min = 0
+        self.y_min = 0
+        self.x_min = 0
+        self.xy_view = None
+        self.xz_view = None
+        self.yz_view = None
+        self.background_points = []
+        self.label_store = None
+        # Own label store of a linked tab, see link_documents
+        self.unlinked_store = None
+        self.autosave = None
+        # Names the spill files, the image file stays valid until the image is replaced
+        self.spill_key = uuid.uuid4().hex
+        self.image_spill = None
+
+    def own_store(self):
+        # Label store holding this tab's annotations, the one its autosave checkpoints
+        return self.unlinked_store if self.unlinked_store is not None else self.label_store
+
+    def share_image(self, other):
+        # Takes over the image of another document without copying it. Image
+        # volumes are never written once loaded, so tabs of the same file can
+        # share them, and the slices cached for them.
+        self.image_data = other.image_data
+        self.volume_layout = other.volume_layout
+        self.image_min, self.image_max = other.image_min, other.image_max
+        self.min_pixel_intensity = other.min_pixel_intensity
+        self.max_pixel_intensity = other.max_pixel_intensity
+        self.image_spill = other.image_spill
+
+    def resident_bytes(self, counted):
+        # Memory held by the image, its reordered copies and the labels.
+        # counted holds the ids of arrays already counted for other tabs.
+        n_bytes = 0
+        for item, size in ((self.image_data, lambda image: image.nbytes if is_resident(image) else 0),
+                           (self.volume_layout, lambda layout: layout.n_bytes),
+                           (self.label_store, lambda store: store.resident_bytes())):
+            if item is not None and id(item) not in counted:
+                counted.add(id(item))
+                n_bytes += size(item)
+        return n_bytes
+
+    def spill(self, spill_dir, spill_image=True, spill_labels=True):
+        # Replaces the image and the labels by memory-mapped files in spill_dir.
+        # The image never changes once loaded, so its file is only written once.
+        if spill_image and is_resident(self.image_data):
+            if self.image_spill is None:
+                image_spill = os.path.join(spill_dir, "%s_image.npy" % self.spill_key)
+                np.save(image_spill, self.image_data)
+                self.image_spill = image_spill
+            self.image_data = np.load(self.image_spill, mmap_mode="r")
+        if spill_labels and self.label_store is not None:
+            self.label_store.spill(os.path.join(spill_dir, "%s_labels.npy" % self.spill_key))
+
+    def restore(self):
+        # Reads spilled data back into memory, returns whether the image was spilled
+        if self.label_store is not None:
+            self.label_store.unspill()
+        if isinstance(self.image_data, np.memmap):
+            self.image_data = np.array(self.image_data)
+            return True
+        return False
+
+    def remove_spill_files(self, keep_image=False, keep_labels=False):
+        # keep_image and keep_labels when another tab still shares the file
+        for filename in (None if keep_image else self.image_spill,
+                         None if keep_labels else getattr(self.label_store, "spill_file", None)):
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+
+def document_property(name):
+    # MainWindow attribute stored on the current TabDocument
+    return property(lambda window: getattr(window.document, name),
+                    lambda window, value: setattr(window.document, name, value))
+
+
+def same_shape(document, other):
+    return document.label_store is not None and other.label_store is not None \
+        and document.label_store.shape == other.label_store.shape
+
+
+def link_source(document, documents):
+    # Tab a link of the tabs shaped like document starts from: the only one
+    # with annotations, document if none has any. None when several have
+    # annotations, linking would hide all of them but one.
+    annotated = [other for other in documents
+                 if same_shape(document, other) and len(other.label_store.label_counts) > 0]
+    if len(annotated) > 1:
+        return None
+    return annotated[0] if annotated else document
+
+
+def join_link(source, document):
+    # document shows and edits the label store of source until unlinked. Its
+    # own store, empty when joining, is kept in unlinked_store and is what its
+    # autosave keeps checkpointing.
+    document.unlinked_store = document.label_store
+    document.label_store = source.label_store
+
+
+def link_documents(source, documents):
+    # Links the tabs shaped like source that have no annotations to source,
+    # whose own store becomes the shared one
+    source.unlinked_store = source.label_store
+    for document in documents:
+        if document is not source and document.unlinked_store is None and same_shape(source, document) \
+                and len(document.label_store.label_counts) == 0:
+            join_link(source, document)
+
+
+def linked_documents(documents):
+    # There is one group of linked tabs at a time, see MainWindow.set_linked_tabs
+    return [document for document in documents if document.unlinked_store is not None]
+
+
+def relink_documents(source, documents, label_store):
+    # Annotations loaded into a linked tab replace the shared ones for all of
+    # them, as loading replaces the annotations of an unlinked tab
+    for document in linked_documents(documents):
+        document.label_store = label_store
+    source.label_store = source.unlinked_store = label_store
+
+
+def handover_link(source, documents):
+    # Called once source is closed, another linked tab takes over the shared
+    # store as its own. Returns the new source, None if no linked tab is left.
+    for document in linked_documents(documents):
+        if document is not source:
+            document.unlinked_store = document.label_store
+            return document
+    return None
+
+
+def unlink_documents(source, documents):
+    # Every linked tab keeps what was annotated while linked: source keeps the
+    # shared store, the other tabs get a copy of it. Their own stores were
+    # empty when they joined and edits only went to the shared store, so no
+    # annotations are dropped.
+    shared = source.label_store
+    for document in linked_documents(documents):
+        own_store = document.unlinked_store
+        document.unlinked_store = None
+        if document is not source:
+            document.label_store = shared.copy() if len(shared.label_counts) > 0 else own_store
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def main_window(qapp, tmp_path, monkeypatch):
+    import autosave
+    import gui
+    monkeypatch.setattr(autosave, "AUTOSAVE_ROOT", str(tmp_path / "autosave"))
+    window = gui.MainWindow()
+    window.show()
+    yield window
+    window.stop_image_loaders()
+    window.slice_prefetcher.stop()
+    window.close()
+    window.remove_spill_dir()
+
+
+@pytest.fixture
+def open_image(qapp, main_window):
+    # Opens an image file in a new tab of main_window and waits until it is loaded
+    def open_image(filename):
+        main_window.start_image_loader(filename)
+        start = time.monotonic()
+        while main_window.image_loaders and time.monotonic() - start < 30:
+            qapp.processEvents()
+            time.sleep(0.005)
+        qapp.processEvents()
+        return main_window.document
+    return open_image
+
+
+@pytest.fixture
+def image_window(tmp_path, main_window, open_image):
+    # main_window showing a (9, 30, 40) uint16 image
+    filename = str(tmp_path / "image.npy")
+    np.save(filename, (np.random.default_rng(0).random((9, 30, 40)) * 1000).astype(np.uint16))
+    open_image(filename)
+    return main_window
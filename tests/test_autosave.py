@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+
+from autosave import AutosaveStore, AutosaveWriter, checkpoint_jobs
+from label_stats import label_bounds
+from label_store import DIRTY_BLOCK_SIZE, DenseLabelStore, ChunkedLabelStore
+
+SHAPE = (2 * DIRTY_BLOCK_SIZE, 2 * DIRTY_BLOCK_SIZE, 3 * DIRTY_BLOCK_SIZE)
+
+
+def write(jobs):
+    for autosave_store, label_store, blocks, unsaved in jobs:
+        autosave_store.write(label_store.shape, blocks, unsaved)
+
+
+def attach(tmp_path, label_store, name="image.tif"):
+    autosave_store = AutosaveStore(name, path=str(tmp_path / name))
+    autosave_store.track(label_store)
+    autosave_store.saved = (id(label_store), label_store.version)
+    return autosave_store
+
+
+def count_reads(monkeypatch, label_store):
+    reads = []
+    read_block = label_store.read_block
+    monkeypatch.setattr(label_store, "read_block", lambda key: reads.append(key) or read_block(key))
+    return reads
+
+
+@pytest.fixture(params=[DenseLabelStore, ChunkedLabelStore])
+def store_class(request):
+    return request.param
+
+
+def test_fresh_tab_needs_no_checkpoint(tmp_path, store_class):
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    assert checkpoint_jobs([(autosave_store, label_store)]) == []
+
+
+def test_checkpoint_reads_only_edited_blocks(tmp_path, monkeypatch, store_class):
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    reads = count_reads(monkeypatch, label_store)
+    label_store.add_points(np.array([[1, 1, 1], [2, 1, 1]]), 3)
+    jobs = checkpoint_jobs([(autosave_store, label_store)])
+    assert reads == [0]
+    write(jobs)
+    assert autosave_store.blocks == {0}
+    assert autosave_store.manifest["unsaved"]
+
+
+def test_resume_round_trip(tmp_path, store_class):
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    far = [SHAPE[2] - 1, SHAPE[1] - 1, SHAPE[0] - 1]
+    label_store.add_points(np.array([[1, 2, 3], far]), 4)
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+
+    resumed = AutosaveStore("image.tif", path=autosave_store.path)
+    assert resumed.can_resume(SHAPE)
+    restored = store_class(SHAPE)
+    resumed.load_into(restored)
+    np.testing.assert_array_equal(restored.to_array(), label_store.to_array())
+    assert restored.dirty_blocks == set()
+
+
+def test_store_swap_rewrites_only_labelled_blocks(tmp_path, monkeypatch, store_class):
+    old_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, old_store)
+    old_store.add_points(np.array([[1, 1, 1]]), 1)
+    write(checkpoint_jobs([(autosave_store, old_store)]))
+
+    new_store = store_class(SHAPE)
+    far = [SHAPE[2] - 1, SHAPE[1] - 1, SHAPE[0] - 1]
+    new_store.add_points(np.array([far]), 2)
+    new_store.take_dirty_blocks()
+    reads = count_reads(monkeypatch, new_store)
+    write(checkpoint_jobs([(autosave_store, new_store)]))
+    last_block = int(np.prod(new_store.block_grid_shape)) - 1
+    assert sorted(reads) == [0, last_block]
+    assert autosave_store.blocks == {last_block}
+
+
+def test_load_marks_only_labelled_blocks_dirty(store_class):
+    label_store = store_class(SHAPE)
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+    label_store.take_dirty_blocks()
+    labels = np.zeros(SHAPE, dtype=np.uint16)
+    labels[DIRTY_BLOCK_SIZE + 5, 3, 2 * DIRTY_BLOCK_SIZE + 7] = 9
+    label_store.load_array(labels)
+    loaded_block = int(np.ravel_multi_index((1, 0, 2), label_store.block_grid_shape))
+    # Block 0 held the old labels and has to be cleared
+    assert label_store.dirty_blocks == {0, loaded_block}
+    assert label_store.label_blocks == {loaded_block}
+
+
+def test_shared_store_is_read_once(tmp_path, monkeypatch, store_class):
+    label_store = store_class(SHAPE)
+    first = attach(tmp_path, label_store, "a.tif")
+    second = attach(tmp_path, label_store, "b.tif")
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+    reads = count_reads(monkeypatch, label_store)
+    jobs = checkpoint_jobs([(first, label_store), (second, label_store)])
+    assert reads == [0]
+    write(jobs)
+    assert first.blocks == second.blocks == {0}
+
+
+def test_erased_block_is_removed(tmp_path, store_class):
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+    label_store.remove_points(np.array([[1, 1, 1]]), 1)
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+    assert autosave_store.blocks == set()
+    assert label_store.label_blocks == set()
+
+
+def test_clear_removes_directory(tmp_path):
+    label_store = DenseLabelStore(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+    autosave_store.clear()
+    assert not (tmp_path / "image.tif").exists()
+
+
+def test_load_superset_is_pruned_by_checkpoint(tmp_path, store_class):
+    # A label spread over distant blocks marks every block its bounding box
+    # overlaps, the first checkpoint drops the empty ones
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    labels = np.zeros(SHAPE, dtype=np.uint16)
+    labels[1, 1, 1] = labels[-1, -1, -1] = 5
+    label_store.load_array(labels)
+    corners = {0, int(np.prod(label_store.block_grid_shape)) - 1}
+    assert label_store.label_blocks >= corners
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+    assert label_store.label_blocks == corners
+    assert autosave_store.blocks == corners
+
+
+def test_load_clipped_marks_given_chunks():
+    label_store = DenseLabelStore(SHAPE)
+    labels = np.zeros(SHAPE, dtype=np.uint16)
+    labels[DIRTY_BLOCK_SIZE + 1, 2, 3] = 4
+    key = int(np.ravel_multi_index((1, 0, 0), label_store.block_grid_shape))
+    label_store._prepare_array(labels, 4)
+    label_store.load_clipped(labels, [key], label_bounds(labels, 0, 0, 0))
+    assert label_store.label_blocks == label_store.dirty_blocks == {key}
+
+
+def test_failed_write_is_reported_and_retried(tmp_path, store_class):
+    label_store = store_class(SHAPE)
+    autosave_store = attach(tmp_path, label_store)
+    # A file in place of the autosave directory
+    (tmp_path / "image.tif").write_bytes(b"")
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+    writer = AutosaveWriter(checkpoint_jobs([(autosave_store, label_store)]))
+    errors = []
+    writer.error_signal.connect(lambda title, message: errors.append(message))
+    writer.run()
+    assert len(errors) == 1 and autosave_store.path in errors[0]
+    assert label_store.dirty_blocks == set()
+    writer.restore_failed()
+    assert label_store.dirty_blocks == {0}
+
+    (tmp_path / "image.tif").unlink()
+    write(checkpoint_jobs([(autosave_store, label_store)]))
+    assert autosave_store.blocks == {0}
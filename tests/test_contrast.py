@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import contrast
+from contrast import saturated_range, sampled_saturated_range, apply_contrast, stretch_to_uint8
+
+
+def sorted_range(image, saturated=0.35):
+    # Reference: the full sort the histogram replaces
+    flat = np.sort(image.ravel())
+    n_pixels = len(flat)
+    saturated_pixel_count = max(min(int(n_pixels * saturated / 100.0), n_pixels // 2 - 1), 0)
+    return flat[saturated_pixel_count], flat[-saturated_pixel_count - 1]
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Several chunks even for the small test volumes
+    monkeypatch.setattr(contrast.iter_chunks, "__defaults__", (None, 500))
+
+
+def volume(dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    info = np.iinfo(dtype)
+    image = rng.normal(0, 1, (12, 20, 30)) * 0.1 * (int(info.max) - int(info.min)) + (int(info.max) + int(info.min)) / 2
+    return np.clip(image, info.min, info.max).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+@pytest.mark.parametrize("saturated", [0, 0.35, 5])
+def test_integer_range_matches_sort(small_chunks, dtype, saturated):
+    image = volume(dtype)
+    low, high, min_val, max_val = saturated_range(image, saturated)
+    assert (low, high) == (image.min(), image.max())
+    assert (min_val, max_val) == sorted_range(image, saturated)
+
+
+@pytest.mark.parametrize("image", [np.random.default_rng(1).normal(100, 20, (12, 20, 30)).astype(np.float32),
+                                   volume(np.int32)])
+def test_binned_range_within_one_bin(small_chunks, image):
+    # Floats and integer ranges too wide for one bin per value
+    low, high, min_val, max_val = saturated_range(image)
+    bin_width = (float(high) - float(low)) / contrast.HISTOGRAM_BINS
+    expected_min, expected_max = sorted_range(image)
+    assert abs(min_val - expected_min) <= bin_width
+    assert abs(max_val - expected_max) <= bin_width
+
+
+def test_progress_reaches_one(small_chunks):
+    progress = []
+    saturated_range(volume(np.uint16), progress=progress.append)
+    assert progress == sorted(progress)
+    assert progress[-1] == pytest.approx(1)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int16, np.float32])
+def test_apply_contrast_matches_stretch(small_chunks, dtype):
+    image = volume(np.int16).astype(dtype)
+    low, high, min_val, max_val = saturated_range(image)
+    np.testing.assert_array_equal(apply_contrast(image, low, high, min_val, max_val),
+                                  stretch_to_uint8(image, min_val, max_val))
+
+
+def test_constant_image():
+    image = np.full((3, 4, 5), 7, dtype=np.uint8)
+    low, high, min_val, max_val = saturated_range(image)
+    assert min_val == max_val == 7
+    assert not apply_contrast(image, low, high, min_val, max_val).any()
+
+
+def test_sampled_range_reads_only_sampled_planes():
+    image = volume(np.uint16)
+    read = []
+
+    class Planes:
+        shape, dtype = image.shape, image.dtype
+
+        def __getitem__(self, index):
+            read.append(index)
+            return image[index]
+
+    assert sampled_saturated_range(Planes(), n_planes=4)[2:] == sorted_range(image[[0, 3, 7, 11]])
+    assert read == [0, 3, 7, 11]
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+from PyQt5.QtCore import Qt, QEvent, QPointF
+from PyQt5.QtGui import QMouseEvent
+from PyQt5.QtWidgets import QMessageBox
+
+from graphics_view import brush_stencil, rasterize_line
+
+
+@pytest.fixture
+def window(image_window):
+    image_window.toggleForeground()
+    image_window.index_control.cell_index = 1
+    image_window.brush_width = 1
+    return image_window
+
+
+def mouse(view, kind, col, row, button=Qt.LeftButton):
+    # Sends a mouse event at pixel (col, row) of the slice shown in view
+    position = view.mapFromScene(view._pixmap_item.mapToScene(QPointF(col + 0.3, row + 0.3)))
+    event = QMouseEvent(kind, QPointF(position), button, button, Qt.NoModifier)
+    {QEvent.MouseButtonPress: view.mousePressEvent, QEvent.MouseMove: view.mouseMoveEvent,
+     QEvent.MouseButtonRelease: view.mouseReleaseEvent}[kind](event)
+
+
+def painted(window):
+    z, y, x = np.nonzero(window.label_store.to_array())
+    return set(zip(x.tolist(), y.tolist(), z.tolist()))
+
+
+def test_stroke_is_interpolated_between_events(window):
+    window.slider.setValue(4)
+    mouse(window.xy_view, QEvent.MouseButtonPress, 2, 5)
+    mouse(window.xy_view, QEvent.MouseMove, 12, 5)
+    mouse(window.xy_view, QEvent.MouseButtonRelease, 12, 5)
+    assert painted(window) == {(x, 5, 4) for x in range(2, 13)}
+
+
+def test_slice_change_mid_drag_starts_a_new_stroke(window):
+    window.slider.setValue(2)
+    mouse(window.xy_view, QEvent.MouseButtonPress, 2, 5)
+    mouse(window.xy_view, QEvent.MouseMove, 6, 5)
+    # The slice is scrolled while the button is still held
+    window.slider.setValue(6)
+    mouse(window.xy_view, QEvent.MouseMove, 20, 5)
+    mouse(window.xy_view, QEvent.MouseMove, 22, 5)
+    mouse(window.xy_view, QEvent.MouseButtonRelease, 22, 5)
+    assert painted(window) == {(x, 5, 2) for x in range(2, 7)} | {(x, 5, 6) for x in range(20, 23)}
+
+
+@pytest.mark.parametrize("fixed_dimension, axis", [("X", 0), ("Y", 1), ("Z", 2)])
+def test_stencil_is_a_cached_disc_in_the_plane(fixed_dimension, axis):
+    stencil = brush_stencil(2, fixed_dimension)
+    assert brush_stencil(2, fixed_dimension) is stencil
+    assert not stencil.flags.writeable
+    assert (stencil[:, axis] == 0).all()
+    assert len(stencil) == 13 and len(set(map(tuple, stencil.tolist()))) == 13
+    assert (np.linalg.norm(stencil, axis=1) <= 2).all()
+    assert brush_stencil(0, fixed_dimension).tolist() == [[0, 0, 0]]
+
+
+def test_stamp_is_clipped_to_the_volume(window):
+    points = window.xy_view.generate_nearby_points(np.array([0, 29, 8]), "Z", 1)
+    assert sorted(map(tuple, points.tolist())) == [(0, 28, 8), (0, 29, 8), (1, 29, 8)]
+
+
+@pytest.mark.parametrize("end_point", [(3, 4, 5), (13, 1, 5), (-6, 9, 5), (3, 4, 2)])
+def test_rasterized_line_connects_end_points(end_point):
+    line = rasterize_line(np.array([3, 4, 5]), np.array(end_point))
+    assert line[0].tolist() == [3, 4, 5] and line[-1].tolist() == list(end_point)
+    # Consecutive positions touch, with one position per step along the longest axis
+    assert (np.abs(np.diff(line, axis=0)).max(axis=1) == 1).all()
+    assert len(line) == np.abs(np.subtract(end_point, (3, 4, 5))).max() + 1
+
+
+@pytest.fixture
+def clicking_window(image_window):
+    image_window.slider.setValue(4)
+    image_window.add_points(np.array([[10, 12, 4], [11, 12, 4], [11, 12, 5]]), 5)
+    image_window.render_scheduler.flush()
+    return image_window
+
+
+@pytest.fixture
+def no_slice_scans(clicking_window, monkeypatch):
+    # Select and delete clicks look up one voxel, they never scan the slice
+    monkeypatch.setattr(clicking_window.label_store, "get_slice", None)
+    return clicking_window
+
+
+def test_click_selects_the_cell_under_the_cursor(no_slice_scans):
+    window = no_slice_scans
+    window.select_cell_enabled = True
+    window.new_cell_selected = False
+    mouse(window.xy_view, QEvent.MouseButtonPress, 3, 3)
+    assert not window.new_cell_selected
+    mouse(window.xy_view, QEvent.MouseButtonPress, 11, 12)
+    assert window.new_cell_selected and window.index_control.cell_index == 5
+
+
+def test_click_deletes_the_cell_under_the_cursor(no_slice_scans, monkeypatch):
+    window = no_slice_scans
+    window.delete_cell_enabled = True
+    monkeypatch.setattr(QMessageBox, "question", lambda *args: QMessageBox.Yes)
+    mouse(window.xy_view, QEvent.MouseButtonPress, 3, 3)
+    assert window.label_store.has_label(5)
+    mouse(window.xy_view, QEvent.MouseButtonPress, 10, 12)
+    assert not window.label_store.has_label(5)
+
+
+def test_right_click_copies_the_cell_in_the_slice(clicking_window):
+    window = clicking_window
+    mouse(window.xy_view, QEvent.MouseButtonPress, 10, 12, Qt.RightButton)
+    (view_plane, points, label), = window.copied_points
+    assert view_plane == "XY" and label == 5
+    assert sorted(map(tuple, points.tolist())) == [(10, 12, 4), (11, 12, 4)]
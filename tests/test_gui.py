@@ -0,0 +1,203 @@
+import numpy as np
+import pytest
+
+from cmaps import glasbey_cmap_argb, num_colors
+from gui_widgets import MaskLoader, MaskSaver
+from label_store import DenseLabelStore
+
+
+def painted(window):
+    z, y, x = np.nonzero(window.label_store.to_array())
+    return set(zip(x.tolist(), y.tolist(), z.tolist()))
+
+
+@pytest.fixture
+def erasing_window(image_window):
+    image_window.add_points(np.array([[2, 3, 4], [3, 2, 4], [5, 5, 4]]), 1)
+    image_window.add_points(np.array([[6, 6, 4]]), 2)
+    image_window.toggleEraser()
+    return image_window
+
+
+def test_eraser_removes_exact_voxels(erasing_window):
+    # x and y of these each match a painted voxel, the voxels themselves do not
+    erasing_window.removePoints(np.array([[2, 2, 4], [3, 3, 4]]), 1, "XY")
+    assert painted(erasing_window) == {(2, 3, 4), (3, 2, 4), (5, 5, 4), (6, 6, 4)}
+    erasing_window.removePoints(np.array([[2, 3, 4], [6, 6, 4], [5, 5, 3]]), 1, "XZ")
+    assert painted(erasing_window) == {(3, 2, 4), (5, 5, 4), (6, 6, 4)}
+    assert erasing_window.label_store.label_counts == {1: 2, 2: 1}
+
+
+def test_eraser_only_erases_when_enabled(erasing_window):
+    erasing_window.toggleEraser()
+    erasing_window.removePoints(np.array([[2, 3, 4]]), 1, "XY")
+    assert (2, 3, 4) in painted(erasing_window)
+
+
+def test_add_points_commits_a_batch_at_once(image_window):
+    store = image_window.label_store
+    image_window.add_points(np.array([5, 6, 2]), 3)
+    version = store.version
+    # Duplicates, a painted voxel and points outside the volume
+    batch = np.array([[1, 1, 1], [1, 1, 1], [5, 6, 2], [39, 29, 8], [40, 0, 0], [-1, 2, 2]])
+    image_window.add_points(batch, 4)
+    assert store.version == version + 1
+    assert painted(image_window) == {(1, 1, 1), (5, 6, 2), (39, 29, 8)}
+    assert store.label_counts == {3: 1, 4: 2}
+    assert store.label_at((5, 6, 2)) == 3
+
+
+def test_labels_are_coloured_from_the_lookup_table(image_window):
+    label_slice = np.array([[0, 1], [num_colors + 2, 2]])
+    argb = image_window.labels_to_argb(label_slice)
+    assert argb.dtype == np.uint32 and argb[0, 0] == 0
+    assert argb[0, 1] == glasbey_cmap_argb[1] and argb[1, 0] == argb[1, 1] == glasbey_cmap_argb[2]
+    assert (argb[label_slice > 0] >> 24 == 0xFF).all()
+
+
+def test_label_edits_only_redraw_the_overlay(image_window, monkeypatch):
+    window = image_window
+    window.slider.setValue(4)
+    window.slidery.setValue(7)
+    window.render_scheduler.flush()
+    rendered = []
+    monkeypatch.setattr(window, "render_base_slice", lambda *args: rendered.append(args))
+    window.add_points(np.array([[5, 7, 4]]), 2)
+    window.render_scheduler.flush()
+    assert rendered == []
+    # XY rows are y, XZ rows are x and columns z
+    colour = glasbey_cmap_argb[2]
+    assert window.xy_view._overlay_item.buffer[7, 5] == colour
+    assert window.xz_view._overlay_item.buffer[5, 4] == colour
+    assert window.xy_view._overlay_item.buffer[7, 6] == 0
+    window.markersOffOn()
+    window.render_scheduler.flush()
+    assert not window.xy_view._overlay_item.isVisible() and rendered == []
+
+
+def test_stroke_repaints_only_its_rectangle(image_window, monkeypatch):
+    window = image_window
+    window.slider.setValue(4)
+    window.slidery.setValue(7)
+    window.sliderx.setValue(30)
+    window.add_points(np.array([[1, 1, 1]]), 1)
+    window.render_scheduler.flush()
+    requested, regions = [], []
+    monkeypatch.setattr(window, "request_render", lambda *planes: requested.extend(planes))
+    monkeypatch.setattr(window.xy_view, "setOverlay", None)
+    update_region = window.xy_view.update_overlay_region
+    monkeypatch.setattr(window.xy_view, "update_overlay_region",
+                        lambda row, col, argb: regions.append((row, col, argb.shape)) or update_region(row, col, argb))
+    window.add_points(np.array([[5, 7, 4], [8, 9, 4]]), 2)
+    # The YZ slice at x = 30 is not crossed by the stroke
+    assert sorted(requested) == ["XY", "XZ"]
+    assert window.xy_view.dirty_rects == [(7, 10, 5, 9)]
+    window.update_xy_view()
+    assert regions == [(7, 5, (3, 4))]
+    assert window.xy_view.dirty_rects == []
+    assert window.xy_view._overlay_item.buffer[9, 8] == glasbey_cmap_argb[2]
+
+
+def load_masks(window, filename):
+    # Runs a MaskLoader on the calling thread, returns the errors it reported
+    loader = MaskLoader(window, filename)
+    errors, asked = [], []
+    loader.error_signal.connect(errors.append)
+    loader.ask_user_signal.connect(lambda: asked.append(True))
+    loader.run()
+    if asked:
+        loader.continue_work(True)
+    return errors
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.int32, np.float32])
+def test_mask_volume_is_imported(image_window, tmp_path, dtype):
+    labels = np.zeros((9, 30, 40), dtype=dtype)
+    labels[2, 3:5, 4:9] = 7
+    labels[8, 29, 39] = 300
+    filename = str(tmp_path / "mask.npy")
+    np.save(filename, labels)
+    assert load_masks(image_window, filename) == []
+    np.testing.assert_array_equal(image_window.label_store.to_array(), labels)
+    assert image_window.label_store.label_counts == {7: 10, 300: 1}
+    assert image_window.index_control.cell_index == 300
+
+
+def test_dict_mask_is_imported(image_window, tmp_path):
+    # z, y, x positions per label
+    mask = {3: [(1, 2, 3), (1, 2, 4)], 5: np.array([[8, 29, 39]]), 6: []}
+    filename = str(tmp_path / "mask.npy")
+    np.save(filename, np.array(mask, dtype=object), allow_pickle=True)
+    assert load_masks(image_window, filename) == []
+    assert painted(image_window) == {(3, 2, 1), (4, 2, 1), (39, 29, 8)}
+    assert image_window.label_store.label_counts == {3: 2, 5: 1}
+
+
+def test_mask_without_background_is_shifted(image_window, tmp_path):
+    labels = np.full((9, 30, 40), 4, dtype=np.uint16)
+    labels[0, 0, 0] = 6
+    filename = str(tmp_path / "mask.npy")
+    np.save(filename, labels)
+    assert load_masks(image_window, filename) == []
+    assert image_window.label_store.label_counts == {2: 1}
+    assert image_window.label_store.label_at((0, 0, 0)) == 2
+
+
+def test_mask_of_another_shape_is_refused(image_window, tmp_path):
+    store = image_window.label_store
+    filename = str(tmp_path / "mask.npy")
+    np.save(filename, np.ones((9, 30, 41), dtype=np.uint16))
+    assert load_masks(image_window, filename) == ["Mask shape does not match image shape"]
+    assert image_window.label_store is store
+
+
+def test_mask_saver_reports_progress_and_failures(qapp, tmp_path):
+    label_store = DenseLabelStore((4, 5, 6))
+    label_store.add_points(np.array([[1, 2, 3]]), 300)
+    saver = MaskSaver(label_store, str(tmp_path / "labels.tif"))
+    progress, errors = [], []
+    saver.progress.connect(progress.append)
+    saver.error_signal.connect(lambda title, message: errors.append(message))
+    saver.run()
+    assert progress == [25, 50, 75, 100] and errors == [] and not saver.failed and not saver.edited
+    assert saver.version == label_store.version
+    saver = MaskSaver(label_store, str(tmp_path / "missing" / "labels.npy"))
+    saver.error_signal.connect(lambda title, message: errors.append(message))
+    saver.run()
+    assert saver.failed and len(errors) == 1
+
+
+def test_tabs_of_one_file_share_the_image_not_the_labels(image_window, open_image):
+    window = image_window
+    first = window.document
+    window.add_points(np.array([[1, 2, 3]]), 1)
+    second = open_image(first.path)
+    assert window.tab_widget.count() == 2 and window.document is second
+    assert second.image_data is first.image_data and second.volume_layout is first.volume_layout
+    assert second.label_store is not first.label_store and second.label_store.label_counts == {}
+    window.add_points(np.array([[4, 5, 6]]), 2)
+    window.tab_widget.setCurrentIndex(0)
+    assert window.document is first and window.label_store is first.label_store
+    assert window.label_store.label_counts == {1: 1}
+    window.tab_widget.setCurrentIndex(1)
+    assert window.label_store.label_counts == {2: 1}
+
+
+def test_inactive_tab_is_spilled_over_budget(image_window, open_image, tmp_path):
+    window = image_window
+    first = window.document
+    window.add_points(np.array([[1, 2, 3]]), 1)
+    image = np.array(first.image_data)
+    filename = str(tmp_path / "other.npy")
+    np.save(filename, np.zeros((9, 30, 40), dtype=np.uint8))
+    window.tab_memory_budget = 1
+    second = open_image(filename)
+    assert isinstance(first.image_data, np.memmap) and isinstance(first.label_store.labels, np.memmap)
+    assert type(second.image_data) is np.ndarray
+    window.tab_widget.setCurrentIndex(0)
+    assert type(first.image_data) is np.ndarray and isinstance(second.image_data, np.memmap)
+    np.testing.assert_array_equal(first.image_data, image)
+    assert window.label_store.label_counts == {1: 1} and window.label_store.label_at((1, 2, 3)) == 1
+    window.tab_memory_budget = 1 << 40
+    window.tab_widget.setCurrentIndex(1)
+    assert type(first.image_data) is np.ndarray and type(second.image_data) is np.ndarray
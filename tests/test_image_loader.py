@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import contrast
+import gui_widgets
+from contrast import saturated_range, apply_contrast
+from gui_widgets import ImageLoader
+from lazy_volume import LazyVolume
+
+SHAPE = (12, 20, 30)
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    filename = str(tmp_path / "image.npy")
+    np.save(filename, (np.random.default_rng(0).random(SHAPE) * 4000).astype(np.uint16))
+    return filename
+
+
+def run(loader):
+    # Runs the loader on the calling thread, returns what it emitted
+    emitted = {"progress": [], "volumes": [], "errors": []}
+    loader.progress.connect(emitted["progress"].append)
+    loader.volume_ready.connect(lambda volume, final: emitted["volumes"].append((volume, final)))
+    loader.error_signal.connect(lambda title, message: emitted["errors"].append(title))
+    loader.run()
+    return emitted
+
+
+def test_stretched_volume_comes_before_the_final_one(qapp, image_file):
+    emitted = run(ImageLoader(image_file, lazy_loading=False))
+    image = np.load(image_file)
+    (first, first_final), (final, final_final) = emitted["volumes"]
+    assert isinstance(first, LazyVolume) and not first_final
+    assert final_final and final.dtype == np.uint8
+    expected = apply_contrast(image, *saturated_range(image))
+    np.testing.assert_array_equal(final, expected)
+    np.testing.assert_array_equal(first[5], expected[5])
+    assert emitted["progress"] == sorted(emitted["progress"]) and emitted["progress"][-1] == 100
+    assert emitted["errors"] == []
+
+
+def test_large_file_is_only_mapped(qapp, image_file, monkeypatch):
+    monkeypatch.setattr(gui_widgets, "LAZY_LOAD_MIN_BYTES", 0)
+    emitted = run(ImageLoader(image_file))
+    (volume, final), = emitted["volumes"]
+    assert isinstance(volume, LazyVolume) and final
+    assert isinstance(volume.raw, np.memmap)
+
+
+def test_cancelled_load_stops_without_a_volume(qapp, image_file, monkeypatch):
+    # Progress is reported, and cancelling checked, for every chunk
+    monkeypatch.setattr(contrast.iter_chunks, "__defaults__", (None, 500))
+    loader = ImageLoader(image_file, lazy_loading=False)
+    loader.progress.connect(lambda value: value >= 70 and loader.cancel())
+    emitted = run(loader)
+    assert [final for volume, final in emitted["volumes"]] == [False]
+    assert emitted["errors"] == []
+
+
+def test_invalid_image_is_reported(qapp, tmp_path):
+    filename = str(tmp_path / "plane.npy")
+    np.save(filename, np.zeros((20, 30), dtype=np.uint8))
+    emitted = run(ImageLoader(filename))
+    assert emitted["volumes"] == [] and emitted["errors"] == ["Invalid Image"]
+
+
+def test_window_shows_the_final_volume(main_window, open_image, image_file):
+    document = open_image(image_file)
+    assert main_window.tab_widget.count() == 1
+    assert isinstance(document.image_data, np.ndarray) and document.image_data.dtype == np.uint8
+    assert main_window.image_loaders == [] and main_window.cancel_loading_button.isHidden()
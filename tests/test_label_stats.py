@@ -0,0 +1,130 @@
+import time
+
+import numpy as np
+import pytest
+
+from label_store import DenseLabelStore, ChunkedLabelStore
+
+SHAPE = (12, 20, 24)
+
+
+@pytest.fixture(params=[DenseLabelStore, ChunkedLabelStore])
+def label_store(request, monkeypatch):
+    label_store = request.param(SHAPE, chunk_size=8) if request.param is ChunkedLabelStore \
+        else request.param(SHAPE)
+    # Queries must be answered from the statistics, not by scanning the labels
+    monkeypatch.setattr(label_store, "points_of_label", None)
+    return label_store
+
+
+def expected(labels, label):
+    z, y, x = np.nonzero(labels == label)
+    points = np.column_stack((x, y, z))
+    return points.mean(axis=0), (tuple(points.min(axis=0)), tuple(points.max(axis=0)))
+
+
+def check(label_store):
+    label_store.stats.flush()
+    labels = label_store.to_array()
+    for label in label_store.label_counts:
+        centroid, bounding_box = expected(labels, label)
+        np.testing.assert_allclose(label_store.stats.centroid(label), centroid)
+        assert label_store.stats.bounding_box(label) == bounding_box
+    assert set(label_store.stats.entries) == set(label_store.label_counts)
+
+
+def random_points(rng, n):
+    return np.column_stack([rng.integers(0, dim, n) for dim in SHAPE[::-1]])
+
+
+def test_stats_follow_edits(label_store):
+    rng = np.random.default_rng(0)
+    for step in range(60):
+        label = int(rng.integers(1, 5))
+        points = random_points(rng, 40)
+        if step % 3 == 2:
+            label_store.remove_points(points, label)
+        elif step % 3 == 1:
+            label_store.add_labelled_points(points, rng.integers(1, 5, len(points)))
+        else:
+            label_store.add_points(points, label)
+        check(label_store)
+
+
+def test_bounds_shrink_when_boundary_is_erased(label_store):
+    label_store.add_points(np.array([[1, 2, 3], [5, 6, 7], [9, 10, 11]]), 1)
+    label_store.remove_points(np.array([[9, 10, 11]]), 1)
+    assert label_store.stats.bounding_box(1) == ((1, 2, 3), (5, 6, 7))
+    label_store.remove_points(np.array([[1, 2, 3], [5, 6, 7]]), 1)
+    assert label_store.stats.bounding_box(1) is None
+
+
+@pytest.mark.parametrize("num_labels", [4, 3000])
+def test_stats_of_loaded_labels(label_store, num_labels):
+    rng = np.random.default_rng(1)
+    labels = rng.integers(0, num_labels, SHAPE).astype(np.uint16) * (rng.random(SHAPE) < 0.05)
+    label_store.add_points(np.array([[0, 0, 0]]), 9000)
+    label_store.load_array(labels)
+    assert label_store.stats.bounding_box(9000) is None
+    # Edits of loaded labels before their statistics are counted
+    for step in range(20):
+        label = int(rng.integers(1, num_labels))
+        points = random_points(rng, 200)
+        if step % 2:
+            label_store.add_points(points, label)
+        else:
+            label_store.remove_points(points, label)
+    check(label_store)
+
+
+def test_copy_has_independent_stats(label_store):
+    label_store.add_points(np.array([[1, 1, 1], [3, 3, 3]]), 1)
+    other = label_store.copy()
+    other.remove_points(np.array([[3, 3, 3]]), 1)
+    assert label_store.stats.bounding_box(1) == ((1, 1, 1), (3, 3, 3))
+    assert other.stats.bounding_box(1) == ((1, 1, 1), (1, 1, 1))
+
+
+def test_nearest_point_of_ring_lies_on_ring(label_store):
+    angles = np.linspace(0, 2 * np.pi, 64, endpoint=False)
+    ring = np.column_stack((12 + np.round(8 * np.cos(angles)), 10 + np.round(8 * np.sin(angles)),
+                            np.full(len(angles), 6))).astype(int)
+    label_store.add_points(ring, 2)
+    x, y, z = label_store.stats.nearest_point(2)
+    assert label_store.label_at((x, y, z)) == 2
+    centroid = label_store.stats.centroid(2)
+    distances = np.linalg.norm(ring - centroid, axis=1)
+    assert np.isclose(np.linalg.norm(np.array([x, y, z]) - centroid), distances.min())
+
+
+def test_slice_extent(label_store):
+    label_store.add_points(np.array([[2, 3, 4], [6, 5, 4], [7, 7, 5]]), 1)
+    assert label_store.stats.slice_extent("XY", 4, 1) == (3, 5, 2, 6)
+    label_store.add_points(np.array([[1, 9, 4]]), 1)
+    assert label_store.stats.slice_extent("XY", 4, 1) == (3, 9, 1, 6)
+    assert label_store.stats.slice_extent("XY", 6, 1) is None
+
+
+@pytest.mark.parametrize("store_class", [DenseLabelStore, ChunkedLabelStore])
+def test_bulk_load_only_records_bounds(store_class):
+    # A load records the bounding boxes of the labels, sums and counts are
+    # counted within the box of a label once it is asked about
+    rng = np.random.default_rng(2)
+    shape = (40, 512, 512)
+    labels = np.zeros(shape, dtype=np.uint16)
+    starts = np.column_stack([rng.integers(0, dim - 12, 2000) for dim in shape])
+    for i, (z, y, x) in enumerate(starts):
+        labels[z:z + 8, y:y + 12, x:x + 12] = i + 1
+    label_store = store_class(shape)
+    start = time.perf_counter()
+    label_store.load_array(labels)
+    assert time.perf_counter() - start < 2
+    label_store.stats.flush()
+    assert all(entry["sums"] is None for entry in label_store.stats.entries.values())
+
+    label = int(labels[tuple(starts[-1] + 4)])
+    z, y, x = np.nonzero(labels == label)
+    assert label_store.stats.bounding_box(label) == ((x.min(), y.min(), z.min()), (x.max(), y.max(), z.max()))
+    assert label_store.stats.entries[label]["sums"] is None
+    np.testing.assert_allclose(label_store.stats.centroid(label), (x.mean(), y.mean(), z.mean()))
+    assert sum(entry["sums"] is not None for entry in label_store.stats.entries.values()) == 1
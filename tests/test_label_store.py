@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+
+from label_store import DenseLabelStore, ChunkedLabelStore, VIEW_PLANES, create_label_store
+
+SHAPE = (10, 17, 23)
+
+
+def stores():
+    return DenseLabelStore(SHAPE), ChunkedLabelStore(SHAPE, chunk_size=8)
+
+
+def random_points(rng, n):
+    # Partly outside the volume, those have to be ignored
+    return np.column_stack([rng.integers(-2, dim + 2, n) for dim in SHAPE[::-1]])
+
+
+def assert_same(dense, chunked):
+    np.testing.assert_array_equal(dense.to_array(), chunked.to_array())
+    assert dense.label_counts == chunked.label_counts
+    assert dense.max_label() == chunked.max_label()
+    for view_plane in VIEW_PLANES:
+        for index in (0, 5):
+            np.testing.assert_array_equal(dense.get_slice(view_plane, index), chunked.get_slice(view_plane, index))
+
+
+def test_dense_and_chunked_agree():
+    rng = np.random.default_rng(0)
+    dense, chunked = stores()
+    for step in range(80):
+        label = int(rng.integers(1, 6))
+        points = random_points(rng, 30)
+        if step % 4 == 3:
+            results = [store.remove_points(points, label) for store in (dense, chunked)]
+        elif step % 4 == 2:
+            labels = rng.integers(0, 6, len(points))
+            for store in (dense, chunked):
+                store.add_labelled_points(points, labels)
+            results = None
+        else:
+            results = [store.add_points(points, label) for store in (dense, chunked)]
+        if results is not None:
+            np.testing.assert_array_equal(np.sort(results[0], axis=0), np.sort(results[1], axis=0))
+        assert_same(dense, chunked)
+
+
+def test_add_points_keeps_painted_voxels():
+    for store in stores():
+        store.add_points(np.array([[1, 2, 3]]), 1)
+        written = store.add_points(np.array([[1, 2, 3], [4, 5, 6]]), 2)
+        assert written.tolist() == [[4, 5, 6]]
+        assert store.label_at((1, 2, 3)) == 1
+        assert store.label_counts == {1: 1, 2: 1}
+
+
+def test_remove_points_only_erases_the_given_label():
+    for store in stores():
+        store.add_points(np.array([[1, 2, 3]]), 1)
+        store.add_points(np.array([[4, 5, 6]]), 2)
+        store.remove_points(np.array([[1, 2, 3], [4, 5, 6]]), 2)
+        assert store.label_counts == {1: 1}
+        assert store.max_label() == 1
+        assert store.label_at((4, 5, 6)) == 0
+
+
+def test_slice_orientation():
+    for store in stores():
+        store.add_points(np.array([[4, 5, 6]]), 3)
+        assert store.get_slice("XY", 6)[5, 4] == 3
+        assert store.get_slice("XZ", 5)[4, 6] == 3
+        assert store.get_slice("YZ", 4)[5, 6] == 3
+        np.testing.assert_array_equal(store.points_in_slice("XZ", 5, 3), [[4, 5, 6]])
+
+
+def test_remove_label():
+    for store in stores():
+        store.add_points(np.array([[1, 1, 1], [9, 9, 9]]), 4)
+        store.add_points(np.array([[2, 2, 2]]), 5)
+        store.remove_label(5)
+        assert store.label_counts == {4: 2}
+        assert store.max_label() == 4
+        assert not store.has_label(5)
+
+
+def test_dtype_grows_with_labels():
+    for store in stores():
+        store.add_points(np.array([[1, 1, 1]]), 1)
+        store.add_points(np.array([[2, 2, 2]]), 70000)
+        assert store.dtype == np.uint32
+        assert store.label_at((2, 2, 2)) == 70000
+        assert store.label_at((1, 1, 1)) == 1
+
+
+def test_load_array():
+    rng = np.random.default_rng(1)
+    labels = rng.integers(-3, 5, SHAPE) * (rng.random(SHAPE) < 0.1)
+    dense, chunked = stores()
+    for store in (dense, chunked):
+        store.add_points(np.array([[0, 0, 0]]), 9)
+        store.load_array(labels)
+    assert_same(dense, chunked)
+    np.testing.assert_array_equal(dense.to_array(), np.where(labels > 0, labels, 0))
+    with pytest.raises(ValueError):
+        dense.load_array(np.zeros((1, 2, 3)))
+
+
+def test_copy_is_independent():
+    for store in stores():
+        store.add_points(np.array([[1, 1, 1]]), 1)
+        other = store.copy()
+        other.add_points(np.array([[2, 2, 2]]), 2)
+        store.remove_points(np.array([[1, 1, 1]]), 1)
+        assert store.label_counts == {}
+        assert other.label_counts == {1: 1, 2: 1}
+        assert other.label_at((1, 1, 1)) == 1
+
+
+def test_create_label_store_picks_backend(monkeypatch):
+    import label_store
+    assert isinstance(create_label_store(SHAPE), DenseLabelStore)
+    monkeypatch.setattr(label_store, "DENSE_STORE_LIMIT_BYTES", 16)
+    assert isinstance(create_label_store(SHAPE), ChunkedLabelStore)
+
+
+def test_chunks_exist_only_where_labels_are():
+    store = ChunkedLabelStore(SHAPE, chunk_size=8)
+    assert store.chunks == {} and store.resident_bytes() == 0
+    store.add_points(np.array([[1, 1, 1], [20, 16, 9]]), 3)
+    # The second chunk lies on the far border and is cut to the volume
+    assert sorted(chunk.shape for chunk in store.chunks.values()) == [(2, 1, 7), (8, 8, 8)]
+    assert store.resident_bytes() == sum(chunk.nbytes for chunk in store.chunks.values())
+    store.remove_points(np.array([[20, 16, 9]]), 3)
+    assert len(store.chunks) == 1
+    store.remove_label(3)
+    assert store.chunks == {}
+
+
+class RecordingChunks(dict):
+    def __init__(self, chunks):
+        super().__init__(chunks)
+        self.read = []
+
+    def get(self, key, default=None):
+        self.read.append(key)
+        return super().get(key, default)
+
+
+@pytest.mark.parametrize("view_plane, axis", [("XY", 0), ("XZ", 1), ("YZ", 2)])
+def test_slice_reads_only_intersecting_chunks(view_plane, axis):
+    store = ChunkedLabelStore(SHAPE, chunk_size=8)
+    rng = np.random.default_rng(2)
+    store.add_points(random_points(rng, 300), 1)
+    store.chunks = RecordingChunks(store.chunks)
+    index = 9
+    store.get_slice(view_plane, index)
+    grid = np.unravel_index(store.chunks.read, store.grid_shape)
+    assert len(store.chunks.read) == np.prod(store.grid_shape) // store.grid_shape[axis]
+    assert (grid[axis] == index // 8).all()
+
+
+def test_linear_indices_round_trip():
+    store = DenseLabelStore(SHAPE)
+    coords = np.array([[22, 16, 9], [0, 0, 0], [3, 4, 5], [3, 4, 5]])
+    lin = store.linear_indices(coords)
+    assert lin.tolist()[:2] == [np.prod(SHAPE) - 1, 0]
+    np.testing.assert_array_equal(store.coords_from_linear(lin), coords)
+    assert store.unique_linear_indices(coords).tolist() == sorted(set(lin.tolist()))
+
+
+def test_stroke_lookup_does_not_grow_with_painted_slice():
+    for store in stores():
+        # A fully painted slice next to the stroke
+        ys, xs = np.mgrid[0:SHAPE[1], 0:SHAPE[2]]
+        store.add_points(np.column_stack((xs.ravel(), ys.ravel(), np.full(xs.size, 4))), 1)
+        looked_up = []
+        get_values = store._get_values
+        store._get_values = lambda lin: looked_up.append(len(lin)) or get_values(lin)
+        stroke = np.array([[1, 1, 4], [2, 1, 4], [2, 1, 4], [5, 5, 5]])
+        written = store.add_points(stroke, 2)
+        assert looked_up == [3]
+        assert written.tolist() == [[5, 5, 5]]
+        store.remove_points(stroke, 1)
+        assert looked_up == [3, 3]
+        assert store.label_counts == {1: xs.size - 2, 2: 1}
+
+
+def test_label_at():
+    for store in stores():
+        store.add_points(np.array([[22, 16, 9], [3, 4, 5]]), 70000)
+        store.add_points(np.array([[0, 0, 0]]), 2)
+        assert [store.label_at(p) for p in ((22, 16, 9), (3, 4, 5), (0, 0, 0), (1, 0, 0))] == [70000, 70000, 2, 0]
+        assert store.label_at((23, 0, 0)) == store.label_at((-1, 0, 0)) == store.label_at((0, 0, 10)) == 0
@@ -0,0 +1,89 @@
+import imageio.v3 as iio
+import numpy as np
+import pytest
+
+import gui_widgets
+from contrast import saturated_range, apply_contrast
+from lazy_volume import LazyVolume, TiffPageStack, memmap_tiff, open_memmap
+
+SHAPE = (7, 30, 41)
+
+
+def volume(dtype=np.uint16):
+    return (np.random.default_rng(0).random(SHAPE) * 3000).astype(dtype)
+
+
+class RecordingVolume:
+    # Raw volume logging the voxels every index reads
+    def __init__(self, raw):
+        self.raw = raw
+        self.shape, self.dtype, self.ndim = raw.shape, raw.dtype, raw.ndim
+        self.reads = []
+
+    def __getitem__(self, key):
+        block = np.asarray(self.raw[key])
+        self.reads.append((key, block.size))
+        return block
+
+
+def test_contiguous_tiff_is_one_strided_array(tmp_path):
+    image = volume()
+    filename = str(tmp_path / "image.tif")
+    iio.imwrite(filename, image)
+    raw = open_memmap(filename)
+    assert isinstance(raw, np.ndarray)
+    np.testing.assert_array_equal(raw, image)
+
+
+def test_uneven_pages_become_page_stack(tmp_path):
+    tifffile = pytest.importorskip("tifffile")
+    image = volume()
+    filename = str(tmp_path / "image.tif")
+    # Descriptions of different lengths between the pages
+    with tifffile.TiffWriter(filename) as writer:
+        for i, page in enumerate(image):
+            writer.write(page, description="x" * (7 * i), metadata=None, contiguous=False)
+    raw = memmap_tiff(filename)
+    assert isinstance(raw, TiffPageStack)
+    assert raw.shape == SHAPE
+    np.testing.assert_array_equal(raw[:], image)
+    np.testing.assert_array_equal(raw[2], image[2])
+    np.testing.assert_array_equal(raw[1:5, 3, ::2], image[1:5, 3, ::2])
+
+
+def test_compressed_tiff_is_not_mapped(tmp_path):
+    filename = str(tmp_path / "image.tif")
+    iio.imwrite(filename, volume(), compression="zlib")
+    assert memmap_tiff(filename) is None
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_lazy_volume_matches_contrast(dtype):
+    image = volume(dtype)
+    contrast = saturated_range(image)
+    lazy = LazyVolume(image, contrast=contrast)
+    expected = apply_contrast(image, *contrast)
+    np.testing.assert_array_equal(lazy[3], expected[3])
+    np.testing.assert_array_equal(lazy[:, 4], expected[:, 4])
+    assert lazy.shape == SHAPE and lazy.dtype == np.uint8
+
+
+def test_scrolling_lazy_tiff_reads_only_shown_planes(tmp_path, monkeypatch, main_window, open_image):
+    filename = str(tmp_path / "image.tif")
+    iio.imwrite(filename, volume())
+    monkeypatch.setattr(gui_widgets, "LAZY_LOAD_MIN_BYTES", 0)
+    document = open_image(filename)
+    assert isinstance(document.image_data, LazyVolume)
+    # Not copied into a reordered layout
+    assert document.volume_layout.n_bytes == 0
+    main_window.slice_prefetcher.stop()
+    raw = document.image_data.raw = RecordingVolume(document.image_data.raw)
+    for y in (3, 4, 5, 20):
+        main_window.slidery.setValue(y)
+        main_window.render_scheduler.flush()
+    z_dim, y_dim, x_dim = SHAPE
+    assert len(raw.reads) > 0
+    for key, size in raw.reads:
+        # One XZ row of every plane, never the volume
+        assert key == (slice(None), key[1]) and size == z_dim * x_dim
+    assert {key[1] for key, size in raw.reads} <= {3, 4, 5, 20}
@@ -0,0 +1,131 @@
+import imageio.v3 as iio
+import numpy as np
+import pytest
+
+import mask_io
+from label_store import DenseLabelStore, ChunkedLabelStore
+from lazy_volume import memmap_tiff
+from mask_io import RleVolume, encode_plane_runs, load_mask_file, save_dtype, save_label_store
+
+SHAPE = (6, 9, 11)
+
+
+def random_labels(seed, max_label):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(1, max_label + 1, SHAPE) * (rng.random(SHAPE) < 0.3)
+    # Long runs across rows
+    labels[2, 3:5, :] = max_label
+    return labels
+
+
+def test_encode_plane_runs():
+    plane = np.array([[0, 3, 3], [3, 0, 5]])
+    starts, lengths, values = encode_plane_runs(plane)
+    assert starts.tolist() == [1, 5]
+    assert lengths.tolist() == [3, 1]
+    assert values.tolist() == [3, 5]
+
+
+@pytest.mark.parametrize("store_class", [DenseLabelStore, ChunkedLabelStore])
+@pytest.mark.parametrize("max_label", [7, 300, 70000])
+def test_rle_round_trip(tmp_path, store_class, max_label):
+    labels = random_labels(max_label, max_label)
+    label_store = store_class(SHAPE)
+    label_store.load_array(labels)
+    filename = str(tmp_path / "labels.npz")
+    progress = []
+    save_label_store(label_store, filename, progress.append)
+    assert progress[-1] == 1
+    assert not (tmp_path / "labels.npz.part").exists()
+
+    volume = load_mask_file(filename)
+    assert isinstance(volume, RleVolume)
+    assert volume.shape == SHAPE
+    assert volume.dtype == np.min_scalar_type(max_label)
+    np.testing.assert_array_equal(volume[:], labels)
+    np.testing.assert_array_equal(volume[2], labels[2])
+    np.testing.assert_array_equal(volume[1:4, 2:5, 3], labels[1:4, 2:5, 3])
+    np.testing.assert_array_equal(volume[-1], labels[-1])
+    assert volume.max() == labels.max()
+    assert volume.min() == 0
+
+    restored = store_class(SHAPE)
+    restored.load_array(volume)
+    np.testing.assert_array_equal(restored.to_array(), labels)
+    assert restored.label_counts == label_store.label_counts
+
+
+def test_rle_of_empty_and_full_volumes(tmp_path):
+    for fill in (0, 4):
+        label_store = DenseLabelStore(SHAPE)
+        label_store.load_array(np.full(SHAPE, fill))
+        filename = str(tmp_path / ("%d.npz" % fill))
+        save_label_store(label_store, filename)
+        volume = load_mask_file(filename)
+        np.testing.assert_array_equal(volume[:], np.full(SHAPE, fill))
+        assert volume.min() == fill and volume.max() == fill
+
+
+def test_unsupported_npz_is_rejected(tmp_path):
+    filename = str(tmp_path / "other.npz")
+    np.savez(filename, labels=np.zeros(3))
+    with pytest.raises(ValueError):
+        RleVolume(filename)
+
+
+def test_save_dtype_is_smallest_sufficient():
+    assert [save_dtype(n) for n in (0, 255, 256, 65535, 65536)] == \
+        [np.uint8, np.uint8, np.uint16, np.uint16, np.uint32]
+
+
+@pytest.mark.parametrize("store_class", [DenseLabelStore, ChunkedLabelStore])
+@pytest.mark.parametrize("ext", [".npy", ".tif"])
+@pytest.mark.parametrize("max_label", [7, 300, 70000])
+def test_plane_formats_round_trip(tmp_path, store_class, ext, max_label):
+    labels = random_labels(max_label, max_label)
+    label_store = store_class(SHAPE)
+    label_store.load_array(labels)
+    filename = str(tmp_path / ("labels" + ext))
+    progress = []
+    save_label_store(label_store, filename, progress.append)
+    assert progress == sorted(progress) and progress[-1] == 1
+    volume = load_mask_file(filename)
+    assert volume.dtype == np.min_scalar_type(max_label)
+    np.testing.assert_array_equal(volume, labels)
+    if ext == ".tif":
+        # Evenly spaced pages, so the file maps as one array
+        mapped = memmap_tiff(filename)
+        assert isinstance(mapped, np.ndarray)
+        np.testing.assert_array_equal(mapped, labels)
+
+
+def test_large_tiff_is_written_as_bigtiff(tmp_path, monkeypatch):
+    monkeypatch.setattr(mask_io, "MAX_CLASSIC_TIFF_BYTES", 100)
+    labels = random_labels(3, 9)
+    label_store = DenseLabelStore(SHAPE)
+    label_store.load_array(labels)
+    filename = str(tmp_path / "labels.tif")
+    save_label_store(label_store, filename)
+    with open(filename, "rb") as fp:
+        assert fp.read(4) == b"II+\0"
+    np.testing.assert_array_equal(memmap_tiff(filename), labels)
+    np.testing.assert_array_equal(iio.imread(filename), labels)
+
+
+def test_failed_save_keeps_previous_file(tmp_path, monkeypatch):
+    filename = str(tmp_path / "labels.npy")
+    np.save(filename, np.arange(3))
+    label_store = DenseLabelStore(SHAPE)
+    label_store.add_points(np.array([[1, 1, 1]]), 1)
+
+    def failing_planes(label_store, dtype):
+        yield np.zeros(SHAPE[1:], dtype=dtype)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(mask_io, "store_planes", failing_planes)
+    with pytest.raises(OSError):
+        save_label_store(label_store, filename)
+    np.testing.assert_array_equal(np.load(filename), np.arange(3))
+    assert not (tmp_path / "labels.npy.part").exists()
+    with pytest.raises(ValueError):
+        save_label_store(label_store, str(tmp_path / "labels.png"))
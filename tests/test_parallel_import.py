@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+from label_store import DenseLabelStore, ChunkedLabelStore
+from mask_io import load_mask_file
+from parallel_import import import_tiles, parallel_load_array
+
+SHAPE = (13, 21, 18)
+
+
+def create_store(store_class):
+    if store_class is ChunkedLabelStore:
+        return ChunkedLabelStore(SHAPE, chunk_size=8)
+    return store_class(SHAPE)
+
+
+def test_tiles_cover_volume():
+    covered = np.zeros(SHAPE[:2], dtype=int)
+    for z0, z1, y0, y1 in import_tiles(SHAPE, 8):
+        covered[z0:z1, y0:y1] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize("store_class", [DenseLabelStore, ChunkedLabelStore])
+@pytest.mark.parametrize("dtype, max_label", [(np.int64, 40), (np.int32, 70000), (np.float32, 9)])
+def test_matches_serial_load(store_class, dtype, max_label):
+    rng = np.random.default_rng(max_label)
+    labels = (rng.integers(-2, max_label + 1, SHAPE) * (rng.random(SHAPE) < 0.2)).astype(dtype)
+    # A region without labels, its chunks must stay unwritten
+    labels[:8] = 0
+    expected = create_store(store_class)
+    expected.load_array(labels)
+
+    store = create_store(store_class)
+    store.add_points(np.array([[0, 0, 0]]), 3)
+    parallel_load_array(store, labels, max_workers=2)
+    assert store.dtype == expected.dtype
+    np.testing.assert_array_equal(store.to_array(), expected.to_array())
+    assert store.label_counts == expected.label_counts
+    assert store.max_label() == expected.max_label()
+    assert store.label_blocks == expected.label_blocks
+    for label in expected.label_counts:
+        assert store.stats.bounding_box(label) == expected.stats.bounding_box(label)
+    if store_class is ChunkedLabelStore:
+        assert set(store.chunks) == set(expected.chunks)
+
+
+def test_memmapped_input_is_not_copied(tmp_path, monkeypatch):
+    import parallel_import
+    rng = np.random.default_rng(3)
+    labels = (rng.integers(0, 30, SHAPE) * (rng.random(SHAPE) < 0.2)).astype(np.uint16)
+    filename = str(tmp_path / "labels.npy")
+    np.save(filename, labels)
+    mapped = load_mask_file(filename)
+    assert isinstance(mapped, np.memmap)
+
+    def no_shared(shape, dtype):
+        raise AssertionError("input copied into shared memory")
+
+    outputs = []
+
+    def create_mapped(shape, dtype):
+        outputs.append(parallel_import_create_mapped(shape, dtype))
+        return outputs[-1]
+
+    parallel_import_create_mapped = parallel_import.create_mapped
+    monkeypatch.setattr(parallel_import, "create_shared", no_shared)
+    monkeypatch.setattr(parallel_import, "create_mapped", create_mapped)
+    store = DenseLabelStore(SHAPE)
+    parallel_load_array(store, mapped, max_workers=2)
+    np.testing.assert_array_equal(store.to_array(), labels)
+    values, counts = np.unique(labels[labels > 0], return_counts=True)
+    assert store.label_counts == dict(zip(values.tolist(), counts.tolist()))
+    # The dense store keeps the output mapping, its file is already removed
+    (output_file, output, _), = outputs
+    assert np.shares_memory(store.labels, output)
+    assert not os.path.exists(output_file)
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+from render_scheduler import RenderScheduler
+
+
+@pytest.fixture
+def rendered():
+    return []
+
+
+@pytest.fixture
+def scheduler(qapp, rendered):
+    return RenderScheduler({plane: (lambda plane=plane: rendered.append(plane)) for plane in ("XY", "XZ", "YZ")})
+
+
+def run_events(qapp, seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        qapp.processEvents()
+        time.sleep(0.001)
+
+
+def test_requests_are_coalesced_per_frame(qapp, scheduler, rendered):
+    for _ in range(5):
+        scheduler.request("YZ")
+        scheduler.request("XY")
+    assert rendered == []
+    run_events(qapp, 3 * scheduler.frame_interval + 0.05)
+    assert rendered == ["XY", "YZ"]
+
+
+def test_request_without_planes_renders_all(scheduler, rendered):
+    scheduler.request()
+    scheduler.flush()
+    assert rendered == ["XY", "XZ", "YZ"]
+    assert not scheduler.timer.isActive()
+
+
+def test_flush_waits_for_the_next_frame(qapp, scheduler, rendered):
+    scheduler.frame_interval = 0.2
+    scheduler.request("XZ")
+    scheduler.flush()
+    scheduler.request("XZ")
+    run_events(qapp, 0.05)
+    assert rendered == ["XZ"]
+    run_events(qapp, 0.3)
+    assert rendered == ["XZ", "XZ"]
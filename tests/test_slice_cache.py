@@ -0,0 +1,95 @@
+import gc
+import threading
+import time
+
+import pytest
+
+from slice_cache import SliceCache, SlicePrefetcher
+
+
+class Source:
+    pass
+
+
+def test_least_recently_used_slices_are_evicted():
+    cache, source = SliceCache(budget_bytes=30), Source()
+    for index in range(3):
+        cache.put("base", source, "XY", index, "slice %d" % index, 10)
+    assert cache.get("base", source, "XY", 0) == "slice 0"
+    cache.put("base", source, "XY", 3, "slice 3", 10)
+    assert cache.get("base", source, "XY", 1) is None
+    assert [cache.get("base", source, "XY", i) for i in (0, 2, 3)] == ["slice 0", "slice 2", "slice 3"]
+    assert cache.n_bytes == 30
+    # Larger than the whole budget
+    cache.put("base", source, "XY", 4, "slice 4", 31)
+    assert cache.get("base", source, "XY", 4) is None and cache.n_bytes == 30
+
+
+def test_slices_are_keyed_by_source_identity():
+    cache, source, other = SliceCache(), Source(), Source()
+    cache.put("overlay", source, "XZ", 1, "labels", 1)
+    assert cache.get("overlay", other, "XZ", 1) is None
+    assert cache.get("base", source, "XZ", 1) is None
+    del source
+    gc.collect()
+    # A new source may get the id of the collected one
+    assert all(cache.get("overlay", Source(), "XZ", 1) is None for _ in range(10))
+    cache.put("overlay", other, "XZ", 1, "labels", 1)
+    cache.drop_source(other)
+    assert cache.get("overlay", other, "XZ", 1) is None
+
+
+def test_slice_rendered_before_an_edit_is_not_stored():
+    cache, source = SliceCache(), Source()
+    cache.put("overlay", source, "XY", 5, "old", 1)
+    generation = cache.generation("overlay", source, "XY", 5)
+    cache.invalidate("overlay", source, "XY", range(4, 7))
+    assert cache.get("overlay", source, "XY", 5) is None
+    cache.put("overlay", source, "XY", 5, "stale", 1, generation)
+    assert cache.get("overlay", source, "XY", 5) is None
+    cache.put("overlay", source, "XY", 5, "new", 1, cache.generation("overlay", source, "XY", 5))
+    assert cache.get("overlay", source, "XY", 5) == "new"
+
+
+@pytest.fixture
+def prefetcher(qapp):
+    prefetcher = SlicePrefetcher(SliceCache())
+    yield prefetcher
+    prefetcher.stop()
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_prefetcher_fills_the_cache(prefetcher):
+    source = Source()
+    render = lambda source, view_plane, index: ((view_plane, index), 1)
+    prefetcher.request("XY", [("base", source, "XY", i, render) for i in (3, 1, 4)])
+    prefetcher.request("YZ", [("base", source, "YZ", 2, render)])
+    cache = prefetcher.cache
+    assert wait_for(lambda: cache.n_bytes == 4)
+    assert cache.get("base", source, "XY", 4) == ("XY", 4)
+    assert cache.get("base", source, "YZ", 2) == ("YZ", 2)
+
+
+def test_new_request_replaces_pending_jobs(prefetcher):
+    source, started, release = Source(), threading.Event(), threading.Event()
+    rendered = []
+
+    def render(source, view_plane, index):
+        started.set()
+        release.wait(5)
+        rendered.append(index)
+        return index, 1
+
+    prefetcher.request("XY", [("base", source, "XY", i, render) for i in (0, 1, 2)])
+    assert started.wait(5)
+    prefetcher.request("XY", [("base", source, "XY", i, render) for i in (7, 8)])
+    release.set()
+    assert wait_for(lambda: len(rendered) == 3)
+    time.sleep(0.05)
+    assert rendered == [0, 7, 8]
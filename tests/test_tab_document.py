@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+
+from autosave import AutosaveStore, checkpoint_jobs
+from label_store import DenseLabelStore
+from tab_document import (TabDocument, document_property, link_source, link_documents, join_link, relink_documents,
+                          handover_link, unlink_documents)
+
+SHAPE = (8, 8, 8)
+
+
+def document(label_store=None, points=None, label=1):
+    document = TabDocument()
+    document.label_store = label_store if label_store is not None else DenseLabelStore(SHAPE)
+    if points is not None:
+        document.label_store.add_points(np.array(points), label)
+    return document
+
+
+def autosave(tmp_path, documents):
+    for i, document in enumerate(documents):
+        if document.autosave is None:
+            document.autosave = AutosaveStore("image%d.tif" % i, path=str(tmp_path / str(i)))
+            document.autosave.track(document.label_store)
+            document.autosave.saved = (id(document.label_store), 0)
+    jobs = checkpoint_jobs([(document.autosave, document.own_store()) for document in documents])
+    for autosave_store, label_store, blocks, unsaved in jobs:
+        autosave_store.write(label_store.shape, blocks, unsaved)
+
+
+def test_annotated_tab_is_link_source():
+    annotated = document(points=[[1, 1, 1]])
+    empty = document()
+    other_shape = document(DenseLabelStore((4, 4, 4)), points=[[1, 1, 1]])
+    assert link_source(empty, [annotated, empty, other_shape]) is annotated
+    assert link_source(empty, [empty, other_shape]) is empty
+
+
+def test_link_is_refused_when_several_tabs_have_annotations():
+    first = document(points=[[1, 1, 1]])
+    second = document(points=[[2, 2, 2]])
+    assert link_source(first, [first, second]) is None
+
+
+def test_link_keeps_autosave_of_annotated_tab(tmp_path):
+    annotated = document()
+    empty = document()
+    documents = [annotated, empty]
+    autosave(tmp_path, documents)
+    annotated.label_store.add_points(np.array([[1, 1, 1]]), 1)
+    autosave(tmp_path, documents)
+
+    link_documents(link_source(empty, documents), documents)
+    assert empty.label_store is annotated.label_store
+    autosave(tmp_path, documents)
+    assert annotated.autosave.blocks == {0}
+    assert annotated.autosave.manifest["unsaved"]
+    assert AutosaveStore("image0.tif", path=str(tmp_path / "0")).can_resume(SHAPE)
+    # The joined tab checkpoints its own, empty store
+    assert empty.autosave.blocks == set()
+
+
+def test_unlink_keeps_shared_edits():
+    source = document(points=[[1, 1, 1]])
+    follower = document()
+    documents = [source, follower]
+    link_documents(source, documents)
+    follower.label_store.add_points(np.array([[2, 2, 2]]), 2)
+
+    unlink_documents(source, documents)
+    assert source.unlinked_store is None and follower.unlinked_store is None
+    assert follower.label_store is not source.label_store
+    np.testing.assert_array_equal(follower.label_store.to_array(), source.label_store.to_array())
+    assert follower.label_store.label_counts == {1: 1, 2: 1}
+
+
+def test_unlink_without_annotations_restores_own_store():
+    source = document()
+    follower = document()
+    own_store = follower.label_store
+    link_documents(source, [source, follower])
+    unlink_documents(source, [source, follower])
+    assert follower.label_store is own_store
+
+
+def test_join_and_handover():
+    source = document(points=[[1, 1, 1]])
+    follower = document()
+    link_documents(source, [source])
+    join_link(source, follower)
+    assert follower.label_store is source.label_store
+
+    shared = source.label_store
+    new_source = handover_link(source, [follower])
+    assert new_source is follower
+    assert follower.own_store() is shared
+    assert handover_link(follower, [follower]) is None
+
+
+def test_relink_replaces_shared_store():
+    source = document(points=[[1, 1, 1]])
+    follower = document()
+    documents = [source, follower]
+    link_documents(source, documents)
+    loaded = DenseLabelStore(SHAPE)
+    relink_documents(source, documents, loaded)
+    assert source.label_store is loaded and source.own_store() is loaded
+    assert follower.label_store is loaded
+    assert follower.own_store() is not loaded
+
+
+def test_document_property_follows_current_document():
+
+    class Window:
+        label_store = document_property("label_store")
+
+    window, first, second = Window(), document(), document()
+    window.document = first
+    window.label_store = DenseLabelStore(SHAPE)
+    assert first.label_store is window.label_store
+    window.document = second
+    assert window.label_store is second.label_store is not first.label_store
+
+
+def test_share_image_does_not_copy():
+    source, other = document(), document()
+    source.image_data = np.zeros(SHAPE, dtype=np.uint8)
+    source.volume_layout = object()
+    source.image_min, source.image_max = 3, 9
+    other.share_image(source)
+    assert other.image_data is source.image_data and other.volume_layout is source.volume_layout
+    assert (other.image_min, other.image_max) == (3, 9)
+    assert other.label_store is not source.label_store
+
+
+def test_spill_and_restore(tmp_path):
+    spilled = document(points=[[1, 2, 3]])
+    image = np.arange(np.prod(SHAPE), dtype=np.uint16).reshape(SHAPE)
+    spilled.image_data = image.copy()
+    assert spilled.resident_bytes(set()) == image.nbytes + spilled.label_store.labels.nbytes
+    spilled.spill(str(tmp_path))
+    assert isinstance(spilled.image_data, np.memmap) and isinstance(spilled.label_store.labels, np.memmap)
+    assert spilled.resident_bytes(set()) == 0
+    # Edits of a spilled tab go to its file
+    spilled.label_store.add_points(np.array([[4, 4, 4]]), 2)
+    assert spilled.restore()
+    assert type(spilled.image_data) is np.ndarray and type(spilled.label_store.labels) is np.ndarray
+    np.testing.assert_array_equal(spilled.image_data, image)
+    assert spilled.label_store.label_at((1, 2, 3)) == 1 and spilled.label_store.label_at((4, 4, 4)) == 2
+    assert not spilled.restore()
+    # The image never changes, its file is written once
+    image_spill = spilled.image_spill
+    modified = os.path.getmtime(image_spill)
+    spilled.spill(str(tmp_path))
+    assert spilled.image_spill == image_spill and os.path.getmtime(image_spill) == modified
+    spilled.restore()
+    spilled.remove_spill_files()
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,67 @@
+import gc
+
+import numpy as np
+import pytest
+
+from volume_layout import LayoutBudget, VolumeLayout, TransposedVolumeLayout, BrickedVolumeLayout, \
+    create_volume_layout, is_resident
+
+SHAPE = (11, 37, 45)
+
+
+@pytest.fixture(autouse=True)
+def build_in_place(monkeypatch):
+    # Copies are built on the calling thread, so they are done once get_slice returns
+    monkeypatch.setattr(VolumeLayout, "_build_async", lambda self, target, *args: target(*args))
+
+
+def volume(shape=SHAPE):
+    return np.random.default_rng(0).integers(0, 256, shape).astype(np.uint8)
+
+
+@pytest.mark.parametrize("layout", ["transposed", "bricked"])
+@pytest.mark.parametrize("shape", [SHAPE, SHAPE + (3,)])
+def test_slices_match_strided(layout, shape):
+    image = volume(shape)
+    strided = VolumeLayout(image)
+    volume_layout = create_volume_layout(image, layout, LayoutBudget(1 << 30))
+    for view_plane, n in (("XY", shape[0]), ("XZ", shape[1]), ("YZ", shape[2])):
+        for index in (0, n // 2, n - 1):
+            # The first slice starts the copy, the second is read from it
+            volume_layout.get_slice(view_plane, index)
+            np.testing.assert_array_equal(volume_layout.get_slice(view_plane, index),
+                                          strided.get_slice(view_plane, index))
+    assert volume_layout.n_bytes >= image.nbytes
+
+
+def test_budget_is_shared_by_layouts():
+    image = volume()
+    budget = LayoutBudget(2 * image.nbytes)
+    first = TransposedVolumeLayout(image, budget)
+    first.get_slice("XZ", 0)
+    first.get_slice("YZ", 0)
+    assert set(first.copies) == {"XZ", "YZ"}
+    second = TransposedVolumeLayout(image, budget)
+    second.get_slice("XZ", 0)
+    assert second.copies == {} and second.n_bytes == 0
+    # Collecting a layout returns its copies to the budget
+    del first
+    gc.collect()
+    assert budget.n_bytes == 0
+    third = TransposedVolumeLayout(image, budget)
+    third.get_slice("XZ", 0)
+    assert set(third.copies) == {"XZ"}
+
+
+@pytest.mark.parametrize("layout_class", [TransposedVolumeLayout, BrickedVolumeLayout])
+def test_mapped_volume_is_not_copied(tmp_path, layout_class):
+    image = volume()
+    np.save(str(tmp_path / "image.npy"), image)
+    mapped = np.load(str(tmp_path / "image.npy"), mmap_mode="r")
+    assert not is_resident(mapped) and not is_resident(mapped[2:5]) and is_resident(image)
+    budget = LayoutBudget(1 << 30)
+    volume_layout = layout_class(mapped, budget)
+    for view_plane in ("XZ", "YZ"):
+        volume_layout.get_slice(view_plane, 3)
+    np.testing.assert_array_equal(volume_layout.get_slice("XZ", 3), VolumeLayout(image).get_slice("XZ", 3))
+    assert volume_layout.n_bytes == 0 and budget.n_bytes == 0
@@ -0,0 +1,185 @@
+import mmap
+import threading
+import weakref
+
+import numpy as np
+
+VOLUME_LAYOUTS = ("strided", "transposed", "bricked")
+# Extra memory the layouts of all tabs together may spend on reordered copies
+VOLUME_LAYOUT_BUDGET_BYTES = 2 << 30
+BRICK_SIZE = 32
+# Z-planes copied per step while reordering, keeps the copy cache friendly
+COPY_BLOCK = 64
+
+
+def is_resident(array):
+    # Whether array is held in memory, not mapped from a file or decoded on access
+    if not isinstance(array, np.ndarray):
+        return False
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return False
+        array = array.base
+    return not isinstance(array, mmap.mmap)
+
+
+class LayoutBudget:
+    # Memory the reordered copies of all layouts in the process may hold.
+    # A reservation is returned once the layout holding it is collected.
+
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, owner, n_bytes):
+        with self.lock:
+            if self.n_bytes + n_bytes > self.limit_bytes:
+                return False
+            self.n_bytes += n_bytes
+        weakref.finalize(owner, self.release, n_bytes)
+        return True
+
+    def release(self, n_bytes):
+        with self.lock:
+            self.n_bytes -= n_bytes
+
+
+layout_budget = LayoutBudget(VOLUME_LAYOUT_BUDGET_BYTES)
+
+
+class VolumeLayout:
+    # Slices a (Z, Y, X) or (Z, Y, X, C) image volume for the three view planes,
+    # in the orientation get_flat_image_view has always used. This base layout
+    # reads XZ and YZ slices strided from the original volume.
+
+    def __init__(self, image_data, budget=None):
+        self.image_data = image_data
+        self.shape = image_data.shape
+        self.budget = budget or layout_budget
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get_slice(self, view_plane, index):
+        if view_plane == "XY":
+            return self.image_data[index]
+        elif view_plane == "XZ":
+            return np.swapaxes(self.image_data[:, index], 0, 1)
+        elif view_plane == "YZ":
+            return np.swapaxes(self.image_data[:, :, index], 0, 1)
+        raise ValueError("Invalid viewplane. Choose among 'XY', 'XZ', 'YZ'")
+
+    def _reserve(self, n_bytes):
+        # Reordered copies are only made of volumes held in memory and while
+        # they fit in the budget. Copying a memory-mapped or lazily decoded
+        # volume would read all of it, the views only read the planes shown.
+        if not is_resident(self.image_data) or not self.budget.reserve(self, n_bytes):
+            return False
+        self.n_bytes += n_bytes
+        return True
+
+    def _build_async(self, target, *args):
+        # Copies are built off the GUI thread, slices stay strided until they are done
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+
+class TransposedVolumeLayout(VolumeLayout):
+    # XZ and YZ slices come from (Y, X, Z) and (X, Y, Z) copies of the volume,
+    # in which they are contiguous. Each copy is built the first time its plane
+    # is viewed.
+    AXES = {"XZ": (1, 2, 0), "YZ": (2, 1, 0)}
+
+    def __init__(self, image_data, budget=None):
+        super().__init__(image_data, budget)
+        self.copies = {}
+        self.requested = set()
+
+    def get_slice(self, view_plane, index):
+        copy = self.copies.get(view_plane)
+        if copy is not None:
+            return copy[index]
+        if view_plane in self.AXES:
+            with self.lock:
+                start = view_plane not in self.requested and self._reserve(self.image_data.nbytes)
+                self.requested.add(view_plane)
+            if start:
+                self._build_async(self._build_copy, view_plane)
+        return super().get_slice(view_plane, index)
+
+    def _build_copy(self, view_plane):
+        axes = self.AXES[view_plane] + tuple(range(3, self.image_data.ndim))
+        shape = tuple(self.shape[axis] for axis in axes)
+        copy = np.empty(shape, dtype=self.image_data.dtype)
+        for z_start in range(0, self.shape[0], COPY_BLOCK):
+            z_end = min(z_start + COPY_BLOCK, self.shape[0])
+            copy[:, :, z_start:z_end] = self.image_data[z_start:z_end].transpose(axes)
+        self.copies[view_plane] = copy
+
+
+class BrickedVolumeLayout(VolumeLayout):
+    # One copy of the volume regrouped into BRICK_SIZE^3 bricks which are each
+    # stored contiguously, shape (GZ, GY, GX, B, B, B[, C]). A single copy serves
+    # both XZ and YZ, every slice touching only compact bricks. XY slices are
+    # contiguous in the original volume already.
+
+    def __init__(self, image_data, budget=None, brick_size=BRICK_SIZE):
+        super().__init__(image_data, budget)
+        self.brick_size = brick_size
+        self.grid_shape = tuple(-(-dim // brick_size) for dim in self.shape[:3])
+        self.bricks = None
+        self.requested = False
+
+    def get_slice(self, view_plane, index):
+        bricks = self.bricks
+        if bricks is None or view_plane == "XY":
+            if view_plane != "XY":
+                self._request_bricks()
+            return super().get_slice(view_plane, index)
+        z_dim, y_dim, x_dim = self.shape[:3]
+        grid_z, grid_y, grid_x = self.grid_shape
+        b = self.brick_size
+        channels = self.shape[3:]
+        brick, local = divmod(index, b)
+        if view_plane == "XZ":
+            # (GZ, GX, Bz, Bx) -> (GX, Bx, GZ, Bz) -> (X, Z)
+            part = bricks[:, brick, :, :, local, :]
+            part = np.moveaxis(part, (0, 1, 2, 3), (2, 0, 3, 1))
+            return part.reshape((grid_x * b, grid_z * b) + channels)[:x_dim, :z_dim]
+        elif view_plane == "YZ":
+            # (GZ, GY, Bz, By) -> (GY, By, GZ, Bz) -> (Y, Z)
+            part = bricks[:, :, brick, :, :, local]
+            part = np.moveaxis(part, (0, 1, 2, 3), (2, 0, 3, 1))
+            return part.reshape((grid_y * b, grid_z * b) + channels)[:y_dim, :z_dim]
+        raise ValueError("Invalid viewplane. Choose among 'XY', 'XZ', 'YZ'")
+
+    def _request_bricks(self):
+        b = self.brick_size
+        padded = int(np.prod(self.grid_shape, dtype=np.int64)) * b ** 3 * self.image_data[0, 0, 0].nbytes
+        with self.lock:
+            start = not self.requested and self._reserve(padded)
+            self.requested = True
+        if start:
+            self._build_async(self._build_bricks)
+
+    def _build_bricks(self):
+        b = self.brick_size
+        grid_z, grid_y, grid_x = self.grid_shape
+        channels = self.shape[3:]
+        bricks = np.zeros(self.grid_shape + (b, b, b) + channels, dtype=self.image_data.dtype)
+        for gz in range(grid_z):
+            block = self.image_data[gz * b:(gz + 1) * b]
+            padded = np.zeros((b, grid_y * b, grid_x * b) + channels, dtype=self.image_data.dtype)
+            padded[:block.shape[0], :block.shape[1], :block.shape[2]] = block
+            padded = padded.reshape((b, grid_y, b, grid_x, b) + channels)
+            bricks[gz] = np.moveaxis(padded, (0, 1, 2, 3, 4), (2, 0, 3, 1, 4))
+        self.bricks = bricks
+
+
+def create_volume_layout(image_data, layout="transposed", budget=None):
+    if layout == "transposed":
+        return TransposedVolumeLayout(image_data, budget)
+    elif layout == "bricked":
+        return BrickedVolumeLayout(image_data, budget)
+    elif layout == "strided":
+        return VolumeLayout(image_data, budget)
+    raise ValueError("Invalid volume layout. Choose among %s" % ", ".join(VOLUME_LAYOUTS))